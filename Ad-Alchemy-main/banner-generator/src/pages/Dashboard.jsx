@@ -8,7 +8,7 @@ import { getFirestore, collection, addDoc, getDocs, query, where, orderBy,
 import { getStorage, ref, uploadString, getDownloadURL, deleteObject } from 'firebase/storage';
 // Remove or comment out this import since it's not being used
 // import MokshaImageGenerator from '../components/MokshaImageGenerator';
-import { getUserDesigns, saveGeneratedImage } from '../services/mokshaService';
+import { getUserDesigns, saveGeneratedImage, saveCustomization, persistImageUrl } from '../services/mokshaService';
 import { auth } from '../services/firebase';
 
 const Dashboard = () => {
@@ -675,17 +675,32 @@ const Dashboard = () => {
       // Set crossOrigin to anonymous to handle CORS
       img.crossOrigin = 'anonymous';
       
+      // Prefer the server renderer for images the Flask API hosts; it saves the
+      // render as a permanent design and returns its URL instead of a
+      // size-capped data URL
+      let customizedImageUrl = null;
+      try {
+        customizedImageUrl = await saveCustomization(selectedDesign.imageUrl, customOptions, {
+          userId: currentUser.uid,
+          prompt: selectedDesign.prompt || imagePrompt || ''
+        });
+      } catch (renderError) {
+        console.warn('Server-side customization failed, using canvas:', renderError);
+      }
+      
       // Wait for image to load with CORS handling
-      await new Promise((resolve, reject) => {
-        img.onload = resolve;
-        img.onerror = (e) => {
-          console.error('Error loading image:', e);
-          // If CORS fails, try to load without CORS
-          img.crossOrigin = '';
+      if (!customizedImageUrl) {
+        await new Promise((resolve, reject) => {
+          img.onload = resolve;
+          img.onerror = (e) => {
+            console.error('Error loading image:', e);
+            // If CORS fails, try to load without CORS
+            img.crossOrigin = '';
+            img.src = selectedDesign.imageUrl;
+          };
           img.src = selectedDesign.imageUrl;
-        };
-        img.src = selectedDesign.imageUrl;
-      });
+        });
+      }
       
       // Calculate new dimensions while maintaining aspect ratio
       const maxDimension = 1200; // Maximum width or height
@@ -705,62 +720,64 @@ const Dashboard = () => {
       canvas.height = height;
       
       try {
-        // Apply filters and transformations
-        ctx.filter = `
-          ${customOptions.theme === 'modern' ? 'contrast(1.2) saturate(1.2) brightness(1.1)' : 
-            customOptions.theme === 'retro' ? 'sepia(0.5) contrast(1.1) brightness(0.9)' : 
-            'contrast(1) saturate(1) brightness(1)'}
-          ${customOptions.colors[0] === '#8B5CF6' ? 'hue-rotate(240deg)' : 
-            customOptions.colors[0] === '#3B82F6' ? 'hue-rotate(180deg)' : 
-            customOptions.colors[0] === '#F59E0B' ? 'hue-rotate(30deg)' : 
-            customOptions.colors[0] === '#6366F1' ? 'hue-rotate(200deg)' : ''}
-        `;
+        if (!customizedImageUrl) {
+          // Apply filters and transformations
+          ctx.filter = `
+            ${customOptions.theme === 'modern' ? 'contrast(1.2) saturate(1.2) brightness(1.1)' : 
+              customOptions.theme === 'retro' ? 'sepia(0.5) contrast(1.1) brightness(0.9)' : 
+              'contrast(1) saturate(1) brightness(1)'}
+            ${customOptions.colors[0] === '#8B5CF6' ? 'hue-rotate(240deg)' : 
+              customOptions.colors[0] === '#3B82F6' ? 'hue-rotate(180deg)' : 
+              customOptions.colors[0] === '#F59E0B' ? 'hue-rotate(30deg)' : 
+              customOptions.colors[0] === '#6366F1' ? 'hue-rotate(200deg)' : ''}
+          `;
         
-        // Draw the base image
-        ctx.drawImage(img, 0, 0, width, height);
+          // Draw the base image
+          ctx.drawImage(img, 0, 0, width, height);
         
-        // Apply color overlay
-        ctx.fillStyle = `${customOptions.colors[0]}20`;
-        ctx.globalCompositeOperation = 'color';
-        ctx.fillRect(0, 0, width, height);
+          // Apply color overlay
+          ctx.fillStyle = `${customOptions.colors[0]}20`;
+          ctx.globalCompositeOperation = 'color';
+          ctx.fillRect(0, 0, width, height);
         
-        // Reset composite operation
-        ctx.globalCompositeOperation = 'source-over';
+          // Reset composite operation
+          ctx.globalCompositeOperation = 'source-over';
         
-        // Add text if present
-        if (customOptions.text) {
-          // Scale font size based on image dimensions
-          const baseFontSize = Math.min(width, height) * 0.05; // 5% of the smaller dimension
-          const fontSize = customOptions.size === 'small' ? baseFontSize * 0.8 : 
-                          customOptions.size === 'large' ? baseFontSize * 1.2 : 
-                          baseFontSize;
+          // Add text if present
+          if (customOptions.text) {
+            // Scale font size based on image dimensions
+            const baseFontSize = Math.min(width, height) * 0.05; // 5% of the smaller dimension
+            const fontSize = customOptions.size === 'small' ? baseFontSize * 0.8 : 
+                            customOptions.size === 'large' ? baseFontSize * 1.2 : 
+                            baseFontSize;
           
-          ctx.font = `${fontSize}px ${customOptions.font}`;
-          ctx.fillStyle = customOptions.colors[2];
-          ctx.textAlign = 'center';
-          ctx.textBaseline = 'middle';
+            ctx.font = `${fontSize}px ${customOptions.font}`;
+            ctx.fillStyle = customOptions.colors[2];
+            ctx.textAlign = 'center';
+            ctx.textBaseline = 'middle';
           
-          // Calculate text position
-          const x = (customOptions.position.x / 100) * width;
-          const y = (customOptions.position.y / 100) * height;
+            // Calculate text position
+            const x = (customOptions.position.x / 100) * width;
+            const y = (customOptions.position.y / 100) * height;
           
-          // Apply rotation and scale
-          ctx.save();
-          ctx.translate(x, y);
-          ctx.rotate((customOptions.rotation * Math.PI) / 180);
-          ctx.scale(customOptions.scale, customOptions.scale);
+            // Apply rotation and scale
+            ctx.save();
+            ctx.translate(x, y);
+            ctx.rotate((customOptions.rotation * Math.PI) / 180);
+            ctx.scale(customOptions.scale, customOptions.scale);
           
-          // Draw text
-          ctx.fillText(customOptions.text, 0, 0);
-          ctx.restore();
-        }
+            // Draw text
+            ctx.fillText(customOptions.text, 0, 0);
+            ctx.restore();
+          }
         
-        // Convert canvas to data URL with compression
-        const customizedImageUrl = canvas.toDataURL('image/jpeg', 0.8); // 80% quality
+          // Convert canvas to data URL with compression
+          customizedImageUrl = canvas.toDataURL('image/jpeg', 0.8); // 80% quality
         
-        // Check if the data URL is still too large
-        if (customizedImageUrl.length > 1000000) { // 1MB limit
-          throw new Error('Image too large after compression');
+          // Check if the data URL is still too large
+          if (customizedImageUrl.length > 1000000) { // 1MB limit
+            throw new Error('Image too large after compression');
+          }
         }
         
         // Create the customized design object
@@ -962,12 +979,14 @@ const Dashboard = () => {
         
         try {
           // For demo/development: Save to Firestore without Storage
-          // This is a CORS workaround - in production, you would upload to Storage
+          // This is a CORS workaround - in production, you would upload to Storage.
+          // Images the server generated are temporary, so it saves a permanent copy first
+          const permanentUrl = await persistImageUrl(imageUrl, { userId, prompt: promptText || '' });
           const designDoc = {
             userId: userId,
             type: 'image',
             prompt: promptText || 'Generated image',
-            imageUrl: imageUrl, // Store the original URL directly
+            imageUrl: permanentUrl,
             createdAt: serverTimestamp(),
             source: 'external',
             filename: filename
@@ -7,8 +7,12 @@ import { getStorage, ref, uploadString, getDownloadURL } from 'firebase/storage'
 import { auth } from './firebase';
 
 // API endpoint for image generation
-// Changed from external API to local Flask server
-const API_ENDPOINT = 'http://localhost:5000/generate';
+// Flask server base URL; set REACT_APP_API_BASE_URL when it is not on localhost
+const API_BASE_URL = (process.env.REACT_APP_API_BASE_URL || 'http://localhost:5000').replace(/\/+$/, '');
+const API_ENDPOINT = `${API_BASE_URL}/generate`;
+const BATCH_API_ENDPOINT = `${API_BASE_URL}/generate-batch`;
+const CUSTOMIZE_API_ENDPOINT = `${API_BASE_URL}/render-customization`;
+const SAVE_API_ENDPOINT = `${API_BASE_URL}/save-image`;
 
 // Generate placeholder images when the API is unavailable
 const generatePlaceholderImage = (text) => {
@@ -51,6 +55,120 @@ export const generateImageFromPrompt = async (prompt) => {
   }
 };
 
+// Generate many images in one request. The server streams one JSON line per
+// prompt as each finishes, so onResult fires in completion order, not input order.
+export const generateImagesFromPrompts = async (prompts, { concurrency, onResult } = {}) => {
+  const response = await fetch(BATCH_API_ENDPOINT, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify({ prompts, concurrency })
+  });
+  
+  if (!response.ok || !response.body) {
+    throw new Error(`Batch generation failed with status ${response.status}`);
+  }
+  
+  const results = new Array(prompts.length);
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffered = '';
+  
+  const handleLine = (line) => {
+    if (!line.trim()) return;
+    const result = JSON.parse(line);
+    if (result.done) return;
+    results[result.index] = result;
+    if (onResult) onResult(result);
+  };
+  
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffered += decoder.decode(value, { stream: true });
+    const lines = buffered.split('\n');
+    buffered = lines.pop();
+    lines.forEach(handleLine);
+  }
+  handleLine(buffered);
+  
+  return results;
+};
+
+// Generate one image with live progress. The server streams Server-Sent Events
+// (queued, upstream_started, first_bytes, decoded, resized, saved, done/failed);
+// EventSource reconnects on its own and the server resumes from the last event.
+// Resolves with the /generate-style result; onEvent(name, data) sees every event.
+export const generateImageWithProgress = (prompt, { onEvent } = {}) => new Promise((resolve, reject) => {
+  const source = new EventSource(`${API_BASE_URL}/generate-stream?prompt=${encodeURIComponent(prompt)}`);
+  const stages = ['queued', 'upstream_started', 'first_bytes', 'decoded', 'resized', 'saved'];
+  
+  stages.forEach((name) => source.addEventListener(name, (event) => {
+    if (onEvent) onEvent(name, JSON.parse(event.data));
+  }));
+  source.addEventListener('done', (event) => {
+    source.close();
+    const result = JSON.parse(event.data);
+    if (onEvent) onEvent('done', result);
+    resolve({ ...result, imageUrl: result.image_url });
+  });
+  source.addEventListener('failed', (event) => {
+    source.close();
+    reject(new Error(JSON.parse(event.data).error || 'Generation failed'));
+  });
+  source.onerror = () => {
+    // CLOSED means the server refused the stream (e.g. a 400); otherwise the browser retries
+    if (source.readyState === EventSource.CLOSED) {
+      reject(new Error('Generation stream failed'));
+    }
+  };
+});
+
+// Render theme/palette/text customizations on the Flask server. Only images
+// the server hosts or publishes (images/, saved-images/ and blobs/ in object
+// storage) can be rendered there; returns null for anything else so callers
+// can fall back to the canvas path.
+export const renderCustomization = async (imageUrl, options) => {
+  if (!imageUrl || !/\/((saved-)?images|blobs)\//.test(imageUrl) || imageUrl.startsWith('data:')) {
+    return null;
+  }
+  
+  const response = await axios.post(CUSTOMIZE_API_ENDPOINT, { imageUrl, options });
+  return response.data.imageUrl;
+};
+
+// Like renderCustomization, but also saves the render as a permanent design
+// on the server. Rendered previews are a cache the server evicts, so this is
+// the URL to store. Returns null when the server cannot render the image.
+export const saveCustomization = async (imageUrl, options, { userId, prompt } = {}) => {
+  if (!imageUrl || !/\/((saved-)?images|blobs)\//.test(imageUrl) || imageUrl.startsWith('data:')) {
+    return null;
+  }
+  
+  const response = await axios.post(CUSTOMIZE_API_ENDPOINT, {
+    imageUrl, options, userId, prompt, save: true
+  });
+  return response.data.imageUrl;
+};
+
+// Generated images (images/ on the Flask server or in object storage) are
+// temporary: the server evicts them, and object-storage URLs are presigned
+// and expire. Saves one as a permanent design on the server and returns the
+// URL to store instead; any other URL is returned unchanged.
+export const persistImageUrl = async (imageUrl, { userId, prompt } = {}) => {
+  if (!imageUrl || imageUrl.startsWith('data:') || !/\/images\//.test(imageUrl)) {
+    return imageUrl;
+  }
+  
+  const filename = imageUrl.split('?')[0].split('/').pop();
+  try {
+    const response = await axios.post(SAVE_API_ENDPOINT, { filename, userId, prompt });
+    return response.data.design.imageUrl;
+  } catch (error) {
+    console.warn('Could not save the image on the server, storing its temporary URL:', error);
+    return imageUrl;
+  }
+};
+
 // Add this utility function to check and fix localhost URLs
 export const fixLocalImageUrl = (imageUrl) => {
   // Check if this is a localhost URL
@@ -221,8 +339,10 @@ export const saveGeneratedImage = async (imageData) => {
         storeDataUrlDirectly = true;
       }
     } else {
-      // For remote URLs, log but don't attempt storage upload due to CORS
+      // For remote URLs, log but don't attempt storage upload due to CORS;
+      // the server keeps a permanent copy of images it generated
       console.log('Using remote URL directly (CORS limitation)');
+      imageUrl = await persistImageUrl(imageUrl, { userId, prompt: imageData.prompt || '' });
     }
     
     // Save metadata to Firestore for permanent persistence
@@ -317,6 +437,11 @@ export const saveGeneratedImage = async (imageData) => {
 // Create a named service object to fix the ESLint warning
 const mokshaService = {
   generateImageFromPrompt,
+  generateImagesFromPrompts,
+  generateImageWithProgress,
+  renderCustomization,
+  saveCustomization,
+  persistImageUrl,
   getUserDesigns,
   saveGeneratedImage
 };
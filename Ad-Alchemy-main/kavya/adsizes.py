@@ -0,0 +1,163 @@
+"""
+adsizes.py
+
+Fans one generated creative out to the standard ad sizes. The source image
+is decoded once and a saliency map is computed once, with vectorized NumPy
+on a downscaled copy:
+
+    saliency = edge energy (luminance gradient magnitude)
+             + colour contrast (distance from the mean colour)
+             + a weak centre prior,
+    box-smoothed so isolated pixels do not pull the crop.
+
+For each size the crop window with that aspect ratio is as large as the
+source allows, and slides along the free axis to wherever it covers the
+most saliency (a cumulative sum makes every offset one subtraction). Crop
+and resize are then a single Image.resize(box=...) call per size.
+"""
+
+import re
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from metrics import timed
+from postprocess import EncodeOptions, REDUCING_GAP, encode
+
+# ------------------------------------------------------------------------------
+# Configuration: named sizes and saliency resolution
+# ------------------------------------------------------------------------------
+AD_SIZES = {
+    'banner': (1200, 628),
+    'leaderboard': (728, 90),
+    'medium_rectangle': (300, 250),
+    'wide_skyscraper': (160, 600),
+    'square': (1080, 1080),
+}
+SALIENCY_SIZE = 256     # the source is downscaled to fit this box for the map
+SMOOTH_RADIUS = 4       # box blur radius, in saliency-map pixels
+CENTER_WEIGHT = 0.1     # strength of the centre prior relative to the cues
+MAX_DIMENSION = 4096
+
+_CUSTOM_SIZE = re.compile(r"^(\d+)x(\d+)$")
+
+
+def parse_sizes(values) -> dict:
+    """
+    Returns {name: (width, height)} for a request's `sizes` list of names
+    from AD_SIZES and/or "WxH" strings; None means every named size.
+    Raises ValueError on anything else.
+    """
+    if values is None:
+        return dict(AD_SIZES)
+    if not isinstance(values, list) or not values:
+        raise ValueError("sizes must be a non-empty list")
+    sizes = {}
+    for value in values:
+        value = str(value).lower()
+        if value in AD_SIZES:
+            sizes[value] = AD_SIZES[value]
+            continue
+        match = _CUSTOM_SIZE.match(value)
+        if not match:
+            raise ValueError(f"Unknown ad size: {value}")
+        width, height = int(match.group(1)), int(match.group(2))
+        if not (1 <= width <= MAX_DIMENSION and 1 <= height <= MAX_DIMENSION):
+            raise ValueError(f"Ad size out of range: {value}")
+        sizes[value] = (width, height)
+    return sizes
+
+
+def _smooth(values: np.ndarray, radius: int) -> np.ndarray:
+    """
+    Separable box blur via cumulative sums, edges extended.
+    """
+    window = 2 * radius + 1
+    for axis in (0, 1):
+        pad = [(0, 0), (0, 0)]
+        pad[axis] = (radius + 1, radius)
+        summed = np.cumsum(np.pad(values, pad, mode='edge'), axis=axis)
+        n = values.shape[axis]
+        values = (np.take(summed, np.arange(window, n + window), axis=axis)
+                  - np.take(summed, np.arange(0, n), axis=axis)) / window
+    return values
+
+
+def saliency_map(image: Image.Image, size: int = SALIENCY_SIZE) -> np.ndarray:
+    """
+    Returns a float32 saliency map of `image`, downscaled to fit `size`.
+    """
+    small = image.convert('RGB')
+    small.thumbnail((size, size), Image.BILINEAR)
+    rgb = np.asarray(small, dtype=np.float32) / 255.0
+    lum = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+    gy, gx = np.gradient(lum)
+    edges = np.hypot(gx, gy)
+    contrast = np.linalg.norm(rgb - rgb.reshape(-1, 3).mean(axis=0), axis=2)
+
+    h, w = lum.shape
+    y = (np.arange(h, dtype=np.float32) - (h - 1) / 2) / max(h, 1)
+    x = (np.arange(w, dtype=np.float32) - (w - 1) / 2) / max(w, 1)
+    center = np.exp(-(y[:, None] ** 2 + x[None, :] ** 2) / 0.18)
+
+    saliency = (edges / max(float(edges.max()), 1e-6)
+                + contrast / max(float(contrast.max()), 1e-6)
+                + CENTER_WEIGHT * center)
+    return _smooth(saliency, SMOOTH_RADIUS).astype(np.float32)
+
+
+def best_crop(saliency: np.ndarray, source_size: tuple, target_size: tuple) -> tuple:
+    """
+    Returns the (left, top, right, bottom) box in source pixels of the
+    largest `target_size`-shaped crop covering the most saliency.
+    """
+    src_w, src_h = source_size
+    aspect = target_size[0] / target_size[1]
+    map_h, map_w = saliency.shape
+    wide = src_w / src_h > aspect
+
+    if wide:
+        # Full height; slide horizontally
+        crop_w, crop_h = src_h * aspect, float(src_h)
+        profile, scale, extent, free = saliency.sum(axis=0), src_w / map_w, crop_w, src_w - crop_w
+    else:
+        # Full width; slide vertically
+        crop_w, crop_h = float(src_w), src_w / aspect
+        profile, scale, extent, free = saliency.sum(axis=1), src_h / map_h, crop_h, src_h - crop_h
+
+    length = min(len(profile), max(1, int(round(extent / scale))))
+    summed = np.concatenate(([0.0], np.cumsum(profile, dtype=np.float64)))
+    windows = summed[length:] - summed[:-length]
+    offset = min(free, int(np.argmax(windows)) * scale)
+
+    if wide:
+        return (offset, 0.0, offset + crop_w, crop_h)
+    return (0.0, offset, crop_w, offset + crop_h)
+
+
+def render_sizes(data: bytes, sizes: dict, options: EncodeOptions = EncodeOptions(),
+                 map_fn=map) -> list:
+    """
+    Returns [(name, (width, height), crop box, encoded bytes), ...] for
+    every entry of `sizes`, cut from the image `data`. `map_fn` (e.g. an
+    executor's map) runs the per-size crop, resize and encode.
+    """
+    image = Image.open(BytesIO(data))
+    with timed("decode"):
+        image.load()
+    if image.mode not in ('RGB', 'RGBA', 'L'):
+        image = image.convert('RGB')
+    with timed("saliency"):
+        saliency = saliency_map(image)
+
+    def render(item):
+        name, size = item
+        box = best_crop(saliency, image.size, size)
+        with timed("resize"):
+            resized = image.resize(size, Image.LANCZOS, box=box, reducing_gap=REDUCING_GAP)
+        with timed("encode"):
+            return name, size, tuple(round(v) for v in box), encode(resized, options)
+
+    return list(map_fn(render, sizes.items()))
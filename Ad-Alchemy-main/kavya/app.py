@@ -1,11 +1,16 @@
-from flask import Flask, request, jsonify, send_file, send_from_directory
+from flask import Flask, request, jsonify, Response, stream_with_context, g, redirect
 from flask_cors import CORS
 import os
 import sys
 import logging
-from PIL import Image
 import shutil
 import uuid
+import json
+import base64
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from werkzeug.security import safe_join
 from datetime import datetime  # Add this import for datetime
 
 # Add the path to your ML model
@@ -19,18 +24,43 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Create a new Flask app instead of importing from gemmi
-app = Flask(__name__, static_folder='images')
+# Create the Flask app
+# /images is served by serve_image below, not Flask's static route
+app = Flask(__name__, static_folder=None)
 CORS(app)  # Enable CORS for all routes
 
 # Import necessary components from gemmi
 from gemmi import (
     GeminiImageGenerator, 
-    next_image_filename, 
+    write_image_exclusive, 
     BANNER_WIDTH, 
     BANNER_HEIGHT
 )
 
+from cache import GenerationCache, make_cache_key
+from postprocess import EncodeOptions, process as postprocess_image
+from jobs import JobQueue, JOB_QUEUED, JOB_DONE, JOB_FAILED, TERMINAL_EVENTS
+from designs import DesignIndex, saved_design_user
+from layout import ShardedDirectory
+from blobstore import BlobStore
+from derivatives import DerivativeStore, MIMETYPES
+from customize import CustomizationRenderer, InvalidOptions, CUSTOMIZED_DIR
+from colors import ColorIndex, hex_to_rgb
+from phash import (HashIndex, dhash_file, same_pixels, KIND_TEMP, KIND_SAVED, DEDUP_THRESHOLD,
+                   SIMILAR_THRESHOLD, MAX_SEARCH_DISTANCE)
+from singleflight import SingleFlight, FlightFailed
+from janitor import (TempJanitor, protected_filenames, CUSTOMIZED_LOCK_PATH,
+                     CUSTOMIZED_MAX_AGE, CUSTOMIZED_MAX_BYTES)
+from upstream import UpstreamGuard, UpstreamUnavailable, CIRCUIT_OPEN
+from scoring import score_image
+from adsizes import AD_SIZES, parse_sizes, render_sizes
+from metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE, timed
+from serving import send_image, OFFLOAD, OFFLOAD_X_SENDFILE
+from storage import make_storage, public_url
+
+# With IMAGE_OFFLOAD=x-sendfile, send_file hands the path to the front server
+app.config['USE_X_SENDFILE'] = OFFLOAD == OFFLOAD_X_SENDFILE
+
 # Load API key
 from dotenv import load_dotenv
 load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "GEMINI_API_KEY.env"))
@@ -41,7 +71,8 @@ if not API_KEY:
 # Initialize the generator
 generator = None
 if API_KEY:
-    generator = GeminiImageGenerator(api_key=API_KEY)
+    # Rate limit / retry / circuit breaker state is shared by all workers
+    generator = GeminiImageGenerator(api_key=API_KEY, guard=UpstreamGuard())
     logger.info("Initialized Gemini generator successfully")
 else:
     logger.error("Failed to initialize Gemini generator - missing API key")
@@ -52,62 +83,792 @@ SAVED_IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sav
 os.makedirs(TEMP_IMAGES_DIR, exist_ok=True)
 os.makedirs(SAVED_IMAGES_DIR, exist_ok=True)
 
+# Hash-sharded layouts; files not yet migrated are still found at the top level
+temp_images = ShardedDirectory(TEMP_IMAGES_DIR)
+saved_images = ShardedDirectory(SAVED_IMAGES_DIR, group_of=saved_design_user)
+
+# Saved-design metadata, indexed on (user_id, created_at); designs saved
+# before the index existed are imported from their .meta files once
+design_index = DesignIndex()
+design_index.import_once(SAVED_IMAGES_DIR)
+
+# Saved image bytes, stored once per distinct content and reference-counted
+blob_store = BlobStore()
+
+# Where clients download images from: this service, or an S3-compatible bucket/CDN
+storage = make_storage()
+
+def blob_key(digest):
+    return f"blobs/{os.path.basename(blob_store.path(digest))}"
+
+def design_image_url(row):
+    if row['blob']:
+        return storage.url(blob_key(row['blob']), f"/saved-images/{row['id']}")
+    return public_url(f"/saved-images/{row['id']}")
+
+def saved_image_path(design_id):
+    """
+    Returns the on-disk path of a saved design's image: its blob, or the
+    saved_images/ file for designs saved before the blob store existed.
+    """
+    row = design_index.get(design_id)
+    if row is not None and row['blob']:
+        return blob_store.path(row['blob'])
+    return saved_images.resolve(design_id) or saved_images.path_for(design_id)
+
+# Thumbnail / WebP / AVIF variants of saved images
+derivative_store = DerivativeStore(
+    SAVED_IMAGES_DIR, source_path=saved_image_path,
+    publish=lambda filename, width, fmt, path: storage.publish(
+        DerivativeStore.key(filename, width, fmt), path, MIMETYPES[fmt]))
+
+# Dominant-colour palettes of saved designs, searchable by colour
+color_index = ColorIndex()
+
+# Perceptual hashes of generated and saved images, for near-duplicate lookup
+hash_index = HashIndex()
+
+# Server-side customization renders, cached by source + options
+customization_renderer = CustomizationRenderer(
+    publish=lambda filename, path: storage.publish(f"customized/{filename}", path, 'image/jpeg'))
+
+# Page size limits for /user-designs
+DESIGNS_PAGE_SIZE = 50
+DESIGNS_MAX_PAGE_SIZE = 200
+
+# Cache of finished banners keyed on (model, enhanced prompt, size)
+generation_cache = GenerationCache()
+
+# Identical generations already in flight are joined instead of repeated
+generation_flights = SingleFlight()
+
+# Candidates of a multi-variant generation are post-processed side by side
+MAX_VARIANTS = int(os.getenv("GENERATE_MAX_VARIANTS", "4"))
+variant_pool = ThreadPoolExecutor(max_workers=MAX_VARIANTS, thread_name_prefix="variant")
+
+# Request and cache metrics served by /metrics
+http_requests = REGISTRY.counter(
+    "banner_http_requests_total", "HTTP requests by route, method and status.",
+    ("route", "method", "status"))
+http_in_flight = REGISTRY.gauge(
+    "banner_http_requests_in_flight", "HTTP requests currently being handled.", ("route",))
+http_seconds = REGISTRY.histogram(
+    "banner_http_request_seconds", "Time to produce a response, by route.", ("route",))
+cache_lookups = REGISTRY.counter(
+    "banner_cache_lookups_total", "Cache lookups by cache and result.", ("cache", "result"))
+
+def cache_hit_ratios():
+    stats = generation_cache.stats()
+    ratios = {('generation',): stats['hitRatio']}
+    counts = cache_lookups.samples()
+    for (cache_name, result), count in counts.items():
+        if result == 'hit':
+            total = count + counts.get((cache_name, 'miss'), 0)
+            ratios[(cache_name,)] = count / total if total else 0.0
+    return ratios
+
+REGISTRY.callback_gauge(
+    "banner_cache_hit_ratio", "Fraction of cache lookups served from the cache.",
+    ("cache",), cache_hit_ratios)
+
+def upstream_samples():
+    if getattr(generator, 'guard', None) is None:
+        return {}
+    state = generator.guard.state()
+    return {('tokens',): state['tokens'],
+            ('circuit_open',): float(state['circuit'] == CIRCUIT_OPEN),
+            ('consecutive_failures',): state['failures']}
+
+REGISTRY.callback_gauge(
+    "banner_upstream_state", "Gemini rate limiter tokens and circuit breaker state.",
+    ("field",), upstream_samples)
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.metrics_start = time.perf_counter()
+    http_in_flight.inc(route=g.metrics_route)
+
+@app.after_request
+def count_request(response):
+    http_requests.inc(route=g.metrics_route, method=request.method, status=response.status_code)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    route = g.pop('metrics_route', None)
+    if route is not None:
+        http_in_flight.dec(route=route)
+        http_seconds.observe(time.perf_counter() - g.metrics_start, route=route)
+
+# Server-Sent Events for /generate-stream and /jobs/<job_id>/events. A stream
+# polls the job store every EVENT_STREAM_POLL_INTERVAL seconds while events
+# arrive, backing off to EVENT_STREAM_MAX_POLL_INTERVAL while the job is quiet
+EVENT_STREAM_POLL_INTERVAL = float(os.getenv("EVENT_STREAM_POLL_INTERVAL", "0.05"))
+EVENT_STREAM_MAX_POLL_INTERVAL = float(os.getenv("EVENT_STREAM_MAX_POLL_INTERVAL", "1.0"))
+EVENT_STREAM_HEARTBEAT = float(os.getenv("EVENT_STREAM_HEARTBEAT", "15"))
+EVENT_STREAM_RETRY_MS = int(os.getenv("EVENT_STREAM_RETRY_MS", "2000"))
+
+# Limits for /generate-batch
+BATCH_MAX_PROMPTS = int(os.getenv("BATCH_MAX_PROMPTS", "200"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+
+# Enhance the prompt with banner-specific instructions
+BANNER_INSTRUCTIONS = (
+    "Create a professional horizontal banner image with the following specifications:\n"
+    f"- Exact dimensions: {BANNER_WIDTH}x{BANNER_HEIGHT} pixels\n"
+    "- Use a horizontal rectangular layout with proper banner proportions\n"
+    "- Include visually appealing design elements typical of banners\n"
+    "- Ensure any text is readable and properly positioned for a banner\n"
+    "- Avoid generating images that only show the word 'Boost' or similar text\n"
+    "- Create a complete, polished banner design based on this prompt:\n\n"
+)
+
+# One high-resolution creative that is later cropped to every ad size
+FORMATS_INSTRUCTIONS = (
+    "Create a professional, high-resolution advertising creative with the following specifications:\n"
+    "- It will be cropped to wide banners, squares and tall skyscrapers\n"
+    "- Keep the main subject and any text compact and near the centre\n"
+    "- Surround them with background that can be trimmed on any side\n"
+    "- Ensure any text is readable and large enough for small ad sizes\n"
+    "- Create a complete, polished design based on this prompt:\n\n"
+)
+
+def generation_keys(enhanced_prompt, encode_options):
+    """
+    Returns (cache key, single-flight key) for a generation. Requests that
+    differ only in whitespace share one upstream call.
+    """
+    size = (BANNER_WIDTH, BANNER_HEIGHT)
+    cache_key = make_cache_key(generator.model_name, enhanced_prompt, size, encode_options.cache_tag)
+    flight_key = make_cache_key(generator.model_name, " ".join(enhanced_prompt.split()),
+                                size, encode_options.cache_tag)
+    return cache_key, flight_key
+
+def store_generated_image(prompt, image_bytes, encode_options, cached):
+    """
+    Writes a finished banner to TEMP_IMAGES_DIR and returns the /generate
+    response body.
+    """
+    # Save the image under a fresh, collision-free name
+    with timed("disk_write"):
+        filename = write_image_exclusive(image_bytes, ext=encode_options.extension,
+                                         path_for=temp_images.path_for)
+    image_path = temp_images.path_for(filename)
+    logger.info(f"Image saved to {image_path}")
+    
+    hash_index.schedule(KIND_TEMP, filename, image_path)
+    
+    # Publish it and hand out a URL that does not route the bytes through us
+    key = f"images/{filename}"
+    with timed("upload"):
+        storage.publish(key, image_path)
+    image_url = storage.url(key, f"/images/{filename}")
+    
+    logger.info(f"Generated image URL: {image_url}")
+    
+    return {
+        'success': True,
+        'image_url': image_url,
+        'filename': filename,
+        'prompt': prompt,
+        'cached': cached
+    }
+
+def variants_prompt(enhanced_prompt, variants):
+    # Image models can return several images in one response when asked to
+    return (f"{enhanced_prompt}\n\nProduce {variants} distinct variations of this banner,"
+            " each as a separate image.")
+
+def report_saved(progress, body):
+    if progress is not None:
+        progress('saved', {key: body[key] for key in ('image_url', 'filename', 'cached', 'score')
+                           if key in body})
+
+def finish_variant(prompt, raw_bytes, encode_options, rank, progress=None):
+    """
+    Post-processes, optionally scores and stores one candidate; returns its
+    /generate response body.
+    """
+    image_bytes, _ = postprocess_image(raw_bytes, (BANNER_WIDTH, BANNER_HEIGHT), encode_options,
+                                       progress)
+    body = store_generated_image(prompt, image_bytes, encode_options, False)
+    if rank:
+        with timed("score"):
+            body['score'] = score_image(image_bytes)
+    report_saved(progress, body)
+    return body
+
+def collect_variants(prompt, bodies, rank):
+    """
+    Returns the /generate response body for several candidates. The first
+    (best, when ranked) one also fills the single-image fields.
+    """
+    if rank:
+        bodies = sorted(bodies, key=lambda body: body['score']['score'], reverse=True)
+    return {
+        **bodies[0],
+        'variants': [{key: body[key] for key in ('image_url', 'filename', 'score') if key in body}
+                     for body in bodies],
+    }
+
+def generate_variants(prompt, variants, rank=False, encode_options=None, progress=None):
+    """
+    Generates up to `variants` candidates for `prompt` in as few Gemini calls
+    as the model allows and finishes them in parallel. The generation cache
+    is not used: asking for options means asking for new images.
+    """
+    enhanced_prompt = variants_prompt(BANNER_INSTRUCTIONS + prompt, variants)
+    if progress is not None:
+        progress('upstream_started', {'model': generator.model_name, 'variants': variants})
+    started = time.perf_counter()
+    images = generator.generate_images_bytes(enhanced_prompt, variants)
+    logger.info(f"Received {len(images)} of {variants} requested variants")
+    if progress is not None:
+        # Multi-candidate responses are not streamed; this is when they arrived
+        progress('first_bytes', {'elapsedMs': round((time.perf_counter() - started) * 1000)})
+    bodies = list(variant_pool.map(
+        lambda image: finish_variant(prompt, image[0], encode_options, rank, progress), images))
+    return collect_variants(prompt, bodies, rank)
+
+def generate_banner(prompt, bypass_cache=False, refresh_cache=False, encode_options=None,
+                    variants=1, rank=False, progress=None):
+    """
+    Runs the full generation pipeline for `prompt` (cache lookup, Gemini,
+    post-processing, write to TEMP_IMAGES_DIR) and returns the /generate
+    response body. With `progress(event, data)` the Gemini response is
+    streamed and each stage is reported as it completes.
+    """
+    if not generator:
+        raise RuntimeError('API key not configured')
+    encode_options = encode_options or EncodeOptions()
+    if variants > 1:
+        return generate_variants(prompt, variants, rank, encode_options, progress)
+    
+    enhanced_prompt = BANNER_INSTRUCTIONS + prompt
+    cache_key, flight_key = generation_keys(enhanced_prompt, encode_options)
+    
+    image_bytes = None
+    if not bypass_cache and not refresh_cache:
+        image_bytes = generation_cache.get(cache_key)
+    cached = image_bytes is not None
+    
+    if not cached:
+        def produce():
+            # Generate the image
+            if progress is not None:
+                raw_bytes, _ = generator.stream_image_bytes(enhanced_prompt, progress)
+            else:
+                raw_bytes, _ = generator.generate_image_bytes(enhanced_prompt)
+            
+            # Resize/re-encode to the banner size and requested format, skipping
+            # whatever work the raw bytes make unnecessary
+            image_bytes, _ = postprocess_image(raw_bytes, (BANNER_WIDTH, BANNER_HEIGHT), encode_options,
+                                               progress)
+            return image_bytes
+        
+        try:
+            image_bytes, shared = generation_flights.do(flight_key, produce)
+        except FlightFailed as e:
+            # Another worker's run of this generation failed; a refused call
+            # is reported as a refusal here too
+            if e.retry_after is not None:
+                raise UpstreamUnavailable(str(e), e.retry_after) from e
+            raise
+        cache_lookups.inc(cache='singleflight', result='hit' if shared else 'miss')
+        
+        if shared:
+            # The stages ran under the request that started the flight
+            logger.info(f"Joined an in-flight generation for key {flight_key}")
+        elif not bypass_cache:
+            generation_cache.put(cache_key, image_bytes)
+    else:
+        logger.info(f"Generation cache hit for key {cache_key}")
+    
+    body = store_generated_image(prompt, image_bytes, encode_options, cached)
+    report_saved(progress, body)
+    return body
+
+def run_generation_job(params, progress=None):
+    return generate_banner(
+        params['prompt'],
+        bypass_cache=params.get('noCache', False),
+        refresh_cache=params.get('refreshCache', False),
+        encode_options=EncodeOptions.from_request(params),
+        variants=int(params.get('variants', 1)),
+        rank=bool(params.get('rank', False)),
+        progress=progress
+    )
+
+# Background queue for /generate-jobs; state persists in data/jobs.db
+job_queue = JobQueue(run_generation_job)
+
+def evict_temp_images(names):
+    hash_index.remove(KIND_TEMP, names)
+    for name in names:
+        storage.delete(f"images/{name}")
+
+# Evicts old and over-quota temp images that nothing references
+temp_janitor = TempJanitor(
+    TEMP_IMAGES_DIR,
+    protected=protected_filenames(design_index, job_queue.store),
+    on_evict=evict_temp_images)
+temp_janitor.start()
+
+def evict_customizations(names):
+    for name in names:
+        storage.delete(f"customized/{name}")
+
+# Evicts old and over-quota customization previews; kept customizations are saved designs
+customization_janitor = TempJanitor(
+    CUSTOMIZED_DIR,
+    max_age=CUSTOMIZED_MAX_AGE,
+    max_bytes=CUSTOMIZED_MAX_BYTES,
+    on_evict=evict_customizations,
+    lock_path=CUSTOMIZED_LOCK_PATH,
+    name='customized')
+customization_janitor.start()
+
+def parse_generate_request(data):
+    """
+    Returns generate_banner() keyword arguments for a /generate body, or
+    raises ValueError with the message for a 400 response.
+    """
+    prompt = data.get('prompt')
+    if not prompt:
+        raise ValueError('No prompt provided')
+    variants = int(data.get('variants', 1))
+    if not 1 <= variants <= MAX_VARIANTS:
+        raise ValueError(f'variants must be between 1 and {MAX_VARIANTS}')
+    
+    # noCache skips the cache entirely; refreshCache regenerates and overwrites
+    return {
+        'prompt': prompt,
+        'bypass_cache': bool(data.get('noCache', False)),
+        'refresh_cache': bool(data.get('refreshCache', False)),
+        'encode_options': EncodeOptions.from_request(data),
+        'variants': variants,
+        'rank': bool(data.get('rank', False))
+    }
+
 @app.route('/generate', methods=['POST'])
 def generate():
     try:
         if not generator:
             return jsonify({'error': 'API key not configured'}), 500
             
+        try:
+            options = parse_generate_request(request.json)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        return jsonify(generate_banner(**options))
+        
+    except UpstreamUnavailable as e:
+        # Tell clients when to come back instead of letting them retry into the outage
+        logger.warning("Generation refused: %s", e)
+        response = jsonify({'error': str(e), 'retryAfter': round(e.retry_after, 1)})
+        response.headers['Retry-After'] = str(max(1, int(e.retry_after + 0.999)))
+        return response, 503
+    except Exception as e:
+        logger.exception("Error: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+def generate_ad_formats(prompt, sizes, bypass_cache=False, refresh_cache=False, encode_options=None):
+    """
+    Generates one creative for `prompt` and cuts every entry of `sizes`
+    ({name: (width, height)}) from it with saliency-aware crops. Returns
+    the /generate-formats response body.
+    """
+    if not generator:
+        raise RuntimeError('API key not configured')
+    encode_options = encode_options or EncodeOptions()
+    
+    # The cache holds the uncropped source, so any set of sizes can reuse it
+    enhanced_prompt = FORMATS_INSTRUCTIONS + prompt
+    cache_key = make_cache_key(generator.model_name, enhanced_prompt, (0, 0), 'source')
+    
+    source_bytes = None
+    if not bypass_cache and not refresh_cache:
+        source_bytes = generation_cache.get(cache_key)
+    cached = source_bytes is not None
+    cache_lookups.inc(cache='formats', result='hit' if cached else 'miss')
+    
+    if not cached:
+        source_bytes, _ = generator.generate_image_bytes(enhanced_prompt)
+        if not bypass_cache:
+            generation_cache.put(cache_key, source_bytes)
+    
+    renders = render_sizes(source_bytes, sizes, encode_options, map_fn=variant_pool.map)
+    formats = []
+    for name, (width, height), box, image_bytes in renders:
+        body = store_generated_image(prompt, image_bytes, encode_options, cached)
+        formats.append({
+            'name': name,
+            'width': width,
+            'height': height,
+            'image_url': body['image_url'],
+            'filename': body['filename'],
+            'crop': list(box)
+        })
+    
+    return {
+        'success': True,
+        'prompt': prompt,
+        'cached': cached,
+        'formats': formats
+    }
+
+@app.route('/generate-formats', methods=['POST'])
+def generate_formats():
+    try:
+        if not generator:
+            return jsonify({'error': 'API key not configured'}), 500
+        
         data = request.json
-        prompt = data.get('prompt')
+        try:
+            prompt = data.get('prompt')
+            if not prompt:
+                raise ValueError('No prompt provided')
+            sizes = parse_sizes(data.get('sizes'))
+            encode_options = EncodeOptions.from_request(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        if not prompt:
-            return jsonify({'error': 'No prompt provided'}), 400
-            
-        # Enhance the prompt with banner-specific instructions
-        banner_instructions = (
-            "Create a professional horizontal banner image with the following specifications:\n"
-            f"- Exact dimensions: {BANNER_WIDTH}x{BANNER_HEIGHT} pixels\n"
-            "- Use a horizontal rectangular layout with proper banner proportions\n"
-            "- Include visually appealing design elements typical of banners\n"
-            "- Ensure any text is readable and properly positioned for a banner\n"
-            "- Avoid generating images that only show the word 'Boost' or similar text\n"
-            "- Create a complete, polished banner design based on this prompt:\n\n"
-        )
+        return jsonify(generate_ad_formats(
+            prompt, sizes,
+            bypass_cache=bool(data.get('noCache', False)),
+            refresh_cache=bool(data.get('refreshCache', False)),
+            encode_options=encode_options
+        ))
+    
+    except UpstreamUnavailable as e:
+        logger.warning("Generation refused: %s", e)
+        response = jsonify({'error': str(e), 'retryAfter': round(e.retry_after, 1)})
+        response.headers['Retry-After'] = str(max(1, int(e.retry_after + 0.999)))
+        return response, 503
+    except Exception as e:
+        logger.exception("Error generating ad formats: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+def job_params(options):
+    """
+    Returns the JSON-serializable job parameters for parse_generate_request() output.
+    """
+    encode_options = options['encode_options']
+    return {
+        'prompt': options['prompt'],
+        'noCache': options['bypass_cache'],
+        'refreshCache': options['refresh_cache'],
+        'format': encode_options.format,
+        'quality': encode_options.quality,
+        'compressLevel': encode_options.compress_level,
+        'variants': options['variants'],
+        'rank': options['rank']
+    }
+
+@app.route('/generate-jobs', methods=['POST'])
+def submit_generation_job():
+    try:
+        if not generator:
+            return jsonify({'error': 'API key not configured'}), 500
         
-        enhanced_prompt = banner_instructions + prompt
+        try:
+            options = parse_generate_request(request.json)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        job_id = job_queue.submit(job_params(options))
         
-        # Generate the image
-        image = generator.generate_image(enhanced_prompt)
+        return jsonify({
+            'success': True,
+            'jobId': job_id,
+            'status': JOB_QUEUED,
+            'statusUrl': public_url(f"/jobs/{job_id}"),
+            'eventsUrl': public_url(f"/jobs/{job_id}/events")
+        }), 202
         
-        # Resize to banner dimensions
-        image = image.resize((BANNER_WIDTH, BANNER_HEIGHT), Image.LANCZOS)
+    except Exception as e:
+        logger.exception("Error submitting generation job: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/generate-batch', methods=['POST'])
+def generate_batch():
+    try:
+        if not generator:
+            return jsonify({'error': 'API key not configured'}), 500
         
-        # Save the image
-        images_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
-        os.makedirs(images_dir, exist_ok=True)
+        data = request.json
+        prompts = data.get('prompts')
         
-        filename = next_image_filename(directory=images_dir)
-        image_path = os.path.join(images_dir, filename)
-        image.save(image_path)
-        logger.info(f"Image saved to {image_path}")
+        if not prompts or not isinstance(prompts, list):
+            return jsonify({'error': 'No prompts provided'}), 400
+        if len(prompts) > BATCH_MAX_PROMPTS:
+            return jsonify({'error': f'Too many prompts (max {BATCH_MAX_PROMPTS})'}), 400
         
-        # Create a full URL for the image that includes the host
-        image_url = f"http://localhost:5000/images/{filename}"
+        concurrency = max(1, min(int(data.get('concurrency', BATCH_MAX_CONCURRENCY)), BATCH_MAX_CONCURRENCY))
+        bypass_cache = bool(data.get('noCache', False))
+        refresh_cache = bool(data.get('refreshCache', False))
+        encode_options = EncodeOptions.from_request(data)
         
-        logger.info(f"Generated image URL: {image_url}")
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.exception("Error starting batch: %s", e)
+        return jsonify({'error': str(e)}), 500
+    
+    logger.info(f"Starting batch of {len(prompts)} prompts with concurrency {concurrency}")
+    
+    def run_batch():
+        succeeded = 0
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="generation-batch") as executor:
+            futures = {}
+            for index, prompt in enumerate(prompts):
+                if not prompt:
+                    yield json.dumps({'index': index, 'success': False, 'error': 'No prompt provided'}) + "\n"
+                    continue
+                futures[executor.submit(generate_banner, prompt, bypass_cache, refresh_cache, encode_options)] = (index, prompt)
+            
+            # Emit one NDJSON line per prompt as soon as it finishes
+            for future in as_completed(futures):
+                index, prompt = futures[future]
+                try:
+                    result = future.result()
+                    succeeded += 1
+                    yield json.dumps({'index': index, **result}) + "\n"
+                except Exception as e:
+                    logger.exception(f"Batch prompt {index} failed: {e}")
+                    yield json.dumps({'index': index, 'success': False, 'prompt': prompt, 'error': str(e)}) + "\n"
+        
+        yield json.dumps({
+            'done': True,
+            'total': len(prompts),
+            'succeeded': succeeded,
+            'failed': len(prompts) - succeeded
+        }) + "\n"
+    
+    return Response(stream_with_context(run_batch()), mimetype='application/x-ndjson')
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        job = job_queue.store.get(job_id)
+        if job is None:
+            return jsonify({'error': f'Job not found: {job_id}', 'success': False}), 404
         
         return jsonify({
             'success': True,
-            'image_url': image_url,
-            'filename': filename,
-            'prompt': prompt
+            'job': job
         })
         
     except Exception as e:
-        logger.exception("Error: %s", e)
+        logger.exception("Error retrieving job %s: %s", job_id, e)
         return jsonify({'error': str(e)}), 500
 
+def parse_event_id(value):
+    """
+    Splits a Last-Event-ID of the form "<job id>:<event id>" into
+    (job id, event id); anything else gives (None, 0).
+    """
+    job_id, _, event_id = (value or '').partition(':')
+    if not job_id or not event_id.isdigit():
+        return None, 0
+    return job_id, int(event_id)
+
+def format_event(job_id, event):
+    return (f"id: {job_id}:{event['id']}\n"
+            f"event: {event['event']}\n"
+            f"data: {json.dumps(event['data'])}\n\n")
+
+EVENT_STREAM_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',  # let nginx pass events through immediately
+}
+
+def job_event_steps(job_id, after=0):
+    """
+    Yields the text/event-stream chunks replaying the job's events after
+    event id `after` and following new ones until the job finishes, with
+    the number of seconds to wait before polling again in between. Both
+    the WSGI and the ASGI streams drive it.
+    """
+    store = job_queue.store
+    cursor = after
+    delay = EVENT_STREAM_POLL_INTERVAL
+    last_write = time.monotonic()
+    yield f"retry: {EVENT_STREAM_RETRY_MS}\n\n"
+    while True:
+        # Read the status before the events: finish() writes both at once,
+        # so a finished job's final event is always in this batch
+        job = store.get(job_id)
+        batch = store.events(job_id, cursor)
+        for event in batch:
+            cursor = event['id']
+            yield format_event(job_id, event)
+            if event['event'] in TERMINAL_EVENTS:
+                return
+        if batch:
+            last_write = time.monotonic()
+            delay = EVENT_STREAM_POLL_INTERVAL
+        elif job is None or job['status'] in (JOB_DONE, JOB_FAILED):
+            # Finished before it kept an event log
+            return
+        else:
+            if time.monotonic() - last_write >= EVENT_STREAM_HEARTBEAT:
+                yield ": keep-alive\n\n"
+                last_write = time.monotonic()
+            delay = min(delay * 2, EVENT_STREAM_MAX_POLL_INTERVAL)
+        yield delay
+
+def stream_job_events(job_id, after=0):
+    """
+    Returns a text/event-stream response replaying the job's events after
+    event id `after`, then following new ones until the job finishes.
+    """
+    def events():
+        for step in job_event_steps(job_id, after):
+            if isinstance(step, str):
+                yield step
+            else:
+                time.sleep(step)
+    
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers=EVENT_STREAM_HEADERS)
+
+def query_generate_params(args):
+    # EventSource can only GET, so /generate-stream also takes the body's fields as query parameters
+    data = args.to_dict()
+    for key in ('noCache', 'refreshCache', 'rank'):
+        if key in data:
+            data[key] = data[key].lower() in ('1', 'true', 'yes')
+    return data
+
+@app.route('/generate-stream', methods=['GET', 'POST'])
+def generate_stream():
+    try:
+        # A reconnecting EventSource repeats the request with Last-Event-ID:
+        # resume that job instead of starting another
+        job_id, after = parse_event_id(request.headers.get('Last-Event-ID'))
+        if job_id and job_queue.store.get(job_id) is not None:
+            return stream_job_events(job_id, after)
+        
+        if not generator:
+            return jsonify({'error': 'API key not configured'}), 500
+        
+        data = request.get_json(silent=True) if request.method == 'POST' else query_generate_params(request.args)
+        try:
+            options = parse_generate_request(data or {})
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        return stream_job_events(job_queue.submit(job_params(options)))
+        
+    except Exception as e:
+        logger.exception("Error starting generation stream: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def get_job_events(job_id):
+    try:
+        if job_queue.store.get(job_id) is None:
+            return jsonify({'error': f'Job not found: {job_id}', 'success': False}), 404
+        
+        last_job, after = parse_event_id(request.headers.get('Last-Event-ID'))
+        if last_job != job_id:
+            after = request.args.get('after', 0, type=int)
+        return stream_job_events(job_id, after)
+        
+    except Exception as e:
+        logger.exception("Error streaming events for job %s: %s", job_id, e)
+        return jsonify({'error': str(e)}), 500
+
+class SaveError(Exception):
+    """
+    Raised when a design's bytes or index row could not be stored.
+    """
+
+def save_design(source_path, user_id, design_type, prompt, original_filename):
+    """
+    Saves the image at `source_path` as a new permanent design of
+    `user_id` and returns its description for the client.
+    """
+    saved = True  # Always set to True when explicitly saving
+    saved_filename = f"saved_{user_id}_{str(uuid.uuid4())[:8]}_{original_filename}"
+    
+    # Reuse the blob of one of this user's saved images with identical
+    # pixels when there is one; otherwise store the bytes under their
+    # content hash. Either way the save is a reference, not a copy. The
+    # dHash only finds candidates: it cannot tell apart banners that
+    # differ in their text, so every candidate is compared pixel by pixel.
+    source_name = os.path.basename(source_path)
+    image_hash = hash_index.get(KIND_TEMP, source_name)
+    if image_hash is None:
+        image_hash = dhash_file(source_path)
+    duplicate = None
+    candidates = hash_index.search(KIND_SAVED, image_hash, DEDUP_THRESHOLD)
+    rows = design_index.get_many([name for name, _ in candidates])
+    for name, _ in candidates:
+        candidate = rows.get(name)
+        if (candidate is not None and candidate['user_id'] == user_id and candidate['blob']
+                and same_pixels(source_path, blob_store.path(candidate['blob']))):
+            duplicate = candidate
+            break
+    
+    try:
+        with timed("save_copy"):
+            if duplicate is not None and duplicate['blob']:
+                blob = duplicate['blob']
+                blob_store.add_ref(blob)
+                logger.info(f"Image {source_name} duplicates {duplicate['id']}, reused blob {blob}")
+            else:
+                blob = blob_store.put_file(source_path)
+                logger.info(f"Image {source_name} saved as blob {blob}")
+        with timed("upload"):
+            storage.publish(blob_key(blob), blob_store.path(blob))
+    except Exception as store_error:
+        logger.exception(f"Error storing image: {store_error}")
+        raise SaveError(f'Failed to store file: {str(store_error)}') from store_error
+    
+    # Record the design in the metadata index
+    created_at = datetime.now().isoformat()
+    try:
+        design_index.add(
+            design_id=saved_filename,
+            user_id=user_id,
+            design_type=design_type,
+            prompt=prompt,
+            original_filename=original_filename,
+            created_at=created_at,
+            saved=saved,
+            blob=blob
+        )
+        logger.info(f"Metadata indexed for {saved_filename}")
+    except Exception as meta_error:
+        # Without an index row the design would never be listed, so drop the reference
+        logger.exception(f"Error writing metadata: {meta_error}")
+        key = blob_key(blob)
+        if blob_store.release(blob):
+            storage.delete(key)
+        raise SaveError(f'Failed to record design: {str(meta_error)}') from meta_error
+    
+    hash_index.add(KIND_SAVED, saved_filename, image_hash)
+    
+    # Build thumbnails, modern encodings and the colour palette off the request path
+    derivative_store.schedule(saved_filename)
+    color_index.schedule(saved_filename, user_id, blob_store.path(blob))
+    
+    # Return the new permanent URL and design information; clients store
+    # it, so it must not be a presigned URL that expires
+    saved_url = storage.stable_url(blob_key(blob), f"/saved-images/{saved_filename}")
+    logger.info(f"Save successful, returning URL: {saved_url}")
+    return {
+        'id': saved_filename,
+        'type': design_type,
+        'prompt': prompt,
+        'imageUrl': saved_url,
+        'createdAt': created_at,
+        'saved': saved  # Always True
+    }
+
 # Add new endpoint to save images permanently
 # Modify the save-image endpoint to include more design-related information
 # Add new endpoint to save images permanently
@@ -123,26 +884,14 @@ def save_image():
         prompt = data.get('prompt', '')
         user_id = data.get('userId', 'anonymous')
         design_type = data.get('type', 'banner')
-        saved = True  # Always set to True when explicitly saving
         
         if not filename:
             logger.error("No filename provided in save request")
             return jsonify({'error': 'No filename provided', 'success': False}), 400
         
-        # Generate a unique filename for the saved image
-        unique_id = str(uuid.uuid4())[:8]
-        saved_filename = f"saved_{user_id}_{unique_id}_{filename}"
-        
-        # Source and destination paths
-        source_path = os.path.join(TEMP_IMAGES_DIR, filename)
-        dest_path = os.path.join(SAVED_IMAGES_DIR, saved_filename)
+        source_path = temp_images.resolve(filename) or os.path.join(TEMP_IMAGES_DIR, filename)
         
-        logger.info(f"Attempting to save image from {source_path} to {dest_path}")
-        logger.info(f"TEMP_IMAGES_DIR: {TEMP_IMAGES_DIR}")
-        logger.info(f"SAVED_IMAGES_DIR: {SAVED_IMAGES_DIR}")
-        
-        # Debug: List all files in the temp directory
-        logger.info(f"Files in temp directory: {os.listdir(TEMP_IMAGES_DIR)}")
+        logger.info(f"Attempting to save image from {source_path}")
         
         # Check if source file exists
         if not os.path.exists(source_path):
@@ -150,16 +899,16 @@ def save_image():
             
             # Try to find the file without directory structure
             logger.info(f"Trying alternative path with basename: {os.path.basename(filename)}")
-            alternative_path = os.path.join(TEMP_IMAGES_DIR, os.path.basename(filename))
+            alternative_path = temp_images.resolve(os.path.basename(filename))
             
-            if os.path.exists(alternative_path):
+            if alternative_path:
                 source_path = alternative_path
                 logger.info(f"Found image at alternative path: {source_path}")
             else:
-                # Try to find a similar filename
+                # Try to find a similar filename among files not yet sharded
                 logger.info("Searching for similar filenames...")
                 for file in os.listdir(TEMP_IMAGES_DIR):
-                    if os.path.basename(filename) in file:
+                    if os.path.basename(filename) in file and os.path.isfile(os.path.join(TEMP_IMAGES_DIR, file)):
                         source_path = os.path.join(TEMP_IMAGES_DIR, file)
                         logger.info(f"Found similar filename: {source_path}")
                         break
@@ -168,104 +917,184 @@ def save_image():
                     logger.error(f"Could not find any matching file for {filename}")
                     return jsonify({'error': f'Source image not found: {filename}', 'success': False}), 404
         
-        # Copy the file to the saved images directory
-        try:
-            shutil.copy2(source_path, dest_path)
-            logger.info(f"Image saved permanently to {dest_path}")
-        except Exception as copy_error:
-            logger.exception(f"Error copying file: {copy_error}")
-            return jsonify({'error': f'Failed to copy file: {str(copy_error)}', 'success': False}), 500
-        
-        # Create metadata file with more design-related information
-        created_at = datetime.now().isoformat()
-        # Include the saved flag in the metadata
-        metadata_path = os.path.join(SAVED_IMAGES_DIR, f"{saved_filename}.meta")
         try:
-            with open(metadata_path, 'w') as f:
-                f.write(f"Prompt: {prompt}\n")
-                f.write(f"Type: {design_type}\n")
-                f.write(f"Original filename: {filename}\n")
-                f.write(f"User ID: {user_id}\n")
-                f.write(f"Saved: {saved}\n")  # Always True
-                f.write(f"Saved on: {created_at}\n")
-            logger.info(f"Metadata saved to {metadata_path}")
-        except Exception as meta_error:
-            logger.exception(f"Error writing metadata: {meta_error}")
-            # Continue even if metadata writing fails
-        
-        # Return the new permanent URL and design information
-        saved_url = f"http://localhost:5000/saved-images/{saved_filename}"
-        
-        logger.info(f"Save successful, returning URL: {saved_url}")
-        
-        # Debug: List all files in the saved directory after save
-        logger.info(f"Files in saved directory after save: {os.listdir(SAVED_IMAGES_DIR)}")
+            design = save_design(source_path, user_id, design_type, prompt, filename)
+        except SaveError as e:
+            return jsonify({'error': str(e), 'success': False}), 500
         
-        return jsonify({
-            'success': True,
-            'design': {
-                'id': saved_filename,
-                'type': design_type,
-                'prompt': prompt,
-                'imageUrl': saved_url,
-                'createdAt': created_at,
-                'saved': saved  # Always True
-            }
-        })
+        return jsonify({'success': True, 'design': design})
         
     except Exception as e:
         logger.exception(f"Error saving image: {e}")
         return jsonify({'error': str(e), 'success': False}), 500
 
-# Modify the user-designs endpoint to show all saved images
+@app.route('/designs/<design_id>', methods=['DELETE'])
+def delete_design(design_id):
+    try:
+        released = []
+        
+        def purge(conn, row):
+            # Hashes, palettes and blobs live in designs.db too, so they go
+            # in the same transaction as the design row
+            hash_index.remove(KIND_SAVED, [row['id']], conn)
+            color_index.remove(row['id'], conn)
+            if row['blob']:
+                key = blob_key(row['blob'])
+                if blob_store.release(row['blob'], conn):
+                    released.append(key)
+        
+        row = design_index.remove(design_id, purge)
+        if row is None:
+            return jsonify({'error': 'Design not found', 'success': False}), 404
+        
+        derivative_store.remove(design_id)
+        if not row['blob']:
+            # Saved before the blob store: the file itself is the design
+            legacy_path = saved_images.resolve(design_id)
+            for path in (legacy_path, legacy_path and f"{legacy_path}.meta"):
+                if path and os.path.exists(path):
+                    os.remove(path)
+        for key in released:
+            storage.delete(key)
+        
+        logger.info(f"Deleted design {design_id}")
+        return jsonify({'success': True, 'id': design_id})
+        
+    except Exception as e:
+        logger.exception(f"Error deleting design: {e}")
+        return jsonify({'error': str(e), 'success': False}), 500
+
+def design_to_dict(row):
+    return {
+        'id': row['id'],
+        'type': row['type'],
+        'prompt': row['prompt'],
+        'imageUrl': design_image_url(row),
+        'createdAt': row['created_at'],
+        'saved': bool(row['saved'])  # Always True
+    }
+
+def encode_designs_cursor(row):
+    raw = json.dumps([row['created_at'], row['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_designs_cursor(cursor):
+    created_at, design_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return created_at, design_id
+
+# List a user's saved designs, newest first, one page at a time
 @app.route('/user-designs/<user_id>', methods=['GET'])
 def get_user_designs(user_id):
     try:
-        designs = []
+        try:
+            limit = int(request.args.get('limit', DESIGNS_PAGE_SIZE))
+        except ValueError:
+            return jsonify({'error': 'limit must be an integer'}), 400
+        limit = max(1, min(limit, DESIGNS_MAX_PAGE_SIZE))
         
-        for filename in os.listdir(SAVED_IMAGES_DIR):
-            if filename.startswith(f"saved_{user_id}_") and not filename.endswith('.meta'):
-                # Default values
-                is_saved = True  # Default to True for all saved images
-                prompt = ""
-                design_type = "banner"
-                created_at = datetime.fromtimestamp(os.path.getctime(os.path.join(SAVED_IMAGES_DIR, filename))).isoformat()
-                
-                meta_file = os.path.join(SAVED_IMAGES_DIR, f"{filename}.meta")
-                if os.path.exists(meta_file):
-                    try:
-                        with open(meta_file, 'r') as f:
-                            content = f.read()
-                            # Parse metadata
-                            for line in content.split('\n'):
-                                if line.startswith("Prompt:"):
-                                    prompt = line.split("Prompt:")[1].strip()
-                                elif line.startswith("Type:"):
-                                    design_type = line.split("Type:")[1].strip()
-                    except Exception as e:
-                        logger.error(f"Error reading metadata for {filename}: {e}")
-                else:
-                    logger.warning(f"No metadata file found for {filename}")
-                
-                # Create the image URL
-                image_url = f"http://localhost:5000/saved-images/{filename}"
-                
-                design = {
-                    'id': filename,
-                    'type': design_type,
-                    'prompt': prompt,
-                    'imageUrl': image_url,
-                    'createdAt': created_at,
-                    'saved': is_saved  # Always True
-                }
-                
-                logger.info(f"Adding design: {design}")
+        cursor = request.args.get('cursor')
+        after = None
+        if cursor:
+            try:
+                after = decode_designs_cursor(cursor)
+            except Exception:
+                return jsonify({'error': 'Invalid cursor'}), 400
+        
+        # The ETag only depends on the user's revision counter and the page
+        # requested, so unchanged dashboards get a 304 without running the query
+        # The storage URL version changes before presigned URLs in the page expire.
+        revision = design_index.revision(user_id)
+        etag = hashlib.sha1(
+            f"{user_id}:{revision}:{storage.url_version()}:{cursor}:{limit}".encode('utf-8')
+        ).hexdigest()
+        if etag in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        
+        # Fetch one extra row to know whether another page exists
+        with timed("designs_scan"):
+            rows = design_index.page_for_user(user_id, limit + 1, after)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        
+        designs = [design_to_dict(row) for row in rows]
+        
+        logger.debug(f"Returning {len(designs)} designs for user {user_id}")
+        
+        response = jsonify({
+            'success': True,
+            'designs': designs,
+            'nextCursor': encode_designs_cursor(rows[-1]) if has_more else None
+        })
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+        
+    except Exception as e:
+        logger.exception(f"Error retrieving user designs: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/designs/by-color', methods=['GET'])
+def find_designs_by_color():
+    try:
+        try:
+            rgb = hex_to_rgb(request.args.get('color', ''))
+        except ValueError:
+            return jsonify({'error': 'color must be a hex value like #8B5CF6'}), 400
+        
+        limit = max(1, min(request.args.get('limit', 20, type=int), DESIGNS_MAX_PAGE_SIZE))
+        max_distance = request.args.get('maxDistance', type=float)
+        user_id = request.args.get('userId')
+        
+        matches = color_index.nearest(rgb, limit=limit, user_id=user_id, max_distance=max_distance)
+        rows = design_index.get_many([design_id for design_id, _ in matches])
+        
+        designs = []
+        for design_id, distance in matches:
+            if design_id in rows:
+                design = design_to_dict(rows[design_id])
+                design['colorDistance'] = round(distance, 2)
+                design['palette'] = color_index.palette(design_id)
                 designs.append(design)
         
-        # Sort by creation time, newest first
-        designs.sort(key=lambda x: x['createdAt'], reverse=True)
+        return jsonify({
+            'success': True,
+            'designs': designs
+        })
+        
+    except Exception as e:
+        logger.exception(f"Error searching designs by colour: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/similar-designs', methods=['GET'])
+def find_similar_designs():
+    try:
+        design_id = request.args.get('designId')
+        filename = request.args.get('filename')
+        limit = max(1, min(request.args.get('limit', 20, type=int), DESIGNS_MAX_PAGE_SIZE))
+        max_distance = max(0, min(request.args.get('maxDistance', SIMILAR_THRESHOLD, type=int),
+                                  MAX_SEARCH_DISTANCE))
+        
+        if design_id:
+            image_hash = hash_index.get(KIND_SAVED, design_id)
+        elif filename:
+            image_hash = hash_index.get(KIND_TEMP, filename)
+        else:
+            return jsonify({'error': 'designId or filename is required'}), 400
         
-        logger.info(f"Returning {len(designs)} designs for user {user_id}")
+        if image_hash is None:
+            return jsonify({'error': 'Image not found in the hash index', 'success': False}), 404
+        
+        matches = hash_index.search(KIND_SAVED, image_hash, max_distance, limit=limit, exclude=design_id)
+        rows = design_index.get_many([name for name, _ in matches])
+        
+        designs = []
+        for name, distance in matches:
+            if name in rows:
+                design = design_to_dict(rows[name])
+                design['hashDistance'] = distance
+                designs.append(design)
         
         return jsonify({
             'success': True,
@@ -273,20 +1102,186 @@ def get_user_designs(user_id):
         })
         
     except Exception as e:
-        logger.exception(f"Error retrieving user designs: {e}")
+        logger.exception(f"Error searching similar designs: {e}")
         return jsonify({'error': str(e)}), 500
 
+def resolve_source_image(data):
+    """
+    Maps a request's designId (saved image), filename (generated image) or
+    imageUrl pointing at this server or the storage backend to a path on
+    disk, or None.
+    """
+    design_id = data.get('designId')
+    filename = data.get('filename')
+    image_url = data.get('imageUrl') or ''
+    if not design_id and not filename and image_url:
+        name = image_url.split('?')[0].rstrip('/').split('/')[-1]
+        if '/saved-images/' in image_url:
+            design_id = name
+        elif '/images/' in image_url:
+            filename = name
+        elif '/blobs/' in image_url and os.path.basename(name) == name:
+            path = blob_store.path(name.split('.')[0])
+            return path if os.path.exists(path) else None
+    
+    name = design_id or filename
+    if not name or os.path.basename(name) != name:
+        return None
+    if design_id:
+        path = saved_image_path(design_id)
+    else:
+        path = temp_images.resolve(filename)
+    return path if path and os.path.exists(path) else None
+
+@app.route('/render-customization', methods=['POST'])
+def render_customization():
+    try:
+        data = request.json
+        if not isinstance(data, dict) or not all(
+                isinstance(data.get(k) or '', str)
+                for k in ('designId', 'filename', 'imageUrl', 'userId', 'prompt', 'type')):
+            return jsonify({'error': 'Invalid request body', 'success': False}), 400
+        source_path = resolve_source_image(data)
+        if not source_path:
+            return jsonify({'error': 'Source image not found', 'success': False}), 404
+        
+        filename, cached = customization_renderer.render(source_path, data.get('options', {}))
+        cache_lookups.inc(cache='customization', result='hit' if cached else 'miss')
+        
+        result = {
+            'success': True,
+            'imageUrl': storage.url(f"customized/{filename}", f"/customized/{filename}"),
+            'filename': filename,
+            'cached': cached
+        }
+        if data.get('save'):
+            # Renders are an evictable cache; a kept customization becomes a
+            # saved design of its own, and its URL is the one to store
+            try:
+                design = save_design(os.path.join(CUSTOMIZED_DIR, filename),
+                                     data.get('userId') or 'anonymous', data.get('type') or 'banner',
+                                     data.get('prompt') or '', filename)
+            except SaveError as e:
+                return jsonify({'error': str(e), 'success': False}), 500
+            result['design'] = design
+            result['imageUrl'] = design['imageUrl']
+        
+        return jsonify(result)
+        
+    except InvalidOptions as e:
+        return jsonify({'error': str(e), 'success': False}), 400
+    except Exception as e:
+        logger.exception(f"Error rendering customization: {e}")
+        return jsonify({'error': str(e), 'success': False}), 500
+
+def image_not_found(filename):
+    return jsonify({'error': f'Image not found: {filename}'}), 404
+
+def is_plain_filename(filename):
+    return '/' not in filename and safe_join('.', filename) is not None
+
+def send_from_layout(directory, filename):
+    """
+    Serves `filename` from a sharded directory, or returns None. A running
+    migration can move the flat file between resolving and opening it, so
+    resolve again.
+    """
+    for _ in range(2):
+        path = directory.resolve(filename)
+        if path is None:
+            return None
+        try:
+            return send_image(path)
+        except FileNotFoundError:
+            continue
+    return None
+
+# Generated files get unique names, so every image route serves immutable content
+@app.route('/images/<path:filename>', methods=['GET'])
+def serve_image(filename):
+    response = send_from_layout(temp_images, filename) if is_plain_filename(filename) else None
+    return response if response is not None else image_not_found(filename)
+
+@app.route('/saved-images/<path:filename>', methods=['GET'])
+def serve_saved_image(filename):
+    if not is_plain_filename(filename):
+        return image_not_found(filename)
+
+    # Deleted designs may still have derivatives on disk for a moment
+    row = design_index.get(filename)
+    if row is None:
+        return image_not_found(filename)
+
+    # Pick a derivative from ?w= and the Accept header when one fits
+    width = request.args.get('w', type=int)
+    variant = derivative_store.resolve(filename, width, request.accept_mimetypes)
+    # The derivative is still being built; the original stands in meanwhile
+    pending = variant is not None and variant[0] is None
+    if pending:
+        variant = None
+    if storage.remote and (variant or row['blob']):
+        # Published objects are downloaded from the storage backend
+        key = (DerivativeStore.key(filename, *variant[2:]) if variant
+               else blob_key(row['blob']))
+        response = redirect(storage.url(key, request.full_path))
+        response.headers['Cache-Control'] = 'private, no-cache'
+    elif variant:
+        response = send_image(variant[0], mimetype=variant[1])
+    else:
+        if row['blob']:
+            # The blob digest identifies the bytes exactly
+            response = send_image(blob_store.path(row['blob']), etag=row['blob'])
+        else:
+            response = send_from_layout(saved_images, filename)
+            if response is None:
+                return image_not_found(filename)
+        if pending:
+            response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept')
+    return response
+
+# Renders are content-addressed, so they can be cached forever
+@app.route('/customized/<filename>', methods=['GET'])
+def serve_customized_image(filename):
+    path = safe_join(CUSTOMIZED_DIR, filename)
+    if path is None or not os.path.isfile(path):
+        return image_not_found(filename)
+    return send_image(path)
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        'success': True,
+        'generationCache': generation_cache.stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), content_type=METRICS_CONTENT_TYPE)
+
 @app.route('/', methods=['GET'])
 def home():
     return jsonify({
         'status': 'online',
         'service': 'Moksha Image Generator API',
         'endpoints': {
-            '/generate': 'POST - Generate an image from a text prompt',
+            '/generate': 'POST - Generate an image from a text prompt (variants: up to N candidates, rank: order by sharpness/contrast)',
+            '/generate-formats': f"POST - One creative cropped to every ad size ({', '.join(AD_SIZES)} or WxH)",
             '/save-image': 'POST - Save a generated image permanently',
+            '/designs/<design_id>': 'DELETE - Delete a saved design',
             '/images/<filename>': 'GET - Retrieve a generated image',
-            '/saved-images/<filename>': 'GET - Retrieve a saved image',
-            '/list-saved-images/<user_id>': 'GET - List all saved images for a user'
+            '/saved-images/<filename>': 'GET - Retrieve a saved image (?w= and Accept pick a thumbnail/WebP/AVIF variant)',
+            '/list-saved-images/<user_id>': 'GET - List all saved images for a user',
+            '/cache-stats': 'GET - Generation cache hit/miss counters',
+            '/metrics': 'GET - Prometheus metrics: stage latencies, request counts, cache hit ratios',
+            '/designs/by-color': 'GET - Find saved designs nearest to ?color= (Lab delta E)',
+            '/similar-designs': 'GET - Saved designs perceptually similar to ?designId= or ?filename=',
+            '/render-customization': 'POST - Apply theme, palette and text customizations server-side',
+            '/generate-jobs': 'POST - Queue a generation and return a job id',
+            '/generate-batch': 'POST - Generate many prompts concurrently, streaming NDJSON results',
+            '/generate-stream': 'GET/POST - Queue a generation and stream its progress as Server-Sent Events (resumable via Last-Event-ID)',
+            '/jobs/<job_id>': 'GET - Poll the status and result of a generation job',
+            '/jobs/<job_id>/events': 'GET - Stream a generation job\'s progress events (queued ... saved, done/failed)'
         }
     })
 
@@ -299,24 +1294,4 @@ if __name__ == '__main__':
     logger.info(f"Temporary images will be stored in: {TEMP_IMAGES_DIR}")
     logger.info(f"Saved images will be stored in: {SAVED_IMAGES_DIR}")
     
-    # Serve static images directly
-    @app.route('/images/<path:filename>')
-    def serve_image(filename):
-        try:
-            logger.info(f"Serving image: {filename} from {TEMP_IMAGES_DIR}")
-            return send_from_directory(TEMP_IMAGES_DIR, filename)
-        except Exception as e:
-            logger.exception(f"Error serving image {filename}: {e}")
-            return jsonify({'error': str(e)}), 404
-    
-    # Add endpoint to serve saved images
-    @app.route('/saved-images/<path:filename>')
-    def serve_saved_image(filename):
-        try:
-            logger.info(f"Serving saved image: {filename} from {SAVED_IMAGES_DIR}")
-            return send_from_directory(SAVED_IMAGES_DIR, filename)
-        except Exception as e:
-            logger.exception(f"Error serving saved image: {e}")
-            return jsonify({'error': str(e)}), 404
-    
     app.run(debug=True, port=5000)
\ No newline at end of file
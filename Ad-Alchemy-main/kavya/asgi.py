@@ -0,0 +1,288 @@
+"""
+asgi.py
+
+ASGI entry point for running the service under uvicorn:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+POST /generate is served natively on the event loop. The Gemini call goes
+through the async genai client (client.aio), so a waiting generation holds
+a coroutine rather than a worker, and Pillow post-processing and file
+writes run on a bounded thread pool. The Server-Sent Event streams,
+/generate-stream and /jobs/<job_id>/events, are native too: a connected
+client costs a coroutine that sleeps between polls of the job store, not a
+thread. Every other route is the existing Flask app, mounted through
+WSGIMiddleware, so responses are unchanged.
+
+Identical in-flight generations within the process share one asyncio task.
+The cross-worker lock file coalescing of the Flask path is not used here;
+a single uvicorn process is meant to carry the concurrency.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MultiDict
+
+import app as service
+from postprocess import EncodeOptions, process as postprocess_image
+from upstream import UpstreamUnavailable
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# Configuration: Pillow thread pool size
+# ------------------------------------------------------------------------------
+PILLOW_WORKERS = int(os.getenv("ASGI_PILLOW_WORKERS", str(min(8, os.cpu_count() or 1))))
+
+pillow_pool = ThreadPoolExecutor(max_workers=PILLOW_WORKERS, thread_name_prefix="pillow")
+
+# flight key -> asyncio.Task producing the post-processed bytes
+_flights = {}
+
+
+def json_response(body: dict, status: int = 200, headers: dict = None) -> Response:
+    # Flask's JSON provider, so bodies match the WSGI routes byte for byte
+    return Response(service.app.json.dumps(body) + "\n", status_code=status,
+                    headers=headers, media_type="application/json")
+
+
+async def coalesce(key: str, factory) -> tuple:
+    """
+    Returns (result, shared), awaiting the running task for `key` when
+    there is one. Tasks are shielded so one client disconnecting does not
+    cancel a generation others are waiting for.
+    """
+    task = _flights.get(key)
+    if task is not None and task.get_loop() is asyncio.get_running_loop():
+        return await asyncio.shield(task), True
+    task = asyncio.ensure_future(factory())
+    _flights[key] = task
+    task.add_done_callback(lambda _: _flights.pop(key, None))
+    return await asyncio.shield(task), False
+
+
+async def generate_variants_async(prompt, variants, rank=False, encode_options=None):
+    """
+    Async counterpart of app.generate_variants: candidates are finished
+    concurrently on the Pillow pool.
+    """
+    loop = asyncio.get_running_loop()
+    enhanced_prompt = service.variants_prompt(service.BANNER_INSTRUCTIONS + prompt, variants)
+    images = await service.generator.agenerate_images_bytes(enhanced_prompt, variants)
+    bodies = await asyncio.gather(*(
+        loop.run_in_executor(pillow_pool, service.finish_variant,
+                             prompt, raw_bytes, encode_options, rank)
+        for raw_bytes, _ in images))
+    return service.collect_variants(prompt, list(bodies), rank)
+
+
+async def generate_banner_async(prompt, bypass_cache=False, refresh_cache=False, encode_options=None,
+                                variants=1, rank=False):
+    """
+    Async counterpart of app.generate_banner with the same result.
+    """
+    generator = service.generator
+    if not generator:
+        raise RuntimeError('API key not configured')
+    encode_options = encode_options or EncodeOptions()
+    if variants > 1:
+        return await generate_variants_async(prompt, variants, rank, encode_options)
+    loop = asyncio.get_running_loop()
+
+    enhanced_prompt = service.BANNER_INSTRUCTIONS + prompt
+    cache_key, flight_key = service.generation_keys(enhanced_prompt, encode_options)
+
+    image_bytes = None
+    if not bypass_cache and not refresh_cache:
+        image_bytes = await asyncio.to_thread(service.generation_cache.get, cache_key)
+    cached = image_bytes is not None
+
+    if not cached:
+        async def produce():
+            raw_bytes, _ = await generator.agenerate_image_bytes(enhanced_prompt)
+            image_bytes, _ = await loop.run_in_executor(
+                pillow_pool, postprocess_image, raw_bytes,
+                (service.BANNER_WIDTH, service.BANNER_HEIGHT), encode_options)
+            return image_bytes
+
+        image_bytes, shared = await coalesce(flight_key, produce)
+        service.cache_lookups.inc(cache='singleflight', result='hit' if shared else 'miss')
+
+        if shared:
+            logger.info(f"Joined an in-flight generation for key {flight_key}")
+        elif not bypass_cache:
+            await asyncio.to_thread(service.generation_cache.put, cache_key, image_bytes)
+    else:
+        logger.info(f"Generation cache hit for key {cache_key}")
+
+    return await loop.run_in_executor(pillow_pool, service.store_generated_image,
+                                      prompt, image_bytes, encode_options, cached)
+
+
+async def generate(request) -> Response:
+    try:
+        if not service.generator:
+            return json_response({'error': 'API key not configured'}, 500)
+
+        data = await request.json()
+        try:
+            options = service.parse_generate_request(data)
+        except ValueError as e:
+            return json_response({'error': str(e)}, 400)
+
+        return json_response(await generate_banner_async(**options))
+
+    except UpstreamUnavailable as e:
+        logger.warning("Generation refused: %s", e)
+        return json_response(
+            {'error': str(e), 'retryAfter': round(e.retry_after, 1)}, 503,
+            {'Retry-After': str(max(1, int(e.retry_after + 0.999)))})
+    except Exception as e:
+        logger.exception("Error: %s", e)
+        return json_response({'error': str(e)}, 500)
+
+
+async def job_event_stream(job_id: str, after: int = 0):
+    """
+    Async counterpart of app.stream_job_events: store reads run on a
+    worker thread and the waits between polls on the event loop.
+    """
+    steps = service.job_event_steps(job_id, after)
+    while True:
+        step = await asyncio.to_thread(next, steps, None)
+        if step is None:
+            return
+        if isinstance(step, str):
+            yield step
+        else:
+            await asyncio.sleep(step)
+
+
+def event_stream_response(job_id: str, after: int = 0) -> Response:
+    return StreamingResponse(job_event_stream(job_id, after), media_type='text/event-stream',
+                             headers=service.EVENT_STREAM_HEADERS)
+
+
+async def generate_stream(request) -> Response:
+    try:
+        # A reconnecting EventSource repeats the request with Last-Event-ID:
+        # resume that job instead of starting another
+        store = service.job_queue.store
+        job_id, after = service.parse_event_id(request.headers.get('Last-Event-ID'))
+        if job_id and await asyncio.to_thread(store.get, job_id) is not None:
+            return event_stream_response(job_id, after)
+
+        if not service.generator:
+            return json_response({'error': 'API key not configured'}, 500)
+
+        if request.method == 'POST':
+            try:
+                data = await request.json()
+            except ValueError:
+                data = None
+        else:
+            data = service.query_generate_params(MultiDict(request.query_params.multi_items()))
+        try:
+            options = service.parse_generate_request(data or {})
+        except ValueError as e:
+            return json_response({'error': str(e)}, 400)
+
+        job_id = await asyncio.to_thread(service.job_queue.submit, service.job_params(options))
+        return event_stream_response(job_id)
+
+    except Exception as e:
+        logger.exception("Error starting generation stream: %s", e)
+        return json_response({'error': str(e)}, 500)
+
+
+async def job_events(request) -> Response:
+    job_id = request.path_params['job_id']
+    try:
+        if await asyncio.to_thread(service.job_queue.store.get, job_id) is None:
+            return json_response({'error': f'Job not found: {job_id}', 'success': False}, 404)
+
+        last_job, after = service.parse_event_id(request.headers.get('Last-Event-ID'))
+        if last_job != job_id:
+            try:
+                after = int(request.query_params.get('after', 0))
+            except ValueError:
+                after = 0
+        return event_stream_response(job_id, after)
+
+    except Exception as e:
+        logger.exception("Error streaming events for job %s: %s", job_id, e)
+        return json_response({'error': str(e)}, 500)
+
+
+def with_metrics(route: str, handler):
+    """
+    Wraps a native endpoint so it records the same series as the Flask
+    request hooks, which do not see native routes. A stream counts as in
+    flight until its body has been sent, as it does under Flask.
+    """
+    async def endpoint(request) -> Response:
+        service.http_in_flight.inc(route=route)
+        start = time.perf_counter()
+
+        def finish():
+            service.http_in_flight.dec(route=route)
+            service.http_seconds.observe(time.perf_counter() - start, route=route)
+
+        try:
+            response = await handler(request)
+        except BaseException:
+            finish()
+            raise
+        service.http_requests.inc(route=route, method=request.method, status=response.status_code)
+        if isinstance(response, StreamingResponse):
+            body = response.body_iterator
+
+            async def tracked():
+                try:
+                    async for chunk in body:
+                        yield chunk
+                finally:
+                    finish()
+            response.body_iterator = tracked()
+        else:
+            finish()
+        return response
+    return endpoint
+
+
+def native_route(path: str, route: str, handler, methods: list) -> Route:
+    """
+    Returns a Route serving `handler` on the event loop, with the CORS
+    headers, OPTIONS answer and metrics the mounted Flask routes get.
+    """
+    allowed = {'OPTIONS', *methods} | ({'HEAD'} if 'GET' in methods else set())
+    measured = with_metrics(route, handler)
+
+    async def endpoint(request) -> Response:
+        if request.method == 'OPTIONS':
+            # Non-CORS OPTIONS, answered like Flask's automatic handler
+            return Response(status_code=200, headers={'Allow': ', '.join(sorted(allowed))})
+        return await measured(request)
+
+    # Flask-CORS covers the mounted routes; native ones need their own
+    return Route(path, endpoint, methods=[*methods, 'OPTIONS'],
+                 middleware=[Middleware(CORSMiddleware, allow_origins=['*'],
+                                        allow_methods=['*'], allow_headers=['*'])])
+
+
+app = Starlette(routes=[
+    native_route('/generate', '/generate', generate, ['POST']),
+    native_route('/generate-stream', '/generate-stream', generate_stream, ['GET', 'POST']),
+    native_route('/jobs/{job_id}/events', '/jobs/<job_id>/events', job_events, ['GET']),
+    Mount('/', app=WSGIMiddleware(service.app)),
+])
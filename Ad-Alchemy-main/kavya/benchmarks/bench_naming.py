@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+bench_naming.py
+
+Compares the per-image cost of the legacy scan-based naming
+(next_image_filename + write) against write_image_exclusive as the images
+directory grows. Run from the kavya/ directory:
+
+    python benchmarks/bench_naming.py --sizes 1000 10000 100000
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gemmi import next_image_filename, write_image_exclusive
+
+PAYLOAD = b"\x89PNG\r\n\x1a\n" + b"\0" * 1024
+
+
+def populate(directory: str, count: int):
+    for i in range(1, count + 1):
+        with open(os.path.join(directory, f"img{i}.png"), "wb"):
+            pass
+
+
+def time_legacy(directory: str, rounds: int) -> list:
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        filename = next_image_filename(directory=directory)
+        with open(os.path.join(directory, filename), "wb") as f:
+            f.write(PAYLOAD)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def time_exclusive(directory: str, rounds: int) -> list:
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        write_image_exclusive(PAYLOAD, directory=directory)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'files':>10} {'legacy ms':>12} {'exclusive ms':>14}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            populate(directory, size)
+            legacy = statistics.median(time_legacy(directory, args.rounds)) * 1000
+            exclusive = statistics.median(time_exclusive(directory, args.rounds)) * 1000
+        print(f"{size:>10} {legacy:>12.3f} {exclusive:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
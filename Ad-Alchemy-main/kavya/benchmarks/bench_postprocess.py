@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+bench_postprocess.py
+
+Compares the legacy post-processing in /generate (Image.open, LANCZOS
+resize, default PNG save) with postprocess.process() on a few typical
+Gemini outputs. Run from the kavya/ directory:
+
+    python benchmarks/bench_postprocess.py
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gemmi import BANNER_WIDTH, BANNER_HEIGHT
+from postprocess import EncodeOptions, process
+
+SIZE = (BANNER_WIDTH, BANNER_HEIGHT)
+
+
+def make_input(width: int, height: int, fmt: str) -> bytes:
+    # Smooth gradients plus noise: compresses roughly like real renders
+    y, x = np.mgrid[0:height, 0:width]
+    rgb = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    rgb = (rgb + np.random.default_rng(0).integers(0, 24, rgb.shape)).clip(0, 255).astype(np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(rgb, 'RGB').save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def legacy(data: bytes) -> bytes:
+    image = Image.open(BytesIO(data))
+    image = image.resize(SIZE, Image.LANCZOS)
+    buffer = BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def measure(fn, data: bytes, rounds: int) -> float:
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn(data)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    inputs = [
+        ("1200x628 PNG (exact)", make_input(*SIZE, 'PNG')),
+        ("1024x1024 PNG", make_input(1024, 1024, 'PNG')),
+        ("2400x1256 PNG", make_input(2400, 1256, 'PNG')),
+        ("2400x1256 JPEG", make_input(2400, 1256, 'JPEG')),
+    ]
+    variants = [
+        ("png (level 6)", EncodeOptions('png', 85, 6)),
+        ("png (level 1)", EncodeOptions('png', 85, 1)),
+        ("webp q80", EncodeOptions('webp', 80, 6)),
+    ]
+
+    print(f"{'input':<22} {'legacy ms':>10}  " + "  ".join(f"{name:>14}" for name, _ in variants))
+    for label, data in inputs:
+        row = f"{label:<22} {measure(legacy, data, args.rounds):>10.1f}  "
+        row += "  ".join(f"{measure(lambda d: process(d, SIZE, opts), data, args.rounds):>14.1f}"
+                         for _, opts in variants)
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
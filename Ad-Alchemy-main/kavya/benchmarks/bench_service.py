@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+bench_service.py
+
+Measures the service's own overhead on /generate, /save-image and
+/user-designs without calling Gemini. The genai client factory
+(gemmi.make_client) is replaced by a local fake that returns a generated
+image after a configurable delay, and requests go through Flask's test
+client, so the numbers are the pipeline's cost plus the fake latency.
+
+The app modules are copied into a scratch directory first, so the run never
+touches the real images/, saved_images/ or data/. SAVED_IMAGES_DIR and the
+design index are pre-populated to each requested scale before measuring.
+
+Run from the kavya/ directory:
+
+    python benchmarks/bench_service.py --output bench.json
+    python benchmarks/bench_service.py --scales 1000 --baseline bench.json
+
+With --baseline, p50/p99 that regress by more than --tolerance are listed
+and the exit status is 1.
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+KAVYA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SCALES = "1000,100000,1000000"
+POPULATED_USERS = 100
+BENCH_USER = "bench-user"
+
+
+class FakeGenaiClient:
+    """
+    Stands in for genai.Client: models.generate_content sleeps for
+    `latency` seconds and answers with one inline image part.
+    """
+
+    def __init__(self, image_bytes: bytes, mime_type: str, latency: float):
+        self.image_bytes = image_bytes
+        self.mime_type = mime_type
+        self.latency = latency
+        self.calls = 0
+        self.models = self
+
+    def generate_content(self, model=None, contents=None, config=None):
+        self.calls += 1
+        time.sleep(self.latency)
+        part = types.SimpleNamespace(
+            text=None,
+            inline_data=types.SimpleNamespace(data=self.image_bytes, mime_type=self.mime_type)
+        )
+        content = types.SimpleNamespace(parts=[part])
+        return types.SimpleNamespace(candidates=[types.SimpleNamespace(content=content)])
+
+
+def make_image(width: int, height: int, fmt: str) -> bytes:
+    # Gradients plus noise so encoders do realistic work
+    y, x = np.mgrid[0:height, 0:width]
+    rgb = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    rgb = (rgb + np.random.default_rng(0).integers(0, 24, rgb.shape)).clip(0, 255).astype(np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(rgb, 'RGB').save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def load_app(workdir: str, client: FakeGenaiClient):
+    """
+    Copies the service modules into `workdir` and imports app from there
+    with the fake client installed.
+    """
+    for path in glob.glob(os.path.join(KAVYA_DIR, "*.py")):
+        shutil.copy(path, workdir)
+    sys.path.insert(0, workdir)
+    os.environ.setdefault("GEMINI_API_KEY", "offline-benchmark")
+    # Keep the guard in the path but never let its quota pace the requests:
+    # its state lives in workdir's data/upstream.db, and the fake has no quota
+    os.environ["GEMINI_RATE_PER_MINUTE"] = "1000000000"
+    os.environ["GEMINI_BURST"] = "1000000"
+
+    import gemmi
+    gemmi.make_client = lambda api_key: client
+    import app
+    logging.getLogger().setLevel(logging.WARNING)
+    return app
+
+
+def populate(app, count: int, tiny_png: bytes):
+    """
+    Grows SAVED_IMAGES_DIR and the design index to `count` legacy designs,
+    spread over POPULATED_USERS users.
+    """
+    directory = app.SAVED_IMAGES_DIR
+    existing = sum(1 for name in os.listdir(directory) if name.startswith("saved_bench"))
+    if existing >= count:
+        return
+    start = datetime(2024, 1, 1)
+    rows = []
+    with sqlite3.connect(app.design_index.path) as conn:
+        for i in range(existing, count):
+            design_id = f"saved_bench{i % POPULATED_USERS}_{i:08x}_img{i}.png"
+            with open(os.path.join(directory, design_id), "wb") as f:
+                f.write(tiny_png)
+            rows.append((design_id, f"bench{i % POPULATED_USERS}", "banner", f"prompt {i}",
+                         f"img{i}.png", 1, (start + timedelta(seconds=i)).isoformat()))
+            if len(rows) >= 10000:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO designs"
+                    " (id, user_id, type, prompt, original_filename, saved, created_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                rows = []
+        conn.executemany(
+            "INSERT OR IGNORE INTO designs"
+            " (id, user_id, type, prompt, original_filename, saved, created_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def percentile(samples: list, q: float) -> float:
+    return float(np.percentile(samples, q)) if samples else 0.0
+
+
+def run(client, requests: list, concurrency: int) -> dict:
+    """
+    Issues `requests` (callables taking a test client and returning a
+    response) on `concurrency` threads and summarizes their latencies.
+    """
+    def timed_call(call):
+        start = time.perf_counter()
+        response = call(client)
+        return time.perf_counter() - start, response.status_code
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed_call, requests))
+    wall = time.perf_counter() - wall_start
+
+    latencies = [latency * 1000 for latency, status in results if status < 400]
+    return {
+        'requests': len(results),
+        'errors': sum(1 for _, status in results if status >= 400),
+        'throughput_rps': round(len(results) / wall, 2) if wall else 0.0,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+    }
+
+
+def bench_scale(app, args, scale: int) -> dict:
+    client = app.app.test_client()
+    n = args.requests
+
+    # Distinct prompts so every request goes upstream
+    tag = f"{scale}-{time.time_ns()}"
+    generated = []
+
+    def generate_call(i):
+        def call(c):
+            response = c.post('/generate', json={'prompt': f"benchmark {tag} {i}"})
+            if response.status_code == 200:
+                generated.append(response.get_json()['filename'])
+            return response
+        return call
+
+    results = {'generate': run(client, [generate_call(i) for i in range(n)], args.concurrency)}
+
+    save_calls = [
+        (lambda name: lambda c: c.post('/save-image', json={
+            'filename': name, 'userId': BENCH_USER, 'prompt': 'benchmark'}))(name)
+        for name in generated
+    ]
+    results['save_image'] = run(client, save_calls, args.concurrency)
+
+    # A populated user's first page, and a cold (no ETag) listing each time
+    users = [BENCH_USER] + [f"bench{i}" for i in range(min(POPULATED_USERS, 10))]
+    design_calls = [
+        (lambda user: lambda c: c.get(f'/user-designs/{user}'))(users[i % len(users)])
+        for i in range(n)
+    ]
+    results['user_designs'] = run(client, design_calls, args.concurrency)
+    return results
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Returns human-readable lines for every p50/p99 in `current` that is
+    more than `tolerance` slower than the same entry in `baseline`.
+    """
+    regressions = []
+    for scale, endpoints in current['results'].items():
+        for endpoint, stats in endpoints.items():
+            base = baseline.get('results', {}).get(scale, {}).get(endpoint)
+            if not base:
+                continue
+            for key in ('p50_ms', 'p99_ms'):
+                if base[key] and stats[key] > base[key] * (1 + tolerance):
+                    regressions.append(
+                        f"{endpoint} @ {scale}: {key} {base[key]:.2f} -> {stats[key]:.2f}"
+                        f" (+{(stats[key] / base[key] - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default=DEFAULT_SCALES,
+                        help="comma-separated SAVED_IMAGES_DIR sizes to measure at")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint per scale")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake Gemini latency in seconds")
+    parser.add_argument("--image-size", default="1024x1024", help="WxH of the fake Gemini image")
+    parser.add_argument("--image-format", default="PNG", choices=("PNG", "JPEG", "WEBP"))
+    parser.add_argument("--workdir", default=None, help="scratch directory (default: a new temp dir)")
+    parser.add_argument("--output", default=None, help="write results as JSON to this file")
+    parser.add_argument("--baseline", default=None, help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed p50/p99 slowdown against the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.image_size.lower().split("x"))
+    mime_type = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}[args.image_format]
+    fake = FakeGenaiClient(make_image(width, height, args.image_format), mime_type, args.latency)
+    tiny_png = make_image(8, 8, "PNG")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_service_")
+    os.makedirs(workdir, exist_ok=True)
+    app = load_app(workdir, fake)
+
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'latency_s': args.latency,
+            'image': f"{width}x{height} {args.image_format}",
+        },
+        'results': {},
+    }
+
+    print(f"{'scale':>9} {'endpoint':<14} {'rps':>9} {'p50 ms':>10} {'p99 ms':>10} {'errors':>7}")
+    for scale in sorted(int(s) for s in args.scales.split(",")):
+        populate(app, scale, tiny_png)
+        results = bench_scale(app, args, scale)
+        report['results'][str(scale)] = results
+        for endpoint, stats in results.items():
+            print(f"{scale:>9} {endpoint:<14} {stats['throughput_rps']:>9.1f}"
+                  f" {stats['p50_ms']:>10.2f} {stats['p99_ms']:>10.2f} {stats['errors']:>7}")
+    report['upstream_calls'] = fake.calls
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print("Regressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("No regressions against baseline.")
+
+
+if __name__ == "__main__":
+    main()
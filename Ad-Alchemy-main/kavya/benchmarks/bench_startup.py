@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+bench_startup.py
+
+Measures a worker's cold start: how long `import gemmi` and `import app`
+take in a fresh interpreter, and how long the first /generate request then
+takes (which pays for the lazy google.genai import and client creation).
+Gemini itself is replaced by the offline fake from bench_service.py with
+no latency, and each run gets its own scratch copy of the modules, so
+nothing touches the real images/ or data/.
+
+It also checks that importing gemmi has no side effects: no Flask app,
+no genai client and no google.genai import.
+
+Run from the kavya/ directory:
+
+    python benchmarks/bench_startup.py --output startup.json
+    python benchmarks/bench_startup.py --baseline startup.json
+    python benchmarks/bench_startup.py --budget-import 1.5 --budget-first-request 2.0
+
+The exit status is 1 when a side effect is found, a budget is exceeded, or
+a median regresses by more than --tolerance against the baseline.
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+KAVYA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+METRICS = ("import_gemmi_s", "import_app_s", "first_request_s", "total_s")
+
+
+def child(workdir: str):
+    """
+    Runs inside a fresh interpreter: imports the service from `workdir`,
+    serves one /generate and prints the timings as JSON.
+    """
+    start = time.perf_counter()
+    sys.path.insert(0, workdir)
+    os.environ.setdefault("GEMINI_API_KEY", "offline-benchmark")
+
+    import gemmi
+    imported_gemmi = time.perf_counter()
+    side_effects = []
+    if "google.genai" in sys.modules:
+        side_effects.append("google.genai imported")
+    if hasattr(gemmi, "app"):
+        side_effects.append("Flask app created")
+    if getattr(gemmi, "_clients", None):
+        side_effects.append("genai client created")
+
+    import app
+    imported_app = time.perf_counter()
+
+    # Imported after the timings above, so they do not pre-load anything
+    from bench_service import FakeGenaiClient, make_image
+    fake = FakeGenaiClient(make_image(1024, 1024, "PNG"), "image/png", 0.0)
+    gemmi.make_client = lambda api_key: fake
+
+    request_start = time.perf_counter()
+    response = app.app.test_client().post('/generate', json={'prompt': 'cold start'})
+    first_request = time.perf_counter() - request_start
+
+    print(json.dumps({
+        'import_gemmi_s': imported_gemmi - start,
+        'import_app_s': imported_app - imported_gemmi,
+        'first_request_s': first_request,
+        'total_s': time.perf_counter() - start,
+        'status': response.status_code,
+        'side_effects': side_effects,
+    }))
+
+
+def run_once() -> dict:
+    workdir = tempfile.mkdtemp(prefix="bench_startup_")
+    try:
+        for path in glob.glob(os.path.join(KAVYA_DIR, "*.py")):
+            shutil.copy(path, workdir)
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", workdir],
+            capture_output=True, text=True, check=True)
+        # The service logs to stdout; the result is the last line
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def check(report: dict, args, baseline: dict = None) -> list:
+    """
+    Returns human-readable lines for every side effect, budget overrun and
+    regression in `report`.
+    """
+    problems = [f"import gemmi side effect: {effect}" for effect in report['side_effects']]
+    if report['errors']:
+        problems.append(f"{report['errors']} first requests failed")
+    medians = report['median']
+    for key, budget in (('import_gemmi_s', args.budget_gemmi),
+                        ('import_app_s', args.budget_import),
+                        ('first_request_s', args.budget_first_request)):
+        if budget is not None and medians[key] > budget:
+            problems.append(f"{key}: {medians[key]:.3f}s over the {budget:.3f}s budget")
+    if baseline:
+        for key in METRICS:
+            base = baseline.get('median', {}).get(key)
+            if base and medians[key] > base * (1 + args.tolerance):
+                problems.append(f"{key}: {base:.3f}s -> {medians[key]:.3f}s"
+                                f" (+{(medians[key] / base - 1) * 100:.0f}%)")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters to measure")
+    parser.add_argument("--budget-gemmi", type=float, default=None, help="max median import gemmi seconds")
+    parser.add_argument("--budget-import", type=float, default=None, help="max median import app seconds")
+    parser.add_argument("--budget-first-request", type=float, default=None,
+                        help="max median first /generate seconds")
+    parser.add_argument("--output", default=None, help="write results as JSON to this file")
+    parser.add_argument("--baseline", default=None, help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed median slowdown against the baseline (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    runs = [run_once() for _ in range(args.runs)]
+    report = {
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'runs': runs,
+        'median': {key: statistics.median(run[key] for run in runs) for key in METRICS},
+        'errors': sum(1 for run in runs if run['status'] >= 400),
+        'side_effects': sorted({effect for run in runs for effect in run['side_effects']}),
+    }
+
+    for key in METRICS:
+        values = [run[key] for run in runs]
+        print(f"{key:<16} median {report['median'][key] * 1000:9.1f} ms"
+              f"   min {min(values) * 1000:9.1f} ms   max {max(values) * 1000:9.1f} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    problems = check(report, args, baseline)
+    if problems:
+        print("Cold start check failed:")
+        for line in problems:
+            print(f"  {line}")
+        sys.exit(1)
+    print("Cold start within budget.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+blobstore.py
+
+A content-addressed store for saved image bytes. A blob's path is derived
+from the SHA-256 of its content (blobs/ab/cd/abcd....png), so the same
+generation saved by several users is stored once. Saved designs reference
+blobs by digest, and a reference count in SQLite decides when a blob can
+be deleted.
+
+Blobs are brought in with a hardlink where possible, then a reflink
+(copy-on-write clone), and only then a byte copy, so a save is normally a
+metadata-only operation on the filesystem.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# Configuration: blob and database locations
+# ------------------------------------------------------------------------------
+BLOBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "blobs")
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+BLOBS_DB_PATH = os.path.join(DATA_DIR, "designs.db")
+
+# Linux FICLONE ioctl: clone a file's extents on btrfs/XFS
+_FICLONE = 0x40049409
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _reflink(source: str, dest: str) -> bool:
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(source, "rb") as src, open(dest, "xb") as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        return True
+    except OSError:
+        try:
+            os.remove(dest)
+        except FileNotFoundError:
+            pass
+        return False
+
+
+class BlobStore:
+    """
+    Stores files under their content hash with reference counts.
+    """
+
+    def __init__(self, root: str = BLOBS_DIR, db_path: str = BLOBS_DB_PATH):
+        self.root = root
+        self.db_path = db_path
+        os.makedirs(root, exist_ok=True)
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                " digest TEXT PRIMARY KEY,"
+                " ext TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " refcount INTEGER NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def path(self, digest: str, ext: str = None) -> str:
+        if ext is None:
+            with self._connect() as conn:
+                row = conn.execute("SELECT ext FROM blobs WHERE digest = ?", (digest,)).fetchone()
+            ext = row['ext'] if row else ""
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}{ext}")
+
+    def _materialize(self, source: str, dest: str) -> str:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            os.link(source, dest)
+            return "hardlink"
+        except FileExistsError:
+            return "existing"
+        except OSError:
+            pass
+        if _reflink(source, dest):
+            return "reflink"
+        tmp_path = f"{dest}.{os.getpid()}.tmp"
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, dest)
+        return "copy"
+
+    def put_file(self, source: str) -> str:
+        """
+        Adds a reference to the content of `source` and returns its digest.
+        """
+        digest = file_digest(source)
+        ext = os.path.splitext(source)[1].lower()
+        dest = self.path(digest, ext)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT ext FROM blobs WHERE digest = ?", (digest,)).fetchone()
+            if row is not None and os.path.exists(self.path(digest, row['ext'])):
+                conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE digest = ?", (digest,))
+                logger.info("Blob %s already stored, reference added", digest)
+                return digest
+
+            method = self._materialize(source, dest)
+            conn.execute(
+                "INSERT OR REPLACE INTO blobs (digest, ext, size, refcount)"
+                " VALUES (?, ?, ?, COALESCE((SELECT refcount FROM blobs WHERE digest = ?), 0) + 1)",
+                (digest, ext, os.path.getsize(dest), digest)
+            )
+        logger.info("Stored blob %s via %s", digest, method)
+        return digest
+
+    def add_ref(self, digest: str):
+        with self._connect() as conn:
+            conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE digest = ?", (digest,))
+
+    def release(self, digest: str, conn: sqlite3.Connection = None) -> bool:
+        """
+        Drops one reference to `digest`, deleting the blob when none remain.
+        Returns True when the blob was deleted. Given `conn`, runs inside
+        the caller's write transaction on the same database.
+        """
+        if conn is None:
+            with self._connect() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                return self.release(digest, conn)
+        row = conn.execute(
+            "SELECT ext, refcount FROM blobs WHERE digest = ?", (digest,)
+        ).fetchone()
+        if row is None:
+            return False
+        if row['refcount'] > 1:
+            conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE digest = ?", (digest,))
+            return False
+        conn.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+        # Still under the write lock, so a concurrent put_file cannot re-add it in between
+        try:
+            os.remove(self.path(digest, row['ext']))
+        except FileNotFoundError:
+            pass
+        logger.info("Deleted unreferenced blob %s", digest)
+        return True
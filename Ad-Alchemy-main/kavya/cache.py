@@ -0,0 +1,183 @@
+"""
+cache.py
+
+A content-addressed cache for generated banners. Entries are keyed on a
+hash of (model name, enhanced prompt, output size) and hold the final,
+already-resized PNG bytes, so a repeated prompt never reaches Gemini.
+
+Two tiers are used: a small in-memory LRU of recent hits, backed by a
+byte-capped directory on disk that evicts least-recently-used entries.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# Configuration: cache location and limits
+# ------------------------------------------------------------------------------
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+CACHE_MAX_BYTES = int(os.getenv("GENERATION_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+CACHE_MEMORY_ITEMS = int(os.getenv("GENERATION_CACHE_MEMORY_ITEMS", "64"))
+
+
+def make_cache_key(model_name: str, prompt: str, size: tuple, encoding: str = "png") -> str:
+    """
+    Returns the hex digest identifying a generation of `prompt` by
+    `model_name`, resized to `size` (width, height) and encoded as
+    `encoding`.
+    """
+    fields = [model_name, prompt, f"{size[0]}x{size[1]}"]
+    if encoding != "png":
+        # PNG keys predate the encoding field; keep them stable
+        fields.append(encoding)
+    digest = hashlib.sha256()
+    for field in fields:
+        encoded = field.encode("utf-8")
+        # Length-prefix each field so ("ab", "c") and ("a", "bc") differ
+        digest.update(len(encoded).to_bytes(8, "big"))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+class GenerationCache:
+    """
+    A two-tier (memory + disk) cache of encoded banner images.
+    """
+
+    def __init__(self, directory: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES,
+                 memory_items: int = CACHE_MEMORY_ITEMS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._disk_bytes = sum(size for _, size, _ in self._scan())
+        logger.info("Generation cache at %s (%s bytes on disk, cap %s)",
+                    directory, self._disk_bytes, max_bytes)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.png")
+
+    def _scan(self):
+        """
+        Yields (path, size, mtime) for every entry in the disk tier.
+        """
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".png"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield entry.path, stat.st_size, stat.st_mtime
+
+    def _remember(self, key: str, data: bytes):
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str):
+        """
+        Returns the cached bytes for `key`, or None on a miss.
+        """
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return data
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Bump mtime so disk eviction approximates LRU
+            os.utime(path, None)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self._remember(key, data)
+        return data
+
+    def put(self, key: str, data: bytes):
+        """
+        Stores `data` under `key` in both tiers, evicting old disk entries
+        if the byte cap is exceeded.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            replaced_bytes = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced_bytes = 0
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._remember(key, data)
+            self._disk_bytes += len(data) - replaced_bytes
+            over_cap = self._disk_bytes > self.max_bytes
+        if over_cap:
+            self._evict()
+
+    def _evict(self):
+        """
+        Removes least-recently-used disk entries until the tier is back
+        under 90% of the byte cap. Rescans the directory so entries written
+        by other worker processes are accounted for.
+        """
+        entries = sorted(self._scan(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._disk_bytes = total
+            self.evictions += evicted
+        logger.info("Evicted %s cache entries (%s bytes remain)", evicted, total)
+
+    def stats(self) -> dict:
+        """
+        Returns hit/miss counters and current tier sizes.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'memoryHits': self.memory_hits,
+                'misses': self.misses,
+                'hitRatio': (self.hits / lookups) if lookups else 0.0,
+                'evictions': self.evictions,
+                'memoryItems': len(self._memory),
+                'diskBytes': self._disk_bytes,
+                'maxBytes': self.max_bytes,
+            }
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+colors.py
+
+Dominant-colour extraction and a colour index over saved designs, so users
+can find banners "in our brand purple".
+
+Palettes are extracted with a vectorized histogram over a downscaled copy of
+the image (no per-pixel Python). Each palette colour is stored in CIE Lab
+together with a coarse grid cell id; queries only look at the cells around
+the target colour and rank candidates by Lab distance (CIE76 delta E).
+
+Run as a script to backfill palettes for every indexed design:
+
+    python colors.py --backfill
+"""
+
+import argparse
+import itertools
+import logging
+import os
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from designs import saved_design_user
+from layout import ShardedDirectory
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# Configuration: palette size, index grid and database
+# ------------------------------------------------------------------------------
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+COLORS_DB_PATH = os.path.join(DATA_DIR, "designs.db")
+SAVED_IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "saved_images")
+PALETTE_SIZE = 5
+SAMPLE_SIZE = 96        # images are downscaled to fit this box before counting
+QUANT_BITS = 4          # bits kept per RGB channel when histogramming
+MIN_WEIGHT = 0.03       # palette colours covering less of the image are dropped
+CELL_SIZE = 10.0        # Lab grid cell edge, in delta E units
+MAX_RING = 10           # furthest ring of cells searched before giving up
+
+# D65 reference white
+_WHITE = np.array([0.95047, 1.0, 1.08883])
+_RGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+
+
+def rgb_to_lab(rgb: np.ndarray) -> np.ndarray:
+    """
+    Converts an (..., 3) array of sRGB values in 0-255 to CIE Lab.
+    """
+    c = np.asarray(rgb, dtype=np.float64) / 255.0
+    linear = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = linear @ _RGB_TO_XYZ.T / _WHITE
+    f = np.where(xyz > 216 / 24389, np.cbrt(xyz), (24389 / 27 * xyz + 16) / 116)
+    return np.stack([
+        116 * f[..., 1] - 16,
+        500 * (f[..., 0] - f[..., 1]),
+        200 * (f[..., 1] - f[..., 2]),
+    ], axis=-1)
+
+
+def hex_to_rgb(color: str) -> tuple:
+    color = color.strip().lstrip('#')
+    if len(color) == 3:
+        color = ''.join(c * 2 for c in color)
+    if len(color) != 6:
+        raise ValueError(f"Invalid colour: {color}")
+    return tuple(int(color[i:i + 2], 16) for i in (0, 2, 4))
+
+
+def extract_palette(image: Image.Image, size: int = PALETTE_SIZE) -> list:
+    """
+    Returns up to `size` dominant colours of `image` as
+    [((r, g, b), weight), ...], most dominant first. Weights are the
+    fraction of sampled pixels each colour covers.
+    """
+    sample = image.convert('RGB')
+    sample.thumbnail((SAMPLE_SIZE, SAMPLE_SIZE), Image.BILINEAR, reducing_gap=2.0)
+    pixels = np.asarray(sample, dtype=np.uint32).reshape(-1, 3)
+
+    shift = 8 - QUANT_BITS
+    bins = ((pixels[:, 0] >> shift) << (2 * QUANT_BITS)) | \
+           ((pixels[:, 1] >> shift) << QUANT_BITS) | \
+           (pixels[:, 2] >> shift)
+    n_bins = 1 << (3 * QUANT_BITS)
+    counts = np.bincount(bins, minlength=n_bins)
+    # Mean of the real pixel values in each bin, not the bin centre
+    sums = np.stack([np.bincount(bins, weights=pixels[:, ch], minlength=n_bins)
+                     for ch in range(3)], axis=-1)
+
+    top = np.argsort(counts)[::-1][:size]
+    top = top[counts[top] > 0]
+    total = counts.sum()
+    palette = []
+    for b in top:
+        weight = counts[b] / total
+        if weight < MIN_WEIGHT and palette:
+            break
+        mean = sums[b] / counts[b]
+        palette.append((tuple(int(round(v)) for v in mean), float(weight)))
+    return palette
+
+
+def _cell(lab) -> tuple:
+    return tuple(int(np.floor(v / CELL_SIZE)) for v in lab)
+
+
+def _cell_id(cell: tuple) -> int:
+    # Offset keeps every component non-negative: L in [0, 100], a/b in about [-128, 128]
+    return ((cell[0] + 16) << 16) | ((cell[1] + 32) << 8) | (cell[2] + 32)
+
+
+def _palette_for_path(path: str) -> list:
+    with Image.open(path) as image:
+        image.draft('RGB', (SAMPLE_SIZE * 2, SAMPLE_SIZE * 2))
+        return extract_palette(image)
+
+
+class ColorIndex:
+    """
+    Stores design palettes in SQLite, bucketed by Lab grid cell.
+    """
+
+    def __init__(self, path: str = COLORS_DB_PATH, max_workers: int = 1):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="palette")
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS design_colors ("
+                " design_id TEXT NOT NULL,"
+                " user_id TEXT NOT NULL,"
+                " rank INTEGER NOT NULL,"
+                " weight REAL NOT NULL,"
+                " r INTEGER NOT NULL, g INTEGER NOT NULL, b INTEGER NOT NULL,"
+                " lab_l REAL NOT NULL, lab_a REAL NOT NULL, lab_b REAL NOT NULL,"
+                " cell INTEGER NOT NULL,"
+                " PRIMARY KEY (design_id, rank))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS design_colors_cell ON design_colors (cell)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS design_colors_user_cell"
+                " ON design_colors (user_id, cell)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def store(self, design_id: str, user_id: str, palette: list):
+        rows = []
+        for rank, (rgb, weight) in enumerate(palette):
+            lab = rgb_to_lab(np.array(rgb))
+            rows.append((design_id, user_id, rank, weight, *rgb, *lab.tolist(),
+                         _cell_id(_cell(lab))))
+        with self._connect() as conn:
+            conn.execute("DELETE FROM design_colors WHERE design_id = ?", (design_id,))
+            conn.executemany(
+                "INSERT INTO design_colors VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def index_image(self, design_id: str, user_id: str, path: str):
+        self.store(design_id, user_id, _palette_for_path(path))
+
+    def schedule(self, design_id: str, user_id: str, path: str):
+        """
+        Extracts and stores the palette of `path` in the background.
+        """
+        def run():
+            try:
+                self.index_image(design_id, user_id, path)
+            except Exception as e:
+                logger.exception("Failed to index colours of %s: %s", design_id, e)
+        self._executor.submit(run)
+
+    def remove(self, design_id: str, conn: sqlite3.Connection = None):
+        if conn is None:
+            with self._connect() as conn:
+                return self.remove(design_id, conn)
+        conn.execute("DELETE FROM design_colors WHERE design_id = ?", (design_id,))
+
+    def palette(self, design_id: str) -> list:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT r, g, b, weight FROM design_colors WHERE design_id = ? ORDER BY rank",
+                (design_id,)
+            ).fetchall()
+        return [{'color': '#%02X%02X%02X' % (row['r'], row['g'], row['b']),
+                 'weight': row['weight']} for row in rows]
+
+    def nearest(self, rgb: tuple, limit: int = 20, user_id: str = None,
+                max_distance: float = None) -> list:
+        """
+        Returns [(design_id, distance), ...] for the designs whose palette
+        holds a colour closest to `rgb`, nearest first.
+
+        Cells are visited in growing cubic rings around the target. Once
+        `limit` designs are found within the distance every unvisited cell
+        is guaranteed to exceed, the search stops.
+        """
+        target = rgb_to_lab(np.array(rgb))
+        centre = _cell(target)
+        best = {}
+        with self._connect() as conn:
+            for ring in range(MAX_RING + 1):
+                cells = [
+                    _cell_id((centre[0] + dl, centre[1] + da, centre[2] + db))
+                    for dl, da, db in itertools.product(range(-ring, ring + 1), repeat=3)
+                    if max(abs(dl), abs(da), abs(db)) == ring
+                ]
+                rows = []
+                # Outer rings hold thousands of cells; stay under SQLite's variable limit
+                for start in range(0, len(cells), 500):
+                    chunk = cells[start:start + 500]
+                    query = ("SELECT design_id, lab_l, lab_a, lab_b FROM design_colors"
+                             f" WHERE cell IN ({','.join('?' * len(chunk))})")
+                    params = list(chunk)
+                    if user_id is not None:
+                        query += " AND user_id = ?"
+                        params.append(user_id)
+                    rows.extend(conn.execute(query, params).fetchall())
+
+                if rows:
+                    labs = np.array([[r['lab_l'], r['lab_a'], r['lab_b']] for r in rows])
+                    distances = np.linalg.norm(labs - target, axis=1)
+                    for row, distance in zip(rows, distances):
+                        if distance < best.get(row['design_id'], float('inf')):
+                            best[row['design_id']] = float(distance)
+
+                # Anything outside this ring is at least `ring * CELL_SIZE` away
+                settled = ring * CELL_SIZE
+                if max_distance is not None and settled > max_distance:
+                    break
+                if sum(1 for d in best.values() if d <= settled) >= limit:
+                    break
+
+        ranked = sorted(best.items(), key=lambda item: item[1])
+        if max_distance is not None:
+            ranked = [item for item in ranked if item[1] <= max_distance]
+        return ranked[:limit]
+
+    def indexed_ids(self) -> set:
+        with self._connect() as conn:
+            return {row['design_id'] for row in
+                    conn.execute("SELECT DISTINCT design_id FROM design_colors")}
+
+    def backfill(self, designs: list, directory: str = SAVED_IMAGES_DIR,
+                 processes: int = None, blob_store=None) -> int:
+        """
+        Extracts palettes for [(design_id, user_id, blob), ...] that are not
+        yet indexed, decoding images on a process pool. Designs with a blob
+        digest are read from `blob_store`, older ones from `directory`.
+        Returns the number of designs indexed.
+        """
+        done = self.indexed_ids()
+        legacy = ShardedDirectory(directory, group_of=saved_design_user)
+        pending, paths = [], []
+        for design_id, user_id, blob in designs:
+            if design_id in done:
+                continue
+            if blob and blob_store is not None:
+                path = blob_store.path(blob)
+            else:
+                path = legacy.resolve(design_id)
+            if path is not None and os.path.exists(path):
+                pending.append((design_id, user_id))
+                paths.append(path)
+
+        count = 0
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for (design_id, user_id), palette in zip(
+                    pending, pool.map(_palette_for_path, paths, chunksize=16)):
+                self.store(design_id, user_id, palette)
+                count += 1
+                if count % 1000 == 0:
+                    logger.info("Indexed colours of %s/%s designs", count, len(pending))
+        logger.info("Indexed colours of %s designs", count)
+        return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    parser = argparse.ArgumentParser(description="Manage the design colour index.")
+    parser.add_argument("--backfill", action="store_true",
+                        help="extract palettes for every indexed design that has none")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.backfill:
+        from blobstore import BlobStore
+        from designs import DesignIndex
+        ColorIndex().backfill(DesignIndex().all_ids(), processes=args.processes,
+                              blob_store=BlobStore())
+    else:
+        parser.print_help()
@@ -0,0 +1,336 @@
+"""
+customize.py
+
+Server-side renderer for the dashboard's banner customization. It mirrors
+the canvas path in Dashboard.jsx: CSS-style theme filters and a hue rotate
+picked from the primary palette colour, a low-alpha 'color' blend overlay,
+and a rotated/scaled text label. Pixel work is done with NumPy on the whole
+image at once.
+
+Fonts and rendered text sprites are cached in memory, and finished renders
+are cached on disk under a key derived from the source image and the
+option set, so re-applying the same customization is a file lookup.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# Configuration: output location, size cap and encoder
+# ------------------------------------------------------------------------------
+CUSTOMIZED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "customized")
+MAX_DIMENSION = 1200
+JPEG_QUALITY = 85
+
+# Same theme filters as Dashboard.jsx, as (filter, amount) steps
+THEME_FILTERS = {
+    'modern': [('contrast', 1.2), ('saturate', 1.2), ('brightness', 1.1)],
+    'retro': [('sepia', 0.5), ('contrast', 1.1), ('brightness', 0.9)],
+}
+
+# Hue rotation (degrees) keyed on the palette's primary colour
+PALETTE_HUE_ROTATION = {
+    '#8B5CF6': 240,
+    '#3B82F6': 180,
+    '#F59E0B': 30,
+    '#6366F1': 200,
+}
+
+# Alpha of the '<colour>20' overlay the canvas path paints
+OVERLAY_ALPHA = 0x20 / 255
+
+FONT_FILES = {
+    'sans-serif': ['DejaVuSans.ttf', 'Arial.ttf', 'LiberationSans-Regular.ttf'],
+    'serif': ['DejaVuSerif.ttf', 'Times New Roman.ttf', 'LiberationSerif-Regular.ttf'],
+    'monospace': ['DejaVuSansMono.ttf', 'Courier New.ttf', 'LiberationMono-Regular.ttf'],
+}
+
+FONT_SIZE_FACTORS = {'small': 0.8, 'medium': 1.0, 'large': 1.2}
+
+# Bounds on client-supplied numbers; the dashboard keeps position in 0-100
+# (percent of the image) and scale in 0.5-2
+MIN_SCALE = 0.1
+MAX_SCALE = 5.0
+MAX_TEXT_LENGTH = 500
+HEX_COLOR = re.compile(r'^#(?:[0-9a-fA-F]{3}|[0-9a-fA-F]{6})$')
+
+DEFAULT_OPTIONS = {
+    'colors': ['#8B5CF6', '#EC4899', '#FFFFFF'],
+    'font': 'sans-serif',
+    'theme': 'modern',
+    'text': '',
+    'size': 'medium',
+    'position': {'x': 50, 'y': 50},
+    'scale': 1,
+    'rotation': 0,
+}
+
+
+class InvalidOptions(ValueError):
+    """
+    Raised for a customization option set that cannot be rendered.
+    """
+
+
+def _number(value, field: str, low: float = None, high: float = None) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise InvalidOptions(f"{field} must be a number")
+    try:
+        number = float(value)
+    except ValueError:
+        raise InvalidOptions(f"{field} must be a number") from None
+    if not math.isfinite(number):
+        raise InvalidOptions(f"{field} must be a finite number")
+    if (low is not None and number < low) or (high is not None and number > high):
+        raise InvalidOptions(f"{field} must be between {low:g} and {high:g}")
+    return number
+
+
+def normalize_options(options: dict) -> dict:
+    """
+    Fills in defaults and keeps only the fields that affect rendering, so
+    equivalent option sets share a cache key. Raises InvalidOptions for
+    values of the wrong type or out of range.
+    """
+    if options is None:
+        options = {}
+    if not isinstance(options, dict):
+        raise InvalidOptions("options must be an object")
+    merged = {**DEFAULT_OPTIONS, **{k: v for k, v in options.items() if k in DEFAULT_OPTIONS}}
+
+    colors = merged['colors']
+    if not isinstance(colors, list) or len(colors) > 3:
+        raise InvalidOptions("colors must be a list of up to 3 colours")
+    for color in colors:
+        if not isinstance(color, str) or not HEX_COLOR.match(color):
+            raise InvalidOptions(f"Invalid colour: {color!r}")
+    colors = colors + DEFAULT_OPTIONS['colors'][len(colors):]
+
+    for field in ('font', 'theme', 'text', 'size'):
+        if not isinstance(merged[field], str):
+            raise InvalidOptions(f"{field} must be a string")
+    if len(merged['text']) > MAX_TEXT_LENGTH:
+        raise InvalidOptions(f"text must be at most {MAX_TEXT_LENGTH} characters")
+
+    position = merged['position']
+    if not isinstance(position, dict):
+        raise InvalidOptions("position must be an object with x and y")
+
+    return {
+        'colors': [c.upper() for c in colors],
+        'font': merged['font'],
+        'theme': merged['theme'],
+        'text': merged['text'],
+        'size': merged['size'],
+        'position': {'x': _number(position.get('x', 50), 'position.x', 0, 100),
+                     'y': _number(position.get('y', 50), 'position.y', 0, 100)},
+        'scale': _number(merged['scale'], 'scale', MIN_SCALE, MAX_SCALE),
+        'rotation': _number(merged['rotation'], 'rotation'),
+    }
+
+
+def render_key(source_path: str, options: dict) -> str:
+    """
+    Returns the cache key for rendering `source_path` with normalized
+    `options`. The source's size and mtime stand in for its content.
+    """
+    stat = os.stat(source_path)
+    payload = json.dumps({
+        'source': os.path.basename(source_path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'options': options,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _hex_to_rgb(color: str) -> np.ndarray:
+    color = color.lstrip('#')
+    if len(color) == 3:
+        color = ''.join(c * 2 for c in color)
+    return np.array([int(color[i:i + 2], 16) for i in (0, 2, 4)], dtype=np.float32) / 255.0
+
+
+# ------------------------------------------------------------------------------
+# CSS filter effects (https://www.w3.org/TR/filter-effects-1/), on float RGB
+# ------------------------------------------------------------------------------
+def _saturate_matrix(s: float) -> np.ndarray:
+    return np.array([
+        [0.213 + 0.787 * s, 0.715 - 0.715 * s, 0.072 - 0.072 * s],
+        [0.213 - 0.213 * s, 0.715 + 0.285 * s, 0.072 - 0.072 * s],
+        [0.213 - 0.213 * s, 0.715 - 0.715 * s, 0.072 + 0.928 * s],
+    ], dtype=np.float32)
+
+
+def _sepia_matrix(amount: float) -> np.ndarray:
+    a = 1 - amount
+    return np.array([
+        [0.393 + 0.607 * a, 0.769 - 0.769 * a, 0.189 - 0.189 * a],
+        [0.349 - 0.349 * a, 0.686 + 0.314 * a, 0.168 - 0.168 * a],
+        [0.272 - 0.272 * a, 0.534 - 0.534 * a, 0.131 + 0.869 * a],
+    ], dtype=np.float32)
+
+
+def _hue_rotate_matrix(degrees: float) -> np.ndarray:
+    c, s = math.cos(math.radians(degrees)), math.sin(math.radians(degrees))
+    return np.array([
+        [0.213 + c * 0.787 - s * 0.213, 0.715 - c * 0.715 - s * 0.715, 0.072 - c * 0.072 + s * 0.928],
+        [0.213 - c * 0.213 + s * 0.143, 0.715 + c * 0.285 + s * 0.140, 0.072 - c * 0.072 - s * 0.283],
+        [0.213 - c * 0.213 - s * 0.787, 0.715 - c * 0.715 + s * 0.715, 0.072 + c * 0.928 + s * 0.072],
+    ], dtype=np.float32)
+
+
+def apply_filters(rgb: np.ndarray, theme: str, primary_color: str) -> np.ndarray:
+    """
+    Applies the theme's filter chain followed by the palette hue rotation,
+    clamping after each step as browsers do.
+    """
+    for name, amount in THEME_FILTERS.get(theme, []):
+        if name == 'contrast':
+            rgb = (rgb - 0.5) * amount + 0.5
+        elif name == 'brightness':
+            rgb = rgb * amount
+        elif name == 'saturate':
+            rgb = rgb @ _saturate_matrix(amount).T
+        elif name == 'sepia':
+            rgb = rgb @ _sepia_matrix(amount).T
+        np.clip(rgb, 0.0, 1.0, out=rgb)
+
+    degrees = PALETTE_HUE_ROTATION.get(primary_color)
+    if degrees is not None:
+        rgb = rgb @ _hue_rotate_matrix(degrees).T
+        np.clip(rgb, 0.0, 1.0, out=rgb)
+    return rgb
+
+
+# ------------------------------------------------------------------------------
+# 'color' blend mode (https://www.w3.org/TR/compositing-1/#blendingcolor)
+# ------------------------------------------------------------------------------
+def _lum(rgb: np.ndarray) -> np.ndarray:
+    return rgb @ np.array([0.3, 0.59, 0.11], dtype=np.float32)
+
+
+def _clip_color(rgb: np.ndarray) -> np.ndarray:
+    lum = _lum(rgb)[..., None]
+    low = rgb.min(axis=-1, keepdims=True)
+    high = rgb.max(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rgb = np.where(low < 0, lum + (rgb - lum) * lum / (lum - low), rgb)
+        rgb = np.where(high > 1, lum + (rgb - lum) * (1 - lum) / (high - lum), rgb)
+    return np.nan_to_num(rgb, copy=False)
+
+
+def blend_color_overlay(rgb: np.ndarray, color: str, alpha: float = OVERLAY_ALPHA) -> np.ndarray:
+    """
+    Composites a flat `color` over `rgb` with the 'color' blend mode: the
+    overlay's hue and saturation with the backdrop's luminosity.
+    """
+    source = _hex_to_rgb(color)
+    delta = (_lum(rgb) - _lum(source))[..., None]
+    blended = _clip_color(source + delta)
+    return rgb * (1 - alpha) + blended * alpha
+
+
+# ------------------------------------------------------------------------------
+# Text rendering with cached fonts and sprites
+# ------------------------------------------------------------------------------
+@lru_cache(maxsize=64)
+def load_font(family: str, size: int) -> ImageFont.ImageFont:
+    for filename in FONT_FILES.get(family, FONT_FILES['sans-serif']):
+        try:
+            return ImageFont.truetype(filename, size)
+        except OSError:
+            continue
+    logger.warning("No TrueType font found for %s, using Pillow's default", family)
+    return ImageFont.load_default(size=size)
+
+
+@lru_cache(maxsize=256)
+def render_text_sprite(text: str, family: str, size: int, color: str) -> Image.Image:
+    """
+    Returns `text` drawn on a tight transparent RGBA tile.
+    """
+    font = load_font(family, size)
+    left, top, right, bottom = font.getbbox(text)
+    sprite = Image.new('RGBA', (max(1, right - left), max(1, bottom - top)), (0, 0, 0, 0))
+    rgb = tuple(int(v * 255) for v in _hex_to_rgb(color))
+    ImageDraw.Draw(sprite).text((-left, -top), text, font=font, fill=rgb + (255,))
+    return sprite
+
+
+def draw_text(image: Image.Image, options: dict) -> Image.Image:
+    base_size = min(image.width, image.height) * 0.05
+    size = max(1, round(base_size * FONT_SIZE_FACTORS.get(options['size'], 1.0)))
+    sprite = render_text_sprite(options['text'], options['font'], size, options['colors'][2])
+
+    scale = options['scale']
+    if scale != 1:
+        sprite = sprite.resize((max(1, round(sprite.width * scale)),
+                                max(1, round(sprite.height * scale))), Image.LANCZOS)
+    if options['rotation']:
+        # Canvas rotates clockwise for positive angles; PIL counter-clockwise
+        sprite = sprite.rotate(-options['rotation'], resample=Image.BICUBIC, expand=True)
+
+    # Centre the sprite on the requested position, like textAlign/textBaseline 'middle'
+    x = options['position']['x'] / 100 * image.width - sprite.width / 2
+    y = options['position']['y'] / 100 * image.height - sprite.height / 2
+    image.paste(sprite, (round(x), round(y)), sprite)
+    return image
+
+
+class CustomizationRenderer:
+    """
+    Renders customizations to JPEG files in `output_dir`, reusing earlier
+    renders of the same source and options. `publish(filename, path)`, when
+    given, is called with each new render before it appears in `output_dir`.
+    """
+
+    def __init__(self, output_dir: str = CUSTOMIZED_DIR, publish=None):
+        self.output_dir = output_dir
+        self.publish = publish
+        os.makedirs(output_dir, exist_ok=True)
+
+    def render(self, source_path: str, options: dict) -> tuple:
+        """
+        Returns (filename, cached) for the rendered customization of
+        `source_path`.
+        """
+        options = normalize_options(options)
+        filename = f"{render_key(source_path, options)}.jpg"
+        path = os.path.join(self.output_dir, filename)
+        if os.path.exists(path):
+            return filename, True
+
+        with Image.open(source_path) as source:
+            source.draft('RGB', (MAX_DIMENSION, MAX_DIMENSION))
+            image = source.convert('RGB')
+        if max(image.size) > MAX_DIMENSION:
+            image.thumbnail((MAX_DIMENSION, MAX_DIMENSION), Image.LANCZOS, reducing_gap=3.0)
+
+        rgb = np.asarray(image, dtype=np.float32) / 255.0
+        rgb = apply_filters(rgb, options['theme'], options['colors'][0])
+        rgb = blend_color_overlay(rgb, options['colors'][0])
+        image = Image.fromarray(np.round(np.clip(rgb, 0, 1) * 255).astype(np.uint8), 'RGB')
+
+        if options['text']:
+            image = draw_text(image, options)
+
+        # Threads of one worker may render the same option set at once
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        image.save(tmp_path, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+        if self.publish is not None:
+            self.publish(filename, tmp_path)
+        os.replace(tmp_path, path)
+        logger.info("Rendered customization %s from %s", filename, source_path)
+        return filename, False
@@ -0,0 +1,200 @@
+"""
+derivatives.py
+
+Builds and caches smaller / better-compressed copies of saved banners so
+the dashboard grid does not download full-size PNGs. Each source image gets
+thumbnail and medium widths, encoded as PNG plus WebP (and AVIF when the
+installed Pillow can write it).
+
+Derivatives are built on a background pool right after a save, and
+queued on the same pool when a request asks for one that does not exist
+yet; that request, and any others until the build finishes, get the
+original instead.
+"""
+
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, features
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# Configuration: variant sizes, encoders and cache location
+# ------------------------------------------------------------------------------
+DERIVATIVES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "derivatives")
+VARIANT_WIDTHS = (320, 640)
+FULL_WIDTH = 0  # Marks a re-encode of the original at its own size
+WEBP_QUALITY = 80
+AVIF_QUALITY = 60
+DERIVATIVE_WORKERS = int(os.getenv("DERIVATIVE_WORKERS", "2"))
+LOCK_STRIPES = 64
+
+MIMETYPES = {
+    "avif": "image/avif",
+    "webp": "image/webp",
+    "png": "image/png",
+}
+
+
+def _avif_supported() -> bool:
+    try:
+        return bool(features.check("avif"))
+    except Exception:
+        return False
+
+
+AVIF_SUPPORTED = _avif_supported()
+
+
+class DerivativeStore:
+    """
+    Creates and looks up derivatives of images in `source_dir`.
+    `source_path`, when given, maps a filename to the path of its source
+    image instead (e.g. a blob in the content-addressed store).
+    `publish(filename, width, fmt, path)`, when given, is called with each
+    new derivative before it appears in the cache, so a cached derivative
+    has always been published too.
+    """
+
+    def __init__(self, source_dir: str, cache_dir: str = DERIVATIVES_DIR,
+                 max_workers: int = DERIVATIVE_WORKERS, source_path=None, publish=None):
+        self.source_dir = source_dir
+        self.source_path = source_path or (lambda filename: os.path.join(source_dir, filename))
+        self.publish = publish
+        self.cache_dir = cache_dir
+        self.formats = ("avif", "webp", "png") if AVIF_SUPPORTED else ("webp", "png")
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="derivatives")
+        # Builds and removals of one filename serialize on its stripe
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        # Filenames queued or being built, so misses do not queue duplicates
+        self._pending = set()
+        self._pending_guard = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, filename: str, width: int, fmt: str) -> str:
+        return os.path.join(self.cache_dir, filename, f"w{width}.{fmt}")
+
+    def _lock_for(self, filename: str) -> threading.Lock:
+        return self._locks[hash(filename) % LOCK_STRIPES]
+
+    def remove(self, filename: str):
+        """
+        Deletes every derivative of `filename`.
+        """
+        if os.path.basename(filename) != filename:
+            return
+        with self._lock_for(filename):
+            shutil.rmtree(os.path.join(self.cache_dir, filename), ignore_errors=True)
+
+    def schedule(self, filename: str):
+        """
+        Builds every derivative of `filename` in the background, unless a
+        build is already queued.
+        """
+        with self._pending_guard:
+            if filename in self._pending:
+                return
+            self._pending.add(filename)
+        self._executor.submit(self._build_logged, filename)
+
+    def _build_logged(self, filename: str):
+        try:
+            self.build(filename)
+        except Exception as e:
+            logger.exception("Failed to build derivatives for %s: %s", filename, e)
+        finally:
+            with self._pending_guard:
+                self._pending.discard(filename)
+
+    def build(self, filename: str):
+        """
+        Decodes `filename` once and writes every width/format combination
+        that is not already cached.
+        """
+        with self._lock_for(filename):
+            wanted = [(w, f) for w in VARIANT_WIDTHS for f in self.formats]
+            # Full-size PNG is the original itself
+            wanted += [(FULL_WIDTH, f) for f in self.formats if f != "png"]
+            missing = [(w, f) for w, f in wanted
+                       if not os.path.exists(self._path(filename, w, f))]
+            if not missing:
+                return
+
+            os.makedirs(os.path.join(self.cache_dir, filename), exist_ok=True)
+            with Image.open(self.source_path(filename)) as source:
+                source.load()
+                for width in sorted({w for w, _ in missing}):
+                    if width == FULL_WIDTH or width >= source.width:
+                        resized = source
+                    else:
+                        height = max(1, round(source.height * width / source.width))
+                        resized = source.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+                    if resized.mode not in ("RGB", "RGBA"):
+                        resized = resized.convert("RGBA")
+                    for fmt in [f for w, f in missing if w == width]:
+                        self._encode(resized, filename, width, fmt)
+            logger.info("Built %s derivatives for %s", len(missing), filename)
+
+    def _encode(self, image: Image.Image, filename: str, width: int, fmt: str):
+        path = self._path(filename, width, fmt)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        if fmt == "webp":
+            image.save(tmp_path, format="WEBP", quality=WEBP_QUALITY, method=4)
+        elif fmt == "avif":
+            image.save(tmp_path, format="AVIF", quality=AVIF_QUALITY)
+        else:
+            image.save(tmp_path, format="PNG", optimize=False, compress_level=6)
+        if self.publish is not None:
+            self.publish(filename, width, fmt, tmp_path)
+        os.replace(tmp_path, path)
+
+    def pick_format(self, accept) -> str:
+        """
+        Returns the best format the client accepts, given a werkzeug
+        MIMEAccept object. Only explicitly listed types count, since most
+        clients also send a blanket */*.
+        """
+        explicit = {value for value, quality in accept if quality > 0}
+        for fmt in self.formats:
+            if fmt == "png" or MIMETYPES[fmt] in explicit:
+                return fmt
+        return "png"
+
+    @staticmethod
+    def key(filename: str, width: int, fmt: str) -> str:
+        """
+        Returns the storage key of a derivative.
+        """
+        return f"derivatives/{filename}/w{width}.{fmt}"
+
+    def resolve(self, filename: str, width, accept):
+        """
+        Returns (path, mimetype, width, format) of the derivative that best serves a
+        request for `filename` at `width` pixels (None for full size), or
+        None when the original should be served. A missing derivative is
+        queued for a background build and (None, None, width, format) is
+        returned: serve the original for now, but not as a cacheable
+        substitute.
+        """
+        if os.path.basename(filename) != filename:
+            return None
+        fmt = self.pick_format(accept)
+        if width is None:
+            variant_width = FULL_WIDTH
+        else:
+            candidates = [w for w in VARIANT_WIDTHS if w >= width]
+            variant_width = min(candidates) if candidates else FULL_WIDTH
+        if variant_width == FULL_WIDTH and fmt == "png":
+            return None
+
+        path = self._path(filename, variant_width, fmt)
+        if not os.path.exists(path):
+            if not os.path.exists(self.source_path(filename)):
+                return None
+            self.schedule(filename)
+            return None, None, variant_width, fmt
+        return path, MIMETYPES[fmt], variant_width, fmt
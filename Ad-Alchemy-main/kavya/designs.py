@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+designs.py
+
+A SQLite index of saved designs. save_image records each design here and
+get_user_designs answers from an index on (user_id, created_at), so neither
+has to list SAVED_IMAGES_DIR or parse per-file .meta sidecars.
+
+Existing saved_images/ directories are backfilled from their .meta
+sidecars the first time the service starts against an index; the import
+runs under an flock, so with several gunicorn workers one imports while the
+others wait for it, and is recorded in the index so it runs only once. Run
+as a script to re-run it by hand (designs already indexed are kept):
+
+    python designs.py --import-meta
+"""
+
+import argparse
+import logging
+import os
+import re
+import sqlite3
+import sys
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+from layout import iter_files
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# Configuration: index location
+# ------------------------------------------------------------------------------
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+DESIGNS_DB_PATH = os.path.join(DATA_DIR, "designs.db")
+IMPORT_LOCK_PATH = os.path.join(DATA_DIR, "designs-import.lock")
+SAVED_IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "saved_images")
+
+# saved_{user_id}_{8 hex chars}_{original filename}
+_SAVED_NAME = re.compile(r"^saved_(.+?)_([0-9a-f]{8})_(.+)$")
+
+
+def saved_design_user(design_id: str):
+    """
+    Returns the user id encoded in a saved design's filename, or None.
+    """
+    match = _SAVED_NAME.match(design_id)
+    return match.group(1) if match else None
+
+
+class DesignIndex:
+    """
+    Stores saved-design metadata in SQLite. Each call opens its own
+    connection so the index is safe to share between threads and worker
+    processes.
+    """
+
+    def __init__(self, path: str = DESIGNS_DB_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS designs ("
+                " id TEXT PRIMARY KEY,"
+                " user_id TEXT NOT NULL,"
+                " type TEXT NOT NULL,"
+                " prompt TEXT NOT NULL,"
+                " original_filename TEXT,"
+                " saved INTEGER NOT NULL,"
+                " created_at TEXT NOT NULL,"
+                " blob TEXT)"
+            )
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(designs)")}
+            if 'blob' not in columns:
+                # Indexes created before the blob store point at saved_images/ files
+                conn.execute("ALTER TABLE designs ADD COLUMN blob TEXT")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS designs_user_created"
+                " ON designs (user_id, created_at, id)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS designs_without_blob"
+                " ON designs (created_at) WHERE blob IS NULL"
+            )
+            # Bumped on every write so readers can build cheap ETags
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_revisions ("
+                " user_id TEXT PRIMARY KEY,"
+                " revision INTEGER NOT NULL)"
+            )
+            # Directories whose .meta files have been imported
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS imports ("
+                " directory TEXT PRIMARY KEY,"
+                " imported_at TEXT NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def add(self, design_id: str, user_id: str, design_type: str, prompt: str,
+            original_filename: str, created_at: str, saved: bool = True,
+            replace: bool = True, blob: str = None):
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"{verb} INTO designs"
+                " (id, user_id, type, prompt, original_filename, saved, created_at, blob)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (design_id, user_id, design_type, prompt, original_filename,
+                 int(saved), created_at, blob)
+            )
+            if cursor.rowcount:
+                self._bump_revision(conn, user_id)
+
+    def get(self, design_id: str):
+        with self._connect() as conn:
+            return conn.execute("SELECT * FROM designs WHERE id = ?", (design_id,)).fetchone()
+
+    def remove(self, design_id: str, cleanup=None):
+        """
+        Deletes a design and returns its row, or None if it did not exist.
+        `cleanup(conn, row)` runs in the same write transaction, for rows
+        other stores keep about the design in this database.
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT * FROM designs WHERE id = ?", (design_id,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("DELETE FROM designs WHERE id = ?", (design_id,))
+            self._bump_revision(conn, row['user_id'])
+            if cleanup is not None:
+                cleanup(conn, row)
+        return row
+
+    @staticmethod
+    def _bump_revision(conn: sqlite3.Connection, user_id: str):
+        conn.execute(
+            "INSERT INTO user_revisions (user_id, revision) VALUES (?, 1)"
+            " ON CONFLICT (user_id) DO UPDATE SET revision = revision + 1",
+            (user_id,)
+        )
+
+    def revision(self, user_id: str) -> int:
+        """
+        Returns a counter that changes whenever the user's designs change.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT revision FROM user_revisions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return row['revision'] if row else 0
+
+    def page_for_user(self, user_id: str, limit: int, after: tuple = None) -> list:
+        """
+        Returns up to `limit` of the user's designs, newest first. `after` is
+        the (created_at, id) of the last row of the previous page.
+        """
+        with self._connect() as conn:
+            if after is None:
+                return conn.execute(
+                    "SELECT * FROM designs WHERE user_id = ?"
+                    " ORDER BY created_at DESC, id DESC LIMIT ?",
+                    (user_id, limit)
+                ).fetchall()
+            return conn.execute(
+                "SELECT * FROM designs WHERE user_id = ? AND (created_at, id) < (?, ?)"
+                " ORDER BY created_at DESC, id DESC LIMIT ?",
+                (user_id, after[0], after[1], limit)
+            ).fetchall()
+
+    def get_many(self, design_ids: list) -> dict:
+        """
+        Returns {design_id: row} for the given ids that exist.
+        """
+        if not design_ids:
+            return {}
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM designs WHERE id IN ({','.join('?' * len(design_ids))})",
+                list(design_ids)
+            ).fetchall()
+        return {row['id']: row for row in rows}
+
+    def all_ids(self) -> list:
+        """
+        Returns (design_id, user_id, blob) for every indexed design.
+        """
+        with self._connect() as conn:
+            return [(row['id'], row['user_id'], row['blob'])
+                    for row in conn.execute("SELECT id, user_id, blob FROM designs")]
+
+    def original_filenames(self, since: str) -> set:
+        """
+        Returns the temp image filenames that designs saved at or after
+        `since` (an ISO timestamp) without a blob were created from. Designs
+        with a blob hold their own copy and need nothing from images/.
+        """
+        with self._connect() as conn:
+            return {row['original_filename'] for row in conn.execute(
+                "SELECT original_filename FROM designs"
+                " WHERE blob IS NULL AND created_at >= ? AND original_filename IS NOT NULL",
+                (since,))}
+
+    def import_meta_files(self, directory: str = SAVED_IMAGES_DIR) -> int:
+        """
+        Backfills the index from saved images and their .meta sidecars.
+        Designs that are already indexed are left untouched, so the import
+        can be re-run safely. Returns the number of images scanned.
+        """
+        count = 0
+        for entry in iter_files(directory):
+            filename, path = entry.name, entry.path
+            if not filename.startswith("saved_") or filename.endswith(".meta"):
+                continue
+            match = _SAVED_NAME.match(filename)
+
+            fields = {}
+            meta_path = f"{path}.meta"
+            if os.path.exists(meta_path):
+                try:
+                    with open(meta_path, "r") as f:
+                        for line in f.read().split("\n"):
+                            key, sep, value = line.partition(":")
+                            if sep:
+                                fields[key.strip()] = value.strip()
+                except Exception as e:
+                    logger.error("Error reading metadata for %s: %s", filename, e)
+
+            user_id = fields.get("User ID") or (match.group(1) if match else "anonymous")
+            created_at = fields.get("Saved on") or \
+                datetime.fromtimestamp(os.path.getctime(path)).isoformat()
+            self.add(
+                design_id=filename,
+                user_id=user_id,
+                design_type=fields.get("Type", "banner"),
+                prompt=fields.get("Prompt", ""),
+                original_filename=fields.get("Original filename") or (match.group(3) if match else None),
+                created_at=created_at,
+                replace=False
+            )
+            count += 1
+        logger.info("Imported %s saved designs from %s", count, directory)
+        return count
+
+    def _imported(self, directory: str) -> bool:
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT 1 FROM imports WHERE directory = ?", (directory,)
+            ).fetchone() is not None
+
+    def import_once(self, directory: str = SAVED_IMAGES_DIR,
+                    lock_path: str = IMPORT_LOCK_PATH):
+        """
+        Runs import_meta_files for `directory` unless it has already been
+        imported into this index. Concurrent callers block until the
+        first one finishes. Returns the number of images scanned, or None
+        when there was nothing to do.
+        """
+        directory = os.path.realpath(directory)
+        if self._imported(directory):
+            return None
+        if fcntl is None:
+            return self._import_and_record(directory)
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                # Another worker may have finished while this one waited
+                if self._imported(directory):
+                    return None
+                return self._import_and_record(directory)
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _import_and_record(self, directory: str) -> int:
+        count = self.import_meta_files(directory)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO imports (directory, imported_at) VALUES (?, ?)",
+                (directory, datetime.now().isoformat())
+            )
+        return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    parser = argparse.ArgumentParser(description="Manage the saved-design index.")
+    parser.add_argument("--import-meta", action="store_true",
+                        help="backfill the index from saved_images/ and its .meta files")
+    parser.add_argument("--directory", default=SAVED_IMAGES_DIR)
+    args = parser.parse_args()
+
+    if args.import_meta:
+        DesignIndex().import_meta_files(args.directory)
+    else:
+        parser.print_help()
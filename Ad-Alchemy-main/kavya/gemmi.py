@@ -2,81 +2,301 @@
 """
 gemmi.py
 
-A script to generate images via Google's Gemini API, saving each
-output with a sequential filename (img1.png, img2.png, …), prompting
-for a multi-line input at runtime, and forcing every output to a
-fixed banner resolution. 
+Image generation via Google's Gemini API, and the naming helpers for the
+files it produces. Run as a script, it prompts for a multi-line input and
+saves one banner at the fixed banner resolution.
+
+Importing this module has no side effects: the google.genai package is
+imported, and its client created, on first use, once per process. Call
+warm_up() before forking workers to pay the import once.
 """
 
+import asyncio
 import logging
 import os
 import re
+import secrets
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from dotenv import load_dotenv
 from PIL import Image
-from google import genai
-from google.genai import types
-from flask import Flask, request, jsonify, send_file
-from flask_cors import CORS
+
+from metrics import timed
 
 # ------------------------------------------------------------------------------
 # Configuration: target banner size
 # ------------------------------------------------------------------------------
 BANNER_WIDTH = 1200
 BANNER_HEIGHT = 628
+MULTI_CANDIDATE = os.getenv("GEMINI_MULTI_CANDIDATE", "0") == "1"
+# Single-image calls sent at once when several images are wanted
+PARALLEL_REQUESTS = int(os.getenv("GEMINI_PARALLEL_REQUESTS", "4"))
 
 # ------------------------------------------------------------------------------
 # Logging Configuration
 # ------------------------------------------------------------------------------
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
 logger = logging.getLogger(__name__)
 
+# (pid, api key) -> genai.Client; keyed on pid so a forked worker never
+# reuses its parent's connections
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def warm_up():
+    """
+    Imports the google.genai modules ahead of time. Done in a gunicorn
+    master, the forked workers inherit them instead of importing each.
+    """
+    from google import genai  # noqa: F401
+    from google.genai import types  # noqa: F401
+    Image.init()
+
+
+def make_client(api_key: str):
+    from google import genai
+    return genai.Client(api_key=api_key)
+
+
+def get_client(api_key: str):
+    """
+    Returns this process's client for `api_key`, creating it on first use.
+    """
+    key = (os.getpid(), api_key)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = make_client(api_key)
+    return client
+
+
+def _generation_config(candidate_count: int = 1):
+    from google.genai import types
+    if candidate_count > 1:
+        return types.GenerateContentConfig(response_modalities=["Text", "Image"],
+                                           candidate_count=candidate_count)
+    return types.GenerateContentConfig(response_modalities=["Text", "Image"])
+
+
+def _gathered_images(outcomes: list) -> list:
+    """
+    Returns every image from a list of responses and exceptions, raising
+    the first exception when no call produced an image.
+    """
+    images = []
+    for outcome in outcomes:
+        if not isinstance(outcome, BaseException):
+            images.extend(image_parts(outcome))
+    errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+    if not images and errors:
+        raise errors[0]
+    if errors:
+        logger.warning("%s of %s parallel image requests failed: %s",
+                       len(errors), len(outcomes), errors[0])
+    return images
+
+
+def image_parts(response) -> list:
+    """
+    Returns (image bytes, mime type) for every inline image in every
+    candidate of a generate_content response.
+    """
+    images = []
+    for candidate in response.candidates or []:
+        parts = candidate.content.parts if candidate.content else None
+        for part in parts or []:
+            if part.inline_data is not None:
+                images.append((part.inline_data.data, part.inline_data.mime_type))
+    return images
+
 
 class GeminiImageGenerator:
     """
     A class to interact with the Gemini API for image generation.
     """
 
-    def __init__(self, api_key: str, model_name: str = "gemini-2.0-flash-exp-image-generation"):
+    def __init__(self, api_key: str, model_name: str = "gemini-2.0-flash-exp-image-generation",
+                 guard=None, multi_candidate: bool = MULTI_CANDIDATE):
+        self.api_key = api_key
+        self.model_name = model_name
+        # Optional upstream.UpstreamGuard: rate limit, retries, circuit breaker
+        self.guard = guard
+        # Ask for several candidates per call; not every image model accepts it
+        self.multi_candidate = multi_candidate
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        logger.info("Initialized GeminiImageGenerator with model: %s", model_name)
+
+    @property
+    def client(self):
+        return get_client(self.api_key)
+
+    def generate_image_bytes(self, prompt: str) -> tuple:
+        """
+        Sends the prompt to Gemini and returns (image bytes, mime type)
+        exactly as the API delivered them, without decoding.
+        """
+        return self.generate_images_bytes(prompt, 1)[0]
+
+    def _request(self, prompt: str, candidate_count: int = 1):
+        logger.info("Sending image generation request with prompt: %s", prompt)
+        def request():
+            with timed("generate_image"):
+                return self.client.models.generate_content(
+                    model=self.model_name,
+                    contents=prompt,
+                    config=_generation_config(candidate_count)
+                )
+
+        response = self.guard.call(request) if self.guard else request()
+        logger.info("Received response from Gemini API.")
+        return response
+
+    def _parallel(self) -> ThreadPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=PARALLEL_REQUESTS,
+                                                    thread_name_prefix="gemini")
+            return self._executor
+
+    def _requests_parallel(self, prompt: str, count: int) -> list:
+        """
+        Sends `count` single-image requests at once (each through the guard)
+        and returns their images; failed calls are skipped unless all fail.
+        """
+        futures = [self._parallel().submit(self._request, prompt, 1) for _ in range(count)]
+        outcomes = []
+        for future in futures:
+            try:
+                outcomes.append(future.result())
+            except Exception as e:
+                outcomes.append(e)
+        return _gathered_images(outcomes)
+
+    def generate_images_bytes(self, prompt: str, count: int) -> list:
+        """
+        Returns up to `count` (image bytes, mime type) pairs for the prompt.
+        With multi-candidate requests every image part of a response is kept
+        and further calls are made only while fewer than `count` images have
+        arrived; otherwise `count` single-image calls are sent concurrently.
+        """
         try:
-            self.client = genai.Client(api_key=api_key)
-            self.model_name = model_name
-            logger.info("Initialized GeminiImageGenerator with model: %s", model_name)
+            images = []
+            if not self.multi_candidate and count > 1:
+                images = self._requests_parallel(prompt, count)
+            else:
+                for _ in range(count):
+                    wanted = count - len(images)
+                    response = self._request(prompt, wanted if self.multi_candidate else 1)
+                    images.extend(image_parts(response))
+                    if len(images) >= count:
+                        break
+            if not images:
+                raise ValueError("No image data found in API response.")
+            return images[:count]
+
         except Exception as e:
-            logger.exception("Failed to initialize Gemini client: %s", e)
+            logger.exception("Error during image generation: %s", e)
             raise
 
-    def generate_image(self, prompt: str) -> Image.Image:
+    def stream_image_bytes(self, prompt: str, progress=None) -> tuple:
         """
-        Sends the prompt to Gemini and returns a PIL Image.
+        Variant of generate_image_bytes that reads the response with the
+        streaming API and reports "upstream_started" when the request goes
+        out and "first_bytes" when the first chunk arrives, through
+        `progress(event, data)`.
         """
+        logger.info("Sending streaming image generation request with prompt: %s", prompt)
+        report = progress or (lambda event, data=None: None)
+
+        def request():
+            images = []
+            started = time.perf_counter()
+            report("upstream_started", {'model': self.model_name})
+            with timed("generate_image"):
+                chunks = self.client.models.generate_content_stream(
+                    model=self.model_name,
+                    contents=prompt,
+                    config=_generation_config()
+                )
+                for chunk in chunks:
+                    if started is not None:
+                        report("first_bytes", {'elapsedMs': round((time.perf_counter() - started) * 1000)})
+                        started = None
+                    images.extend(image_parts(chunk))
+            return images
+
         try:
-            logger.info("Sending image generation request with prompt: %s", prompt)
-            response = self.client.models.generate_content(
-                model=self.model_name,
-                contents=prompt,
-                config=types.GenerateContentConfig(response_modalities=["Text", "Image"])
-            )
-            logger.info("Received response from Gemini API.")
-
-            for part in response.candidates[0].content.parts:
-                if part.inline_data is not None:
-                    img = Image.open(BytesIO(part.inline_data.data))
-                    logger.info("Image generated successfully (original size: %sx%s).",
-                                img.width, img.height)
-                    return img
-
-            raise ValueError("No image data found in API response.")
+            images = self.guard.call(request) if self.guard else request()
+            logger.info("Received streamed response from Gemini API.")
+            if not images:
+                raise ValueError("No image data found in API response.")
+            return images[0]
 
         except Exception as e:
             logger.exception("Error during image generation: %s", e)
             raise
 
+    async def agenerate_image_bytes(self, prompt: str) -> tuple:
+        """
+        Async variant of generate_image_bytes using the client's aio API, so
+        an event loop can wait on many generations at once.
+        """
+        return (await self.agenerate_images_bytes(prompt, 1))[0]
+
+    async def _arequest(self, prompt: str, candidate_count: int = 1):
+        logger.info("Sending async image generation request with prompt: %s", prompt)
+        async def request():
+            with timed("generate_image"):
+                return await self.client.aio.models.generate_content(
+                    model=self.model_name,
+                    contents=prompt,
+                    config=_generation_config(candidate_count)
+                )
+
+        response = await (self.guard.acall(request) if self.guard else request())
+        logger.info("Received response from Gemini API.")
+        return response
+
+    async def agenerate_images_bytes(self, prompt: str, count: int) -> list:
+        """
+        Async variant of generate_images_bytes.
+        """
+        try:
+            images = []
+            if not self.multi_candidate and count > 1:
+                outcomes = await asyncio.gather(
+                    *(self._arequest(prompt, 1) for _ in range(count)), return_exceptions=True)
+                images = _gathered_images(list(outcomes))
+            else:
+                for _ in range(count):
+                    wanted = count - len(images)
+                    response = await self._arequest(prompt, wanted if self.multi_candidate else 1)
+                    images.extend(image_parts(response))
+                    if len(images) >= count:
+                        break
+            if not images:
+                raise ValueError("No image data found in API response.")
+            return images[:count]
+
+        except Exception as e:
+            logger.exception("Error during image generation: %s", e)
+            raise
+
+    def generate_image(self, prompt: str) -> Image.Image:
+        """
+        Sends the prompt to Gemini and returns a PIL Image.
+        """
+        data, _ = self.generate_image_bytes(prompt)
+        img = Image.open(BytesIO(data))
+        logger.info("Image generated successfully (original size: %sx%s).",
+                    img.width, img.height)
+        return img
+
     def save_image(self, image: Image.Image, filename: str):
         """
         Saves the image into the 'images/' directory.
@@ -97,6 +317,9 @@ def next_image_filename(directory: str = None, prefix: str = "img", ext: str = "
     """
     Scans `directory` for existing files like 'img<number>.png' and returns
     the next filename in sequence.
+
+    Legacy naming: this is O(n) in the directory size and racy across
+    processes. New images are written with write_image_exclusive().
     """
     if directory is None:
         directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
@@ -115,84 +338,76 @@ def next_image_filename(directory: str = None, prefix: str = "img", ext: str = "
     return f"{prefix}{next_index}{ext}"
 
 
-# Create Flask app
-app = Flask(__name__)
-CORS(app)  # Enable CORS for all routes
+# Crockford base32, as used by ULIDs: sortable, case-insensitive, no I/L/O/U
+_ULID_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
 
-# Load API key
-load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "GEMINI_API_KEY.env"))
-API_KEY = os.getenv("GEMINI_API_KEY")
-if not API_KEY:
-    logger.error("GEMINI_API_KEY not found in GEMINI_API_KEY.env. Please add it and try again.")
 
-# Initialize the generator
-generator = None
-if API_KEY:
-    generator = GeminiImageGenerator(api_key=API_KEY)
+def new_image_filename(prefix: str = "img", ext: str = ".png") -> str:
+    """
+    Returns a fresh filename like 'img_01J9Z3...png' built from a ULID
+    (48-bit millisecond timestamp + 80 random bits). Names sort by creation
+    time and need no directory scan, so the cost is independent of how many
+    images already exist.
+    """
+    value = (int(time.time() * 1000) << 80) | secrets.randbits(80)
+    chars = []
+    for _ in range(26):
+        chars.append(_ULID_ALPHABET[value & 0x1F])
+        value >>= 5
+    return f"{prefix}_{''.join(reversed(chars))}{ext}"
+
+
+def write_image_exclusive(data: bytes, directory: str = None, prefix: str = "img",
+                          ext: str = ".png", path_for=None) -> str:
+    """
+    Writes encoded image `data` into `directory` under a new ULID filename
+    and returns that filename. The file is created with O_EXCL, so two
+    processes can never claim the same name; on the (astronomically unlikely)
+    collision a new name is drawn. `path_for(filename)`, when given, picks
+    the path instead (e.g. a sharded layout).
+    """
+    if directory is None:
+        directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
+
+    while True:
+        filename = new_image_filename(prefix=prefix, ext=ext)
+        path = path_for(filename) if path_for else os.path.join(directory, filename)
+        try:
+            with open(path, "xb") as f:
+                f.write(data)
+            return filename
+        except FileExistsError:
+            continue
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
 
-@app.route('/generate', methods=['POST'])
-def generate():
-    try:
-        if not generator:
-            return jsonify({'error': 'API key not configured'}), 500
-            
-        data = request.json
-        prompt = data.get('prompt')
-        
-        if not prompt:
-            return jsonify({'error': 'No prompt provided'}), 400
-            
-        # Enhance the prompt with banner-specific instructions
-        banner_instructions = (
-            "Create a professional horizontal banner image with the following specifications:\n"
-            f"- Exact dimensions: {BANNER_WIDTH}x{BANNER_HEIGHT} pixels\n"
-            "- Use a horizontal rectangular layout with proper banner proportions\n"
-            "- Include visually appealing design elements typical of banners\n"
-            "- Ensure any text is readable and properly positioned for a banner\n"
-            "- Avoid generating images that only show the word 'Boost' or similar text\n"
-            "- Create a complete, polished banner design based on this prompt:\n\n"
-        )
-        
-        enhanced_prompt = banner_instructions + prompt
-        
-        # Generate the image
-        image = generator.generate_image(enhanced_prompt)
-        
-        # Resize to banner dimensions
-        image = image.resize((BANNER_WIDTH, BANNER_HEIGHT), Image.LANCZOS)
-        
-        # Save the image
-        filename = next_image_filename()
-        image_path = generator.save_image(image, filename)
-        
-        # Create a full URL for the image that includes the host
-        image_url = f"http://localhost:5000/images/{filename}"
-        
-        logger.info(f"Generated image URL: {image_url}")
-        
-        return jsonify({
-            'success': True,
-            'image_url': image_url,
-            'filename': filename,
-            'prompt': prompt
-        })
-        
-    except Exception as e:
-        logger.exception("Error: %s", e)
-        return jsonify({'error': str(e)}), 500
-
-@app.route('/images/<filename>', methods=['GET'])
-def serve_image(filename):
-    try:
-        images_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
-        return send_file(os.path.join(images_dir, filename), mimetype='image/png')
-    except Exception as e:
-        logger.exception("Error serving image: %s", e)
-        return jsonify({'error': str(e)}), 404
 
 if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "GEMINI_API_KEY.env"))
+    API_KEY = os.getenv("GEMINI_API_KEY")
     if not API_KEY:
+        logger.error("GEMINI_API_KEY not found in GEMINI_API_KEY.env. Please add it and try again.")
         sys.exit(1)
-    
-    print("Starting Flask server for Gemini image generation...")
-    app.run(debug=True, port=5000)
\ No newline at end of file
+
+    print("Enter a banner prompt (finish with an empty line):")
+    lines = []
+    for line in sys.stdin:
+        if not line.strip():
+            break
+        lines.append(line.rstrip("\n"))
+    prompt = "\n".join(lines)
+    if not prompt:
+        sys.exit("No prompt provided")
+
+    generator = GeminiImageGenerator(api_key=API_KEY)
+    image = generator.generate_image(prompt).resize((BANNER_WIDTH, BANNER_HEIGHT), Image.LANCZOS)
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    print(f"Saved images/{write_image_exclusive(buffer.getvalue())}")
@@ -0,0 +1,30 @@
+"""
+gunicorn.conf.py
+
+Read automatically by `gunicorn app:app` (see Procfile) when started from
+this directory. The master imports the google.genai modules once before
+forking, so each worker inherits them instead of paying the import at
+boot; genai clients themselves are still created per worker, on first use.
+Set GEMINI_PREFORK_WARMUP=0 to skip.
+
+Workers are threaded (gthread). A Server-Sent Event client of
+/generate-stream or /jobs/<job_id>/events holds a thread until its job
+finishes, so with sync workers a handful of open streams would take every
+worker. GUNICORN_THREADS sets the threads per worker and so the number of
+concurrent requests, streams included, each worker serves. For many long
+streams run `uvicorn asgi:app` instead, where a stream is a coroutine.
+"""
+
+import os
+import sys
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "32"))
+
+
+def on_starting(server):
+    if os.getenv("GEMINI_PREFORK_WARMUP", "1") == "0":
+        return
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import gemmi
+    gemmi.warm_up()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+janitor.py
+
+Keeps TEMP_IMAGES_DIR bounded. Every generation leaves a file there whether
+or not it is ever saved, so a background thread periodically:
+
+  1. evicts files older than TEMP_IMAGES_MAX_AGE seconds, then
+  2. while the directory is above TEMP_IMAGES_MAX_BYTES, evicts the least
+     recently accessed of the remaining files.
+
+Files are never evicted while something may still need them: anything
+younger than TEMP_IMAGES_MIN_AGE (a generation in flight, or one the
+client has not fetched yet), and, within TEMP_IMAGES_MAX_AGE, the results
+of finished generation jobs that may not have been polled yet and the
+originals of designs saved without a blob. Saved designs with a blob keep
+their own copy, so their originals age out like any other file.
+
+CUSTOMIZED_DIR, the cache of customization renders, is swept the same way
+under its own CUSTOMIZED_MAX_AGE and CUSTOMIZED_MAX_BYTES limits. Nothing in
+it is protected: renders are previews, and a customization the user keeps
+is saved as a design with its own blob (/render-customization with save),
+so no stored URL points into CUSTOMIZED_DIR.
+
+Sweeps take an flock, so with several gunicorn workers only one sweeps at
+a time. Run as a script for a one-off sweep:
+
+    python janitor.py --dry-run
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+from layout import iter_files
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# Configuration: limits and sweep interval
+# ------------------------------------------------------------------------------
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+TEMP_IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
+JANITOR_LOCK_PATH = os.path.join(DATA_DIR, "janitor.lock")
+MAX_AGE = float(os.getenv("TEMP_IMAGES_MAX_AGE", str(24 * 3600)))
+MAX_BYTES = int(os.getenv("TEMP_IMAGES_MAX_BYTES", str(1024 * 1024 * 1024)))
+MIN_AGE = float(os.getenv("TEMP_IMAGES_MIN_AGE", "600"))
+SWEEP_INTERVAL = float(os.getenv("TEMP_IMAGES_SWEEP_INTERVAL", "300"))
+
+CUSTOMIZED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "customized")
+CUSTOMIZED_LOCK_PATH = os.path.join(DATA_DIR, "janitor-customized.lock")
+CUSTOMIZED_MAX_AGE = float(os.getenv("CUSTOMIZED_MAX_AGE", str(24 * 3600)))
+CUSTOMIZED_MAX_BYTES = int(os.getenv("CUSTOMIZED_MAX_BYTES", str(512 * 1024 * 1024)))
+
+REASON_TTL = "ttl"
+REASON_QUOTA = "quota"
+
+evicted_files = REGISTRY.counter(
+    "banner_temp_evicted_files_total", "Temporary images evicted, by directory and reason.",
+    ("directory", "reason"))
+evicted_bytes = REGISTRY.counter(
+    "banner_temp_evicted_bytes_total", "Bytes reclaimed from temporary images, by directory and reason.",
+    ("directory", "reason"))
+temp_bytes = REGISTRY.gauge(
+    "banner_temp_images_bytes", "Size of each swept directory after its last sweep.", ("directory",))
+
+
+class TempJanitor:
+    """
+    Evicts unreferenced temporary images by age and total size.
+    `protected()` returns the set of filenames that must be kept;
+    `on_evict(names)` is called with the filenames removed by a sweep.
+    `name` labels the directory in metrics and logs.
+    """
+
+    def __init__(self, directory: str = TEMP_IMAGES_DIR, max_age: float = MAX_AGE,
+                 max_bytes: int = MAX_BYTES, min_age: float = MIN_AGE,
+                 interval: float = SWEEP_INTERVAL, protected=None, on_evict=None,
+                 lock_path: str = JANITOR_LOCK_PATH, name: str = "images"):
+        self.directory = directory
+        self.name = name
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.interval = interval
+        self.protected = protected or set
+        self.on_evict = on_evict
+        self.lock_path = lock_path
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._loop, name=f"janitor-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.exception("Sweep of %s failed: %s", self.name, e)
+
+    def _scan(self) -> list:
+        """
+        Returns (name, path, size, created, last_access) for every file.
+        """
+        files = []
+        for entry in iter_files(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            # atime may be coarse (relatime) but is never older than the write
+            files.append((entry.name, entry.path, stat.st_size, stat.st_mtime,
+                          max(stat.st_atime, stat.st_mtime)))
+        return files
+
+    def sweep(self, dry_run: bool = False) -> dict:
+        """
+        Runs one eviction pass and returns {'files', 'bytes', 'remainingBytes'},
+        or None when another process is already sweeping.
+        """
+        if fcntl is None:
+            return self._sweep(dry_run)
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        with open(self.lock_path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            try:
+                return self._sweep(dry_run)
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _sweep(self, dry_run: bool) -> dict:
+        now = time.time()
+        files = self._scan()
+        total = sum(size for _, _, size, _, _ in files)
+        keep = self.protected()
+
+        candidates = [f for f in files if f[0] not in keep and now - f[3] >= self.min_age]
+        expired = [f for f in candidates if now - f[3] >= self.max_age]
+        # Least recently accessed first
+        rest = sorted((f for f in candidates if now - f[3] < self.max_age), key=lambda f: f[4])
+
+        evictions = [(f, REASON_TTL) for f in expired]
+        remaining = total - sum(f[2] for f in expired)
+        for f in rest:
+            if remaining <= self.max_bytes:
+                break
+            evictions.append((f, REASON_QUOTA))
+            remaining -= f[2]
+
+        removed, reclaimed = [], 0
+        for (name, path, size, _, _), reason in evictions:
+            if not dry_run:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                evicted_files.inc(directory=self.name, reason=reason)
+                evicted_bytes.inc(size, directory=self.name, reason=reason)
+            removed.append(name)
+            reclaimed += size
+
+        if not dry_run:
+            temp_bytes.set(total - reclaimed, directory=self.name)
+            if removed and self.on_evict is not None:
+                self.on_evict(removed)
+        if removed and not dry_run:
+            logger.info("Evicted %s files from %s, reclaimed %s bytes (%s bytes remain)",
+                        len(removed), self.name, reclaimed, total - reclaimed)
+        if total - reclaimed > self.max_bytes:
+            logger.warning("%s uses %s bytes, above the %s byte cap,"
+                           " but the rest are protected", self.name, total - reclaimed, self.max_bytes)
+        return {'files': len(removed), 'bytes': reclaimed, 'remainingBytes': total - reclaimed}
+
+
+def protected_filenames(design_index, job_store, max_age: float = MAX_AGE):
+    """
+    Returns a callable listing the temp files referenced by designs saved
+    without a blob, or by generation jobs finished, within `max_age`. Both
+    are indexed range queries over that window only.
+    """
+    def protected():
+        since = (datetime.now() - timedelta(seconds=max_age)).isoformat()
+        return design_index.original_filenames(since) | job_store.result_filenames(since)
+    return protected
+
+
+if __name__ == "__main__":
+    from designs import DesignIndex
+    from jobs import JobStore
+    from phash import HashIndex, KIND_TEMP
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s",
+                        handlers=[logging.StreamHandler(sys.stdout)])
+    parser = argparse.ArgumentParser(description="Evict old temporary images.")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be evicted")
+    args = parser.parse_args()
+
+    hash_index = HashIndex()
+    janitors = [
+        TempJanitor(protected=protected_filenames(DesignIndex(), JobStore()),
+                    on_evict=lambda names: hash_index.remove(KIND_TEMP, names)),
+        TempJanitor(CUSTOMIZED_DIR, max_age=CUSTOMIZED_MAX_AGE, max_bytes=CUSTOMIZED_MAX_BYTES,
+                    lock_path=CUSTOMIZED_LOCK_PATH, name="customized"),
+    ]
+    for janitor in janitors:
+        result = janitor.sweep(dry_run=args.dry_run)
+        if result is None:
+            print(f"{janitor.name}: another sweep is running.")
+        else:
+            print(f"{janitor.name}: {'would evict' if args.dry_run else 'evicted'} {result['files']} files,"
+                  f" {result['bytes']} bytes; {result['remainingBytes']} bytes remain.")
@@ -0,0 +1,257 @@
+"""
+jobs.py
+
+A small asynchronous job queue for banner generation. Submitted jobs are
+recorded in a local SQLite database and executed by a bounded thread pool,
+so HTTP workers return immediately and clients poll for the result.
+
+Handlers report progress through a callback; each report is stored as an
+event with a job-scoped, monotonically increasing id, so a client can
+follow a job as a stream and resume it from the last id it saw, from any
+worker process. Every job starts with a "queued" event and ends with
+"done" or "failed".
+
+Job state survives restarts: jobs that were queued (or left running by a
+process that has since exited) are picked up again when a queue starts.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# Configuration: job database and worker pool size
+# ------------------------------------------------------------------------------
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+JOBS_DB_PATH = os.path.join(DATA_DIR, "jobs.db")
+JOB_WORKERS = int(os.getenv("GENERATION_JOB_WORKERS", "4"))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+EVENT_QUEUED = "queued"
+TERMINAL_EVENTS = (JOB_DONE, JOB_FAILED)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore:
+    """
+    Persists job records in SQLite. Each call opens its own connection so
+    the store is safe to share between threads and worker processes.
+    """
+
+    def __init__(self, path: str = JOBS_DB_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY,"
+                " status TEXT NOT NULL,"
+                " params TEXT NOT NULL,"
+                " result TEXT,"
+                " error TEXT,"
+                " worker_pid INTEGER,"
+                " created_at TEXT NOT NULL,"
+                " updated_at TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+            # For the janitor's "finished recently" lookups
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_updated ON jobs (status, updated_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_events ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " job_id TEXT NOT NULL,"
+                " event TEXT NOT NULL,"
+                " data TEXT NOT NULL,"
+                " created_at TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id, id)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def create(self, params: dict) -> str:
+        job_id = uuid.uuid4().hex
+        now = datetime.now().isoformat()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, params, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (job_id, JOB_QUEUED, json.dumps(params), now, now)
+            )
+            self._add_event(conn, job_id, EVENT_QUEUED, {'jobId': job_id}, now)
+        return job_id
+
+    @staticmethod
+    def _add_event(conn, job_id: str, event: str, data: dict, now: str) -> int:
+        cursor = conn.execute(
+            "INSERT INTO job_events (job_id, event, data, created_at) VALUES (?, ?, ?, ?)",
+            (job_id, event, json.dumps(data or {}), now)
+        )
+        return cursor.lastrowid
+
+    def add_event(self, job_id: str, event: str, data: dict = None) -> int:
+        """
+        Records a progress event for `job_id` and returns its id.
+        """
+        with self._connect() as conn:
+            return self._add_event(conn, job_id, event, data, datetime.now().isoformat())
+
+    def events(self, job_id: str, after: int = 0) -> list:
+        """
+        Returns the job's events with an id greater than `after`, oldest
+        first, as {'id', 'event', 'data', 'createdAt'}.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, event, data, created_at FROM job_events"
+                " WHERE job_id = ? AND id > ? ORDER BY id",
+                (job_id, after)
+            ).fetchall()
+        return [{'id': row['id'], 'event': row['event'], 'data': json.loads(row['data']),
+                 'createdAt': row['created_at']} for row in rows]
+
+    def claim(self, job_id: str) -> bool:
+        """
+        Atomically moves a queued job to running. Returns False if another
+        thread or process got there first.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, worker_pid = ?, updated_at = ?"
+                " WHERE id = ? AND status = ?",
+                (JOB_RUNNING, os.getpid(), datetime.now().isoformat(), job_id, JOB_QUEUED)
+            )
+            return cursor.rowcount == 1
+
+    def finish(self, job_id: str, result: dict = None, error: str = None):
+        status = JOB_FAILED if error is not None else JOB_DONE
+        now = datetime.now().isoformat()
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ?"
+                " WHERE id = ?",
+                (status, json.dumps(result) if result is not None else None,
+                 error, now, job_id)
+            )
+            # In the same transaction, so a finished job always has its final event
+            self._add_event(conn, job_id, status,
+                            {'error': error} if error is not None else result, now)
+
+    def get(self, job_id: str):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'id': row['id'],
+            'status': row['status'],
+            'params': json.loads(row['params']),
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'createdAt': row['created_at'],
+            'updatedAt': row['updated_at'],
+        }
+
+    def params(self, job_id: str) -> dict:
+        with self._connect() as conn:
+            row = conn.execute("SELECT params FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row['params'])
+
+    def result_filenames(self, since: str) -> set:
+        """
+        Returns the image filenames (every variant's) produced by jobs that
+        finished at or after `since` (an ISO timestamp).
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT result FROM jobs WHERE status = ? AND updated_at >= ?",
+                (JOB_DONE, since)
+            ).fetchall()
+        names = set()
+        for row in rows:
+            result = json.loads(row['result']) if row['result'] else {}
+            if result.get('filename'):
+                names.add(result['filename'])
+            names.update(variant['filename'] for variant in result.get('variants', []))
+        return names
+
+    def recover(self) -> list:
+        """
+        Requeues jobs whose worker process has died and returns the ids of
+        every job that is waiting to run.
+        """
+        with self._connect() as conn:
+            running = conn.execute(
+                "SELECT id, worker_pid FROM jobs WHERE status = ?", (JOB_RUNNING,)
+            ).fetchall()
+            for row in running:
+                if row['worker_pid'] is None or not _pid_alive(row['worker_pid']):
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, worker_pid = NULL, updated_at = ?"
+                        " WHERE id = ? AND status = ?",
+                        (JOB_QUEUED, datetime.now().isoformat(), row['id'], JOB_RUNNING)
+                    )
+            queued = conn.execute(
+                "SELECT id FROM jobs WHERE status = ? ORDER BY created_at", (JOB_QUEUED,)
+            ).fetchall()
+        return [row['id'] for row in queued]
+
+
+class JobQueue:
+    """
+    Runs `handler(params, progress) -> dict` for each submitted job on a
+    bounded thread pool, recording progress in a JobStore. The handler
+    calls `progress(event, data)` to add an event to the job's stream.
+    """
+
+    def __init__(self, handler, store: JobStore = None, max_workers: int = JOB_WORKERS):
+        self.handler = handler
+        self.store = store or JobStore()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="generation-job")
+
+        recovered = self.store.recover()
+        for job_id in recovered:
+            self._executor.submit(self._run, job_id)
+        if recovered:
+            logger.info("Resubmitted %s unfinished generation jobs", len(recovered))
+
+    def submit(self, params: dict) -> str:
+        job_id = self.store.create(params)
+        self._executor.submit(self._run, job_id)
+        logger.info("Queued generation job %s", job_id)
+        return job_id
+
+    def _run(self, job_id: str):
+        if not self.store.claim(job_id):
+            return
+        try:
+            result = self.handler(self.store.params(job_id),
+                                  lambda event, data=None: self.store.add_event(job_id, event, data))
+            self.store.finish(job_id, result=result)
+            logger.info("Generation job %s finished", job_id)
+        except Exception as e:
+            logger.exception("Generation job %s failed: %s", job_id, e)
+            self.store.finish(job_id, error=str(e))
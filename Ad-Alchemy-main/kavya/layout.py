@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+layout.py
+
+Hash-sharded directory layout for images/ and saved_images/, so no single
+directory grows to hundreds of thousands of entries.
+
+    images/ab/cd/img_01J9....png               two levels of the name's hash
+    saved_images/ef/01/ef01.../saved_u_...png  one directory per user, itself
+                                               under two levels of the user's hash
+
+URLs still carry only the filename. resolve() looks for the sharded path,
+then the legacy flat path, then the sharded path again; files are moved by
+hard-linking the new path before unlinking the old one, so a file is always
+found under one of them even while a migration runs. .meta sidecars shard
+with the file they describe.
+
+Run as a script to move existing flat files into shards, online and in
+small batches:
+
+    python layout.py --migrate --dry-run
+    python layout.py --migrate --batch 500 --pause 0.1
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# Configuration: directory locations and shard key length
+# ------------------------------------------------------------------------------
+TEMP_IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
+SAVED_IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "saved_images")
+GROUP_KEY_LENGTH = 16
+META_SUFFIX = ".meta"
+
+
+def _digest(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+def iter_files(root: str):
+    """
+    Yields an os.DirEntry for every file under `root`, at any depth.
+    """
+    stack = [root]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+            except FileNotFoundError:
+                continue
+
+
+class ShardedDirectory:
+    """
+    Maps filenames to sharded paths under `root`. `group_of(name)` may
+    return a key (e.g. a user id) whose files share one directory; names
+    without a group are sharded by their own hash.
+    """
+
+    def __init__(self, root: str, group_of=None):
+        self.root = root
+        self.group_of = group_of
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, name: str) -> str:
+        """
+        Returns the sharded path for `name`, whether or not it exists.
+        """
+        key = name[:-len(META_SUFFIX)] if name.endswith(META_SUFFIX) else name
+        group = self.group_of(key) if self.group_of else None
+        if group is not None:
+            digest = _digest(group)
+            return os.path.join(self.root, digest[:2], digest[2:4],
+                                digest[:GROUP_KEY_LENGTH], name)
+        digest = _digest(key)
+        return os.path.join(self.root, digest[:2], digest[2:4], name)
+
+    def flat_path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def resolve(self, name: str):
+        """
+        Returns the existing path for `name`, sharded or legacy flat, or None.
+        """
+        sharded = self.path_for(name)
+        if os.path.isfile(sharded):
+            return sharded
+        flat = self.flat_path(name)
+        if os.path.isfile(flat):
+            return flat
+        # A migration may have moved it between the two checks
+        return sharded if os.path.isfile(sharded) else None
+
+    def files(self):
+        return iter_files(self.root)
+
+    @staticmethod
+    def _move(source: str, target: str) -> bool:
+        """
+        Moves `source` to `target` so that at least one of them exists at
+        every instant. Returns False when the file was left in place.
+        """
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            # Linked by an interrupted run; anything else is a real conflict
+            if not os.path.samefile(source, target):
+                logger.warning("%s exists in both layouts; leaving the flat copy", source)
+                return False
+        except OSError:
+            # No hard links on this filesystem: a rename is still atomic
+            os.replace(source, target)
+            return True
+        os.unlink(source)
+        return True
+
+    def migrate(self, batch_size: int = 500, pause: float = 0.0, dry_run: bool = False) -> dict:
+        """
+        Moves every file still at the top level of `root` into its shard,
+        `batch_size` files at a time with `pause` seconds between batches.
+        Returns {'moved', 'bytes'}.
+        """
+        moved = size = 0
+        batch = 0
+        with os.scandir(self.root) as entries:
+            flat = [entry for entry in entries if entry.is_file()]
+        for entry in flat:
+            try:
+                entry_size = entry.stat().st_size
+                if not dry_run and not self._move(entry.path, self.path_for(entry.name)):
+                    continue
+            except FileNotFoundError:
+                continue
+            moved += 1
+            size += entry_size
+            batch += 1
+            if batch >= batch_size:
+                logger.info("Moved %s files (%s bytes) in %s", moved, size, self.root)
+                batch = 0
+                if pause:
+                    time.sleep(pause)
+        logger.info("%s %s files (%s bytes) in %s",
+                    "Would move" if dry_run else "Moved", moved, size, self.root)
+        return {'moved': moved, 'bytes': size}
+
+
+if __name__ == "__main__":
+    from designs import saved_design_user
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    parser = argparse.ArgumentParser(description="Shard images/ and saved_images/.")
+    parser.add_argument("--migrate", action="store_true",
+                        help="move flat files into their shards while the service runs")
+    parser.add_argument("--batch", type=int, default=500, help="files moved between pauses")
+    parser.add_argument("--pause", type=float, default=0.05, help="seconds to sleep between batches")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be moved")
+    args = parser.parse_args()
+
+    if args.migrate:
+        for directory in (ShardedDirectory(TEMP_IMAGES_DIR),
+                          ShardedDirectory(SAVED_IMAGES_DIR, group_of=saved_design_user)):
+            directory.migrate(args.batch, args.pause, args.dry_run)
+    else:
+        parser.print_help()
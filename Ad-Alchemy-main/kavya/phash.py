@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+phash.py
+
+Perceptual hashing and near-duplicate lookup for generated and saved images.
+
+Each image gets a 64-bit difference hash (dHash). Hashes are stored in SQLite
+as a multi-index hash table: the hash is split into four 16-bit chunks, each
+with its own index. Two hashes within Hamming distance r must agree on some
+chunk to within r // 4 bits, so a lookup only probes a handful of chunk
+values per index and verifies the few candidates it finds. The probe count
+grows steeply with r // 4, so searches are capped at MAX_SEARCH_DISTANCE.
+
+Run as a script to hash saved images that predate the index:
+
+    python phash.py --backfill
+"""
+
+import argparse
+import itertools
+import logging
+import os
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from layout import iter_files
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# Configuration: thresholds and database
+# ------------------------------------------------------------------------------
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+HASHES_DB_PATH = os.path.join(DATA_DIR, "designs.db")
+SAVED_IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "saved_images")
+# Saves within this distance of one of the user's saved images are compared
+# pixel by pixel, and reuse its file only when identical
+DEDUP_THRESHOLD = int(os.getenv("PHASH_DEDUP_THRESHOLD", "2"))
+# Default radius for the "similar designs" lookup
+SIMILAR_THRESHOLD = int(os.getenv("PHASH_SIMILAR_THRESHOLD", "10"))
+# Largest radius search() accepts: 15 probes the 697 values within 3 bits of
+# each chunk, where 32 would probe 39,203
+MAX_SEARCH_DISTANCE = 15
+
+KIND_TEMP = "temp"
+KIND_SAVED = "saved"
+
+_CHUNKS = 4
+_CHUNK_BITS = 16
+_CHUNK_MASK = (1 << _CHUNK_BITS) - 1
+
+
+def dhash(image: Image.Image) -> int:
+    """
+    Returns the 64-bit difference hash of `image`: the sign of the horizontal
+    gradient on a 9x8 grayscale thumbnail.
+    """
+    image.draft('L', (64, 64))
+    small = np.asarray(image.convert('L').resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def dhash_file(path: str) -> int:
+    with Image.open(path) as image:
+        return dhash(image)
+
+
+def same_pixels(path_a: str, path_b: str) -> bool:
+    """
+    Returns True when both images decode to exactly the same pixels,
+    whatever their encoding.
+    """
+    with Image.open(path_a) as a, Image.open(path_b) as b:
+        if a.size != b.size:
+            return False
+        return np.array_equal(np.asarray(a.convert('RGBA')), np.asarray(b.convert('RGBA')))
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def _to_signed(value: int) -> int:
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _to_unsigned(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+def _chunks(value: int) -> list:
+    return [(value >> (_CHUNK_BITS * i)) & _CHUNK_MASK for i in range(_CHUNKS)]
+
+
+def _neighbours(chunk: int, radius: int) -> list:
+    """
+    Returns every 16-bit value within `radius` bits of `chunk`.
+    """
+    values = [chunk]
+    for r in range(1, radius + 1):
+        for positions in itertools.combinations(range(_CHUNK_BITS), r):
+            flipped = chunk
+            for p in positions:
+                flipped ^= 1 << p
+            values.append(flipped)
+    return values
+
+
+class HashIndex:
+    """
+    Stores perceptual hashes of temp and saved images in SQLite.
+    """
+
+    def __init__(self, path: str = HASHES_DB_PATH, max_workers: int = 1):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="phash")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS image_hashes ("
+                " kind TEXT NOT NULL,"
+                " name TEXT NOT NULL,"
+                " hash INTEGER NOT NULL,"
+                " c0 INTEGER NOT NULL, c1 INTEGER NOT NULL,"
+                " c2 INTEGER NOT NULL, c3 INTEGER NOT NULL,"
+                " PRIMARY KEY (kind, name))"
+            )
+            for i in range(_CHUNKS):
+                conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS image_hashes_c{i} ON image_hashes (kind, c{i})"
+                )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def add(self, kind: str, name: str, value: int):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO image_hashes (kind, name, hash, c0, c1, c2, c3)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, name, _to_signed(value), *_chunks(value))
+            )
+
+    def schedule(self, kind: str, name: str, path: str):
+        """
+        Hashes the image at `path` in the background.
+        """
+        def run():
+            try:
+                self.add(kind, name, dhash_file(path))
+            except Exception as e:
+                logger.exception("Failed to hash %s: %s", name, e)
+        self._executor.submit(run)
+
+    def get(self, kind: str, name: str):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT hash FROM image_hashes WHERE kind = ? AND name = ?", (kind, name)
+            ).fetchone()
+        return _to_unsigned(row['hash']) if row else None
+
+    def remove(self, kind: str, names: list, conn: sqlite3.Connection = None):
+        if conn is None:
+            with self._connect() as conn:
+                return self.remove(kind, names, conn)
+        conn.executemany(
+            "DELETE FROM image_hashes WHERE kind = ? AND name = ?",
+            [(kind, name) for name in names]
+        )
+
+    def search(self, kind: str, value: int, max_distance: int, limit: int = 20,
+               exclude: str = None) -> list:
+        """
+        Returns [(name, distance), ...] of `kind` images within
+        `max_distance` bits of `value`, nearest first. Raises ValueError
+        above MAX_SEARCH_DISTANCE.
+        """
+        if max_distance > MAX_SEARCH_DISTANCE:
+            raise ValueError(f"max_distance must be at most {MAX_SEARCH_DISTANCE}")
+        radius = max_distance // _CHUNKS
+        found = {}
+        with self._connect() as conn:
+            for i, chunk in enumerate(_chunks(value)):
+                probes = _neighbours(chunk, radius)
+                for start in range(0, len(probes), 500):
+                    batch = probes[start:start + 500]
+                    rows = conn.execute(
+                        f"SELECT name, hash FROM image_hashes WHERE kind = ?"
+                        f" AND c{i} IN ({','.join('?' * len(batch))})",
+                        [kind, *batch]
+                    ).fetchall()
+                    for row in rows:
+                        if row['name'] in found or row['name'] == exclude:
+                            continue
+                        distance = hamming(value, _to_unsigned(row['hash']))
+                        if distance <= max_distance:
+                            found[row['name']] = distance
+        return sorted(found.items(), key=lambda item: (item[1], item[0]))[:limit]
+
+    def backfill(self, directory: str = SAVED_IMAGES_DIR) -> int:
+        """
+        Hashes every saved image in `directory` that has no hash yet.
+        """
+        with self._connect() as conn:
+            known = {row['name'] for row in conn.execute(
+                "SELECT name FROM image_hashes WHERE kind = ?", (KIND_SAVED,))}
+        count = 0
+        for entry in iter_files(directory):
+            if entry.name in known or entry.name.endswith('.meta'):
+                continue
+            try:
+                self.add(KIND_SAVED, entry.name, dhash_file(entry.path))
+                count += 1
+            except Exception as e:
+                logger.error("Could not hash %s: %s", entry.name, e)
+        logger.info("Hashed %s saved images", count)
+        return count
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[logging.StreamHandler(sys.stdout)]
+    )
+    parser = argparse.ArgumentParser(description="Manage the perceptual hash index.")
+    parser.add_argument("--backfill", action="store_true",
+                        help="hash saved images that are not indexed yet")
+    args = parser.parse_args()
+
+    if args.backfill:
+        HashIndex().backfill()
+    else:
+        parser.print_help()
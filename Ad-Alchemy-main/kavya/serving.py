@@ -0,0 +1,69 @@
+"""
+serving.py
+
+Responses for image files. Every image URL this service hands out names
+content that never changes (generated files get unique names, saved designs
+point at content-addressed blobs), so responses are marked immutable and
+carry a strong ETag and Last-Modified. Conditional requests get a 304 and
+Range requests a 206, both handled by werkzeug.
+
+With IMAGE_OFFLOAD set, the bytes are not streamed by Python at all:
+
+    IMAGE_OFFLOAD=x-sendfile   Apache/lighttpd: X-Sendfile with the file path
+    IMAGE_OFFLOAD=x-accel      nginx: X-Accel-Redirect to IMAGE_ACCEL_PREFIX
+                               plus the path relative to IMAGE_ACCEL_ROOT
+
+For nginx, map the prefix to the service directory with an internal
+location, e.g.
+
+    location /_files/ { internal; alias /app/kavya/; }
+"""
+
+import mimetypes
+import os
+
+from flask import Response, request, send_file
+
+# ------------------------------------------------------------------------------
+# Configuration: cache lifetime and sendfile offload
+# ------------------------------------------------------------------------------
+IMMUTABLE_MAX_AGE = 31536000
+OFFLOAD = os.getenv("IMAGE_OFFLOAD", "").lower()
+ACCEL_PREFIX = os.getenv("IMAGE_ACCEL_PREFIX", "/_files").rstrip("/")
+ACCEL_ROOT = os.getenv("IMAGE_ACCEL_ROOT", os.path.dirname(os.path.abspath(__file__)))
+
+OFFLOAD_X_SENDFILE = "x-sendfile"
+OFFLOAD_X_ACCEL = "x-accel"
+
+
+def _mark_immutable(response: Response) -> Response:
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+def send_image(path: str, mimetype: str = None, etag: str = None) -> Response:
+    """
+    Returns a cacheable response for the image at `path`. `etag` should be
+    a content identifier when one is known (e.g. a blob digest); otherwise
+    werkzeug derives one from the file's mtime, size and name.
+    """
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+    if OFFLOAD == OFFLOAD_X_ACCEL:
+        stat = os.stat(path)
+        relative = os.path.relpath(path, ACCEL_ROOT).replace(os.sep, "/")
+        response = Response(mimetype=mimetype)
+        response.headers["X-Accel-Redirect"] = f"{ACCEL_PREFIX}/{relative}"
+        response.set_etag(etag or f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+        response.last_modified = stat.st_mtime
+        _mark_immutable(response)
+        # nginx serves the body (and Range); only the 304 is decided here
+        return response.make_conditional(request)
+
+    # USE_X_SENDFILE on the app makes send_file emit X-Sendfile instead of bytes
+    response = send_file(path, mimetype=mimetype, conditional=True,
+                         etag=etag if etag else True, max_age=IMMUTABLE_MAX_AGE)
+    return _mark_immutable(response)
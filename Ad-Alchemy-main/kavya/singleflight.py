@@ -0,0 +1,229 @@
+"""
+singleflight.py
+
+Coalesces identical work that is already in flight. The first caller for
+a key runs the function; concurrent callers with the same key wait for it
+and share its result (or its exception).
+
+Within a process this is a map of key -> Future. Across gunicorn workers
+the leader of each process also takes an flock on a per-key lock file.
+A worker that had to wait for that lock leaves a marker first, so the
+holder knows to publish its result next to the lock file, and the waiter
+reads it instead of repeating the call. A failure is published the same
+way and raised in the waiter as FlightFailed. Without fcntl (Windows) only
+the in-process coalescing applies.
+
+Old lock, marker and result files are pruned at most every PRUNE_INTERVAL
+seconds, and never while another caller holds the key's lock; a caller
+that locks a lock file checks it is still the one on disk, so a prune
+racing with it cannot produce a second leader.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# Configuration: lock directory and cleanup age
+# ------------------------------------------------------------------------------
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+INFLIGHT_DIR = os.path.join(DATA_DIR, "inflight")
+# Lock, marker and result files untouched for this long are removed
+STALE_AFTER = 300
+PRUNE_INTERVAL = 60
+
+
+class FlightFailed(Exception):
+    """
+    Raised in a caller that waited for another process's run of the same
+    key when that run failed. `retry_after` is copied from the original
+    exception when it had one.
+    """
+
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time and shares the bytes result
+    with everyone who asked for the same key meanwhile.
+    """
+
+    def __init__(self, lock_dir: str = INFLIGHT_DIR):
+        self.lock_dir = lock_dir
+        self._flights = {}
+        self._guard = threading.Lock()
+        self._last_prune = 0.0
+        os.makedirs(lock_dir, exist_ok=True)
+
+    def do(self, key: str, fn) -> tuple:
+        """
+        Returns (result, shared) where `shared` is True when the result came
+        from another caller's run of `fn`.
+        """
+        with self._guard:
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = self._flights[key] = Future()
+        if not leader:
+            return future.result(), True
+
+        try:
+            result, shared = self._run_locked(key, fn)
+            future.set_result(result)
+            return result, shared
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._guard:
+                self._flights.pop(key, None)
+
+    @staticmethod
+    def _open_locked(lock_path: str, marker_path: str):
+        """
+        Opens and flocks `lock_path`, returning (file, waited). Retries when
+        the file was pruned and replaced while this caller waited for it.
+        """
+        while True:
+            lock_file = open(lock_path, "a")
+            try:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    waited = False
+                except BlockingIOError:
+                    # Another worker is running this key: ask it to publish, then wait
+                    open(marker_path, "a").close()
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                    waited = True
+                try:
+                    current = os.stat(lock_path).st_ino
+                except FileNotFoundError:
+                    current = None
+                if current == os.fstat(lock_file.fileno()).st_ino:
+                    return lock_file, waited
+            except BaseException:
+                lock_file.close()
+                raise
+            lock_file.close()
+
+    def _run_locked(self, key: str, fn) -> tuple:
+        if fcntl is None:
+            return fn(), False
+
+        base = os.path.join(self.lock_dir, key)
+        lock_path, marker_path = f"{base}.lock", f"{base}.waiting"
+        result_path, error_path = f"{base}.result", f"{base}.error"
+        started = time.time()
+        lock_file, waited = self._open_locked(lock_path, marker_path)
+        try:
+            os.utime(lock_path)
+            if waited:
+                result = self._read_published(result_path, started)
+                if result is not None:
+                    return result, True
+                error = self._read_published(error_path, started)
+                if error is not None:
+                    failure = json.loads(error)
+                    raise FlightFailed(failure['message'], failure.get('retryAfter'))
+            try:
+                result = fn()
+            except Exception as e:
+                if os.path.exists(marker_path):
+                    self._publish(error_path, json.dumps({
+                        'message': f"{type(e).__name__}: {e}",
+                        'retryAfter': getattr(e, 'retry_after', None),
+                    }).encode('utf-8'))
+                    self._remove(marker_path)
+                raise
+            if os.path.exists(marker_path):
+                self._publish(result_path, result)
+                self._remove(marker_path)
+            return result, False
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+            self._prune()
+
+    @staticmethod
+    def _read_published(path: str, since: float):
+        try:
+            if os.path.getmtime(path) < since:
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _publish(path: str, result: bytes):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(result)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _prune_lock(path: str, cutoff: float) -> bool:
+        """
+        Removes the lock file at `path` if it is stale and nobody holds it.
+        Returns False when another caller holds it.
+        """
+        with open(path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                if os.fstat(lock_file.fileno()).st_mtime < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        return True
+
+    def _prune(self):
+        now = time.time()
+        with self._guard:
+            if now - self._last_prune < PRUNE_INTERVAL:
+                return
+            self._last_prune = now
+        cutoff = now - STALE_AFTER
+        try:
+            entries = list(os.scandir(self.lock_dir))
+        except OSError as e:
+            logger.warning("Could not prune %s: %s", self.lock_dir, e)
+            return
+
+        # Keys whose lock is held keep their marker and result files too
+        held = {entry.name[:-len(".lock")] for entry in entries
+                if entry.name.endswith(".lock") and not self._prune_lock(entry.path, cutoff)}
+        for entry in entries:
+            key, ext = os.path.splitext(entry.name)
+            if ext == ".lock" or key in held:
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
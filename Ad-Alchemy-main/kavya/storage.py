@@ -0,0 +1,173 @@
+"""
+storage.py
+
+Where image bytes are published and which URL clients get for them.
+
+The service always keeps a local working copy (post-processing, hashing,
+palettes and derivatives read local files); a storage backend decides how
+clients download it:
+
+    STORAGE_BACKEND=local   URLs point at this service's own routes under
+                            PUBLIC_BASE_URL (default http://localhost:5000)
+    STORAGE_BACKEND=s3      files are uploaded to S3_BUCKET on any
+                            S3-compatible endpoint (S3_ENDPOINT_URL for MinIO
+                            and friends) and URLs are presigned GETs, or
+                            IMAGE_CDN_BASE_URL + key when a CDN fronts the
+                            bucket, so image bytes never pass through the app
+
+Keys are stable: images/<filename> for generated files,
+blobs/<digest><ext> for saved, content-addressed images,
+derivatives/<design id>/w<width>.<fmt> for their resized copies and
+customized/<sha>.<ext> for rendered customizations. Objects are uploaded
+with an immutable Cache-Control, as every key names fixed content.
+
+Presigned URLs expire; url_version() changes at least twice per expiry
+period, so responses that embed URLs can fold it into their ETag and a
+revalidating client never keeps a URL with less than half its life left.
+URLs a client will store (saved designs) come from stable_url() instead:
+the CDN URL, or the service route, which redirects to a fresh presigned
+URL on every request.
+boto3 is only needed for the s3 backend.
+"""
+
+import logging
+import mimetypes
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# Configuration: backend selection, public URLs and S3 connection
+# ------------------------------------------------------------------------------
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local").lower()
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "http://localhost:5000").rstrip("/")
+CDN_BASE_URL = os.getenv("IMAGE_CDN_BASE_URL", "").rstrip("/")
+S3_BUCKET = os.getenv("S3_BUCKET", "")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+S3_REGION = os.getenv("S3_REGION") or None
+S3_PREFIX = os.getenv("S3_PREFIX", "").strip("/")
+S3_PRESIGN_EXPIRES = int(os.getenv("S3_PRESIGN_EXPIRES", "3600"))
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def public_url(path: str) -> str:
+    """
+    Returns the absolute URL of one of this service's routes.
+    """
+    return f"{PUBLIC_BASE_URL}{path}"
+
+
+class LocalStorage:
+    """
+    Serves objects from this service: publishing is a no-op and URLs are
+    the service's own routes (behind IMAGE_CDN_BASE_URL when set).
+    """
+
+    name = "local"
+    # URLs point back at this service's routes
+    remote = False
+
+    def __init__(self, base_url: str = None):
+        self.base_url = (base_url or CDN_BASE_URL or PUBLIC_BASE_URL).rstrip("/")
+
+    def publish(self, key: str, path: str, content_type: str = None):
+        pass
+
+    def delete(self, key: str):
+        pass
+
+    def url(self, key: str, route: str) -> str:
+        """
+        Returns the download URL for `key`; `route` is the service path
+        that serves the same bytes.
+        """
+        return f"{self.base_url}{route}"
+
+    def url_version(self) -> int:
+        return 0
+
+    def stable_url(self, key: str, route: str) -> str:
+        return self.url(key, route)
+
+
+class S3Storage:
+    """
+    Publishes objects to an S3-compatible bucket and hands out presigned
+    (or CDN) URLs for them.
+    """
+
+    name = "s3"
+    remote = True
+
+    def __init__(self, bucket: str = S3_BUCKET, endpoint_url: str = S3_ENDPOINT_URL,
+                 region: str = S3_REGION, prefix: str = S3_PREFIX,
+                 cdn_base_url: str = CDN_BASE_URL, expires: int = S3_PRESIGN_EXPIRES,
+                 client=None):
+        if not bucket:
+            raise ValueError("S3_BUCKET must be set for the s3 storage backend")
+        if client is None:
+            try:
+                import boto3
+            except ImportError as e:
+                raise RuntimeError("The s3 storage backend needs boto3 (pip install boto3)") from e
+            client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cdn_base_url = cdn_base_url.rstrip("/")
+        self.expires = expires
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def publish(self, key: str, path: str, content_type: str = None):
+        extra = {'CacheControl': IMMUTABLE_CACHE_CONTROL}
+        content_type = content_type or mimetypes.guess_type(path)[0]
+        if content_type:
+            extra['ContentType'] = content_type
+        self.client.upload_file(path, self.bucket, self._key(key), ExtraArgs=extra)
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def url(self, key: str, route: str) -> str:
+        if self.cdn_base_url:
+            return f"{self.cdn_base_url}/{self._key(key)}"
+        return self.client.generate_presigned_url(
+            "get_object", Params={'Bucket': self.bucket, 'Key': self._key(key)},
+            ExpiresIn=self.expires)
+
+    def url_version(self) -> int:
+        """
+        Returns a number that changes whenever url() results should be
+        refreshed: never behind a CDN, every half expiry period otherwise.
+        """
+        if self.cdn_base_url:
+            return 0
+        return int(time.time() // max(1, self.expires // 2))
+
+    def stable_url(self, key: str, route: str) -> str:
+        """
+        Returns a URL for `key` that does not expire, for clients that
+        store it: the CDN URL, or the service route, which redirects to a
+        presigned URL.
+        """
+        if self.cdn_base_url:
+            return self.url(key, route)
+        return public_url(route)
+
+
+def make_storage(backend: str = STORAGE_BACKEND):
+    """
+    Returns the storage backend configured by STORAGE_BACKEND.
+    """
+    if backend == LocalStorage.name:
+        return LocalStorage()
+    if backend == S3Storage.name:
+        storage = S3Storage()
+        logger.info("Publishing images to s3://%s%s", storage.bucket,
+                    f"/{storage.prefix}" if storage.prefix else "")
+        return storage
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
@@ -0,0 +1,53 @@
+"""
+Multi-index Hamming search in phash, checked against a linear scan at the
+largest radius /similar-designs allows.
+"""
+
+import random
+
+import pytest
+
+from phash import HashIndex, KIND_SAVED, MAX_SEARCH_DISTANCE, _neighbours, hamming
+
+
+def _flip(value: int, positions) -> int:
+    for p in positions:
+        value ^= 1 << p
+    return value
+
+
+@pytest.fixture
+def index(tmp_path):
+    return HashIndex(path=str(tmp_path / "hashes.db"))
+
+
+def test_search_at_max_distance_matches_a_linear_scan(index):
+    rng = random.Random(7)
+    query = rng.getrandbits(64)
+    hashes = {f"random_{i}": rng.getrandbits(64) for i in range(2000)}
+    # Worst case for the chunk index: bits spread 4/4/4/3 over the chunks
+    spread = [0, 1, 2, 3, 16, 17, 18, 19, 32, 33, 34, 35, 48, 49, 50]
+    hashes["at_limit"] = _flip(query, spread)
+    hashes["past_limit"] = _flip(query, spread + [51])
+    for i in range(50):
+        hashes[f"near_{i}"] = _flip(query, rng.sample(range(64), rng.randint(0, MAX_SEARCH_DISTANCE)))
+    for name, value in hashes.items():
+        index.add(KIND_SAVED, name, value)
+
+    found = index.search(KIND_SAVED, query, MAX_SEARCH_DISTANCE, limit=len(hashes))
+
+    expected = sorted(((name, hamming(query, value)) for name, value in hashes.items()
+                       if hamming(query, value) <= MAX_SEARCH_DISTANCE),
+                      key=lambda item: (item[1], item[0]))
+    assert found == expected
+    assert ("at_limit", MAX_SEARCH_DISTANCE) in found
+    assert "past_limit" not in dict(found)
+
+
+def test_max_distance_keeps_probes_per_chunk_small():
+    assert len(_neighbours(0, MAX_SEARCH_DISTANCE // 4)) < 1000
+
+
+def test_search_rejects_a_wider_radius(index):
+    with pytest.raises(ValueError):
+        index.search(KIND_SAVED, 0, MAX_SEARCH_DISTANCE + 1)
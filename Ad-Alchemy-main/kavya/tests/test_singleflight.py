@@ -0,0 +1,85 @@
+"""
+Cross-process coalescing in singleflight: workers are separate processes
+sharing one lock directory, as gunicorn workers do.
+"""
+
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import singleflight
+from singleflight import FlightFailed, SingleFlight
+
+pytestmark = pytest.mark.skipif(singleflight.fcntl is None, reason="needs fcntl")
+
+
+def _run_flight(lock_dir, runs_path, delay, fail, results):
+    time.sleep(delay)
+
+    def produce():
+        with open(runs_path, "a") as f:
+            f.write("x")
+        time.sleep(0.5)
+        if fail:
+            raise RuntimeError("upstream failed")
+        return b"banner"
+
+    try:
+        results.put(("ok",) + SingleFlight(lock_dir).do("key", produce))
+    except FlightFailed as e:
+        results.put(("shared-failure", str(e)))
+    except RuntimeError as e:
+        results.put(("failure", str(e)))
+
+
+def _flight_outcomes(tmp_path, fail):
+    runs_path = str(tmp_path / "runs")
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_run_flight,
+                                       args=(str(tmp_path / "inflight"), runs_path, i * 0.1, fail, results))
+               for i in range(3)]
+    for worker in workers:
+        worker.start()
+    outcomes = sorted(results.get(timeout=10) for _ in workers)
+    for worker in workers:
+        worker.join()
+    with open(runs_path) as f:
+        return outcomes, len(f.read())
+
+
+def test_waiting_workers_share_the_result(tmp_path):
+    outcomes, runs = _flight_outcomes(tmp_path, fail=False)
+
+    assert runs == 1
+    assert outcomes == [("ok", b"banner", False), ("ok", b"banner", True), ("ok", b"banner", True)]
+
+
+def test_waiting_workers_share_the_failure(tmp_path):
+    outcomes, runs = _flight_outcomes(tmp_path, fail=True)
+
+    assert runs == 1
+    assert [kind for kind, _ in outcomes] == ["failure", "shared-failure", "shared-failure"]
+    assert "upstream failed" in outcomes[1][1]
+
+
+def _hold(lock_dir, started):
+    SingleFlight(lock_dir).do("held", lambda: started.set() or time.sleep(1) or b"x")
+
+
+def test_prune_keeps_files_of_a_held_key(tmp_path):
+    lock_dir = str(tmp_path)
+    started = multiprocessing.Event()
+    holder = multiprocessing.Process(target=_hold, args=(lock_dir, started))
+    holder.start()
+    assert started.wait(5)
+    open(os.path.join(lock_dir, "held.waiting"), "a").close()
+    stale = time.time() - 2 * singleflight.STALE_AFTER
+    for name in os.listdir(lock_dir):
+        os.utime(os.path.join(lock_dir, name), (stale, stale))
+
+    SingleFlight(lock_dir)._prune()
+
+    assert sorted(os.listdir(lock_dir)) == ["held.lock", "held.waiting"]
+    holder.join()
@@ -0,0 +1,342 @@
+"""
+upstream.py
+
+Client-side protection for calls to the Gemini API: a token-bucket rate
+limiter sized to our quota, retries of 429/5xx responses with jittered
+exponential backoff, and a circuit breaker that fails fast while the API
+keeps failing.
+
+Bucket and breaker state live in a small SQLite database and every update
+runs in a BEGIN IMMEDIATE transaction, so all gunicorn workers (and the
+job queue threads inside them) draw from one shared budget instead of
+each assuming it has the whole quota.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+# ------------------------------------------------------------------------------
+# Configuration: quota, retry policy and breaker thresholds
+# ------------------------------------------------------------------------------
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+UPSTREAM_DB_PATH = os.path.join(DATA_DIR, "upstream.db")
+RATE_PER_MINUTE = float(os.getenv("GEMINI_RATE_PER_MINUTE", "10"))
+BURST = float(os.getenv("GEMINI_BURST", "3"))
+ACQUIRE_TIMEOUT = float(os.getenv("GEMINI_ACQUIRE_TIMEOUT", "30"))
+MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "4"))
+BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", "1.0"))
+BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", "30"))
+BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Raised instead of calling Gemini when the quota or the circuit breaker
+    says the call cannot be made now. `retry_after` is a hint in seconds.
+    """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def status_code(error: Exception):
+    """
+    Returns the HTTP status carried by a google-genai APIError (or any
+    exception with a `code`/`status_code`), or None.
+    """
+    for attr in ("code", "status_code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    code = status_code(error)
+    return code == 429 or (code is not None and 500 <= code < 600)
+
+
+class UpstreamGuard:
+    """
+    Wraps upstream calls with the shared rate limiter, retry policy and
+    circuit breaker.
+    """
+
+    def __init__(self, path: str = UPSTREAM_DB_PATH, rate_per_minute: float = RATE_PER_MINUTE,
+                 burst: float = BURST, name: str = "gemini"):
+        self.path = path
+        self.rate = rate_per_minute / 60.0
+        self.burst = max(1.0, burst)
+        self.name = name
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS upstream_state ("
+                " name TEXT PRIMARY KEY,"
+                " tokens REAL NOT NULL,"
+                " refilled_at REAL NOT NULL,"
+                " circuit TEXT NOT NULL,"
+                " failures INTEGER NOT NULL,"
+                " opened_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO upstream_state VALUES (?, ?, ?, ?, 0, 0)",
+                (name, self.burst, time.time(), CIRCUIT_CLOSED)
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _update(self, fn):
+        """
+        Runs fn(state dict) under an exclusive write lock and stores the
+        state it leaves behind. Returns fn's result.
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            state = dict(conn.execute(
+                "SELECT * FROM upstream_state WHERE name = ?", (self.name,)).fetchone())
+            result = fn(state)
+            conn.execute(
+                "UPDATE upstream_state SET tokens = ?, refilled_at = ?, circuit = ?,"
+                " failures = ?, opened_at = ? WHERE name = ?",
+                (state['tokens'], state['refilled_at'], state['circuit'],
+                 state['failures'], state['opened_at'], self.name)
+            )
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _refill(self, state: dict, now: float):
+        elapsed = max(0.0, now - state['refilled_at'])
+        state['tokens'] = min(self.burst, state['tokens'] + elapsed * self.rate)
+        state['refilled_at'] = now
+
+    # --------------------------------------------------------------------------
+    # Circuit breaker
+    # --------------------------------------------------------------------------
+    def _check_circuit(self, claim: bool = True) -> bool:
+        """
+        Raises UpstreamUnavailable while the circuit refuses traffic.
+        Returns True when this call was let through as the half-open probe;
+        with `claim` False it only checks, and never takes the probe slot.
+        """
+        def check(state):
+            now = time.time()
+            if state['circuit'] == CIRCUIT_OPEN:
+                remaining = state['opened_at'] + BREAKER_COOLDOWN - now
+                if remaining > 0:
+                    return remaining, False
+                if claim:
+                    # Cooldown over: let exactly one probe through
+                    state['circuit'] = CIRCUIT_HALF_OPEN
+                    state['opened_at'] = now
+                return None, claim
+            if state['circuit'] == CIRCUIT_HALF_OPEN:
+                # A probe is in flight; a stuck probe is given up after one cooldown
+                if now - state['opened_at'] < BREAKER_COOLDOWN:
+                    return BREAKER_COOLDOWN - (now - state['opened_at']), False
+                if claim:
+                    state['opened_at'] = now
+                return None, claim
+            return None, False
+
+        retry_after, probe = self._update(check)
+        if retry_after is not None:
+            raise UpstreamUnavailable("Gemini is temporarily unavailable (circuit open)", retry_after)
+        return probe
+
+    def record_success(self):
+        def success(state):
+            if state['circuit'] != CIRCUIT_CLOSED:
+                logger.info("Upstream %s recovered, closing circuit", self.name)
+            state['circuit'] = CIRCUIT_CLOSED
+            state['failures'] = 0
+        self._update(success)
+
+    def record_failure(self, throttled: bool = False):
+        def failure(state):
+            now = time.time()
+            state['failures'] += 1
+            if throttled:
+                # Quota is exhausted for everyone: stop other workers spending tokens
+                self._refill(state, now)
+                state['tokens'] = min(state['tokens'], 0.0)
+            if state['circuit'] == CIRCUIT_HALF_OPEN or state['failures'] >= BREAKER_THRESHOLD:
+                if state['circuit'] != CIRCUIT_OPEN:
+                    logger.warning("Opening circuit for %s after %s failures", self.name, state['failures'])
+                state['circuit'] = CIRCUIT_OPEN
+                state['opened_at'] = now
+        self._update(failure)
+
+    # --------------------------------------------------------------------------
+    # Token bucket
+    # --------------------------------------------------------------------------
+    def _take(self) -> float:
+        """
+        Takes a token if one is available. Returns 0, or the seconds until
+        the next token.
+        """
+        def take(state):
+            self._refill(state, time.time())
+            if state['tokens'] >= 1.0:
+                state['tokens'] -= 1.0
+                return 0.0
+            return (1.0 - state['tokens']) / self.rate
+        return self._update(take)
+
+    def _refund(self):
+        """
+        Returns a token taken for a call that was never made.
+        """
+        def refund(state):
+            self._refill(state, time.time())
+            state['tokens'] = min(self.burst, state['tokens'] + 1.0)
+        self._update(refund)
+
+    def acquire(self, timeout: float = ACQUIRE_TIMEOUT):
+        """
+        Takes one token, waiting up to `timeout` seconds for the bucket to
+        refill. Raises UpstreamUnavailable when the wait would be longer.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = self._take()
+            if wait == 0.0:
+                return
+            if wait > deadline - time.monotonic():
+                raise UpstreamUnavailable("Gemini request quota exhausted", wait)
+            # Other workers compete for the same token, so re-check after waking
+            time.sleep(wait + random.uniform(0, 0.05))
+
+    async def aacquire(self, timeout: float = ACQUIRE_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while True:
+            wait = await asyncio.to_thread(self._take)
+            if wait == 0.0:
+                return
+            if wait > deadline - time.monotonic():
+                raise UpstreamUnavailable("Gemini request quota exhausted", wait)
+            await asyncio.sleep(wait + random.uniform(0, 0.05))
+
+    # --------------------------------------------------------------------------
+    # Guarded call
+    # --------------------------------------------------------------------------
+    def _retry_delay(self, error: Exception, attempt: int, max_retries: int):
+        """
+        Records a retryable failure and returns the backoff before the next
+        attempt, or None when the error should be raised.
+        """
+        if not is_retryable(error):
+            return None
+        code = status_code(error)
+        self.record_failure(throttled=code == 429)
+        if attempt >= max_retries:
+            return None
+        delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+        logger.warning("Gemini returned %s, retrying in %.1fs (attempt %s/%s)",
+                       code, delay, attempt + 1, max_retries)
+        return delay
+
+    def _admit(self) -> bool:
+        """
+        Takes a token, then passes the circuit breaker; returns True when
+        the call is the half-open probe. The probe slot is only claimed once
+        a token is in hand, so a quota timeout cannot use it up, and the
+        token is returned when the circuit turns the call away.
+        """
+        self._check_circuit(claim=False)  # fail fast rather than wait for a token
+        self.acquire()
+        try:
+            return self._check_circuit()
+        except UpstreamUnavailable:
+            self._refund()
+            raise
+
+    async def _aadmit(self) -> bool:
+        await asyncio.to_thread(self._check_circuit, False)
+        await self.aacquire()
+        try:
+            return await asyncio.to_thread(self._check_circuit)
+        except UpstreamUnavailable:
+            await asyncio.to_thread(self._refund)
+            raise
+
+    def call(self, fn, max_retries: int = MAX_RETRIES):
+        """
+        Runs fn() within the quota, retrying 429/5xx failures with full-jitter
+        exponential backoff. Other exceptions propagate untouched; when the
+        call was the half-open probe they still count as a failure, so the
+        circuit reopens instead of staying half-open.
+        """
+        attempt = 0
+        while True:
+            probe = self._admit()
+            try:
+                result = fn()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, max_retries)
+                if delay is None:
+                    if probe and not is_retryable(e):
+                        self.record_failure()
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.record_success()
+            return result
+
+    async def acall(self, fn, max_retries: int = MAX_RETRIES):
+        """
+        Async variant of call() for a coroutine function `fn`.
+        """
+        attempt = 0
+        while True:
+            probe = await self._aadmit()
+            try:
+                result = await fn()
+            except Exception as e:
+                delay = await asyncio.to_thread(self._retry_delay, e, attempt, max_retries)
+                if delay is None:
+                    if probe and not is_retryable(e):
+                        await asyncio.to_thread(self.record_failure)
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            await asyncio.to_thread(self.record_success)
+            return result
+
+    def state(self) -> dict:
+        """
+        Returns the current token count and breaker state.
+        """
+        with self._connect() as conn:
+            row = dict(conn.execute(
+                "SELECT * FROM upstream_state WHERE name = ?", (self.name,)).fetchone())
+        elapsed = max(0.0, time.time() - row['refilled_at'])
+        return {
+            'tokens': min(self.burst, row['tokens'] + elapsed * self.rate),
+            'circuit': row['circuit'],
+            'failures': row['failures'],
+        }